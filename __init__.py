@@ -2,6 +2,7 @@
 teslawatch package
 '''
 
+import collections.abc
 import sys
 
 from geopy import Nominatim
@@ -53,7 +54,7 @@ def dictMerge(old, new):
     '''
     for k, _ in new.items():
         if (k in old and isinstance(old[k], dict) and
-                isinstance(new[k], collections.Mapping)):
+                isinstance(new[k], collections.abc.Mapping)):
             dictMerge(old[k], new[k])
         else:
             old[k] = new[k]
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+'''
+################################################################################
+#
+# Columnar Archive for TeslaWatch Application
+#
+# Compacts the closed (i.e., whole, past) days of each table of the cars' DBs
+#  into compressed Parquet files, and then removes those rows from the (hot)
+#  Sqlite3 files, so the live DBs stay small.  The files are laid out in
+#  Hive-style partitions:
+#
+#    <archiveDir>/vin=<VIN>/table=<table>/date=<YYYY-MM-DD>/part-<id>.parquet
+#
+#  where the date is the (UTC) day of the rows' timestamps, and <id> is the
+#  id of the first row in the file (so re-running an interrupted compaction
+#  rewrites the same file).  Reads only open the partitions that can hold
+#  the requested cars/dates, only decode the requested columns, and push the
+#  time range (and any other filter) down to the files' row-group statistics.
+#
+# N.B.
+#  * The archived rows are exactly as stored in the DB -- i.e., with the
+#    flattened column names, and (if delta logged) with 'valid_until'.
+#  * The most recent row of each table is never archived, as the DB's delta
+#    logging might still extend it.
+#
+################################################################################
+'''
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import yaml
+
+from schemaCompiler import SEPARATOR, flattenProperties
+from teslaDB import CarDB, OVERFLOW_COL, VALID_UNTIL_COL
+from teslawatch import fatalError
+
+
+# default settings for the archive
+#  * archiveDir: path to the root directory of the archive
+#  * retention: number of (whole) days of rows that are kept in the DBs
+#  * compression: codec used for the Parquet files
+#  * rowGroupSize: max number of rows in each of the files' row groups
+#  * vacuum: if True, shrink the DB files after removing the archived rows
+DEF_ARCHIVE_SETTINGS = {
+    'archiveDir': None,
+    'retention': 7,
+    'compression': "zstd",
+    'rowGroupSize': 64 * 1024,
+    'vacuum': False
+}
+
+# number of ms per day (the units of the rows' timestamps are ms)
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+# map JSON Schema types to Arrow types
+ARROW_TYPE_MAP = {
+    'integer': pa.int64(),
+    'number': pa.float64(),
+    'boolean': pa.bool_(),
+    'string': pa.string()
+}
+
+# types of the columns that aren't in the schema
+EXTRA_COLUMN_TYPES = {
+    'id': pa.int64(),
+    VALID_UNTIL_COL: pa.int64(),
+    OVERFLOW_COL: pa.string()
+}
+
+# partitioning of the archive's directory tree
+PARTITIONING = ds.partitioning(pa.schema([("vin", pa.string()),
+                                          ("table", pa.string()),
+                                          ("date", pa.string())]),
+                               flavor="hive")
+
+DEF_CONFIGS_FILE = "./.teslas.yml"
+
+DEF_SCHEMA_FILE = "./dbSchema.yml"
+
+
+def dayOf(timestamp):
+    ''' Return the (UTC) date string of a timestamp (in ms since the epoch)
+    '''
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp // 1000))
+
+
+def toTimestamp(value):
+    ''' Take a time given as ms since the epoch, or as an ISO 8601 date/time
+        string (UTC, unless it has a time zone), and return it in ms since the
+        epoch.
+    '''
+    if value is None or isinstance(value, int):
+        return value
+    if value.isdigit():
+        return int(value)
+    t = datetime.datetime.fromisoformat(value)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return int(t.timestamp() * 1000)
+
+
+class Archiver(object):
+    ''' Object that moves the closed days of a car's DB into the archive.
+    '''
+    def __init__(self, cdb, settings=None):
+        ''' Construct an archiver object
+
+            Inputs
+              cdb: the CarDB object of the car to be archived
+              settings: optional dict that overrides the values in
+                DEF_ARCHIVE_SETTINGS (which must include 'archiveDir')
+        '''
+        self.cdb = cdb
+        self.settings = dict(DEF_ARCHIVE_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        if not self.settings['archiveDir']:
+            raise ValueError("Must give an archive directory")
+        if self.settings['retention'] < 0:
+            raise ValueError(f"Invalid retention: {self.settings['retention']}")
+
+    def arrowSchema(self, tableName):
+        ''' Return the Arrow schema of a table's archive files.
+        '''
+        types = {SEPARATOR.join(path): ARROW_TYPE_MAP.get(fieldType, pa.string())
+                 for path, fieldType in
+                 flattenProperties(self.cdb.schema['tables'][tableName]['properties'])}
+        types.update(EXTRA_COLUMN_TYPES)
+        return pa.schema([(col, types[col]) for col in ['id'] + self.cdb.columns[tableName]])
+
+    def _writeFile(self, tableName, day, rows, schema):
+        ''' Write a day's rows of a table to a Parquet file in the archive.
+
+            Returns
+              Path to the file
+        '''
+        arrays = []
+        fields = []
+        for i, field in enumerate(schema):
+            values = [r[i] for r in rows]
+            try:
+                arrays.append(pa.array(values, type=field.type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # N.B. Sqlite doesn't enforce the columns' types
+                sys.stderr.write(f"WARNING: archiving column '{field.name}' of table "
+                                 f"'{tableName}' on {day} as strings\n")
+                field = field.with_type(pa.string())
+                arrays.append(pa.array([None if v is None else str(v) for v in values],
+                                       type=pa.string()))
+            fields.append(field)
+        table = pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+        dirPath = os.path.join(self.settings['archiveDir'], f"vin={self.cdb.vin}",
+                               f"table={tableName}", f"date={day}")
+        os.makedirs(dirPath, exist_ok=True)
+        path = os.path.join(dirPath, f"part-{rows[0][0]}.parquet")
+        # N.B. write a temp file and rename it, so readers never see a partial file
+        tmpPath = path + ".tmp"
+        pq.write_table(table, tmpPath, compression=self.settings['compression'],
+                       row_group_size=self.settings['rowGroupSize'])
+        os.replace(tmpPath, path)
+        return path
+
+    def compactTable(self, tableName, before):
+        ''' Move all of the rows of a table from the days before the given
+            time into the archive, with one file per day.
+
+            Inputs
+              tableName: String with name of table to be archived
+              before: time (in ms since the epoch, at the start of a day)
+                before which rows are archived
+
+            Returns
+              Number of rows archived
+        '''
+        latestId = self.cdb.getLatestId(tableName)
+        if latestId is None:
+            return 0
+        schema = self.arrowSchema(tableName)
+        ids = []
+        day = None
+        rows = []
+        for row in self.cdb.query(tableName, end=before - 1, columns=schema.names,
+                                  namedTuples=True):
+            if row.id == latestId:
+                continue
+            rowDay = dayOf(row.timestamp)
+            if rowDay != day and rows:
+                self._writeFile(tableName, day, rows, schema)
+                ids.extend(r.id for r in rows)
+                rows = []
+            day = rowDay
+            rows.append(row)
+        if rows:
+            self._writeFile(tableName, day, rows, schema)
+            ids.extend(r.id for r in rows)
+        # N.B. the rows are only removed once their files are in place, and
+        #      the query's cursor is done with the table
+        return self.cdb.deleteRows(tableName, ids) if ids else 0
+
+    def compact(self, now=None):
+        ''' Move the rows of all of the car's tables that are older than the
+            retention period into the archive.
+
+            Inputs
+              now: optional current time (in secs since the epoch)
+
+            Returns
+              Dict whose keys are table names and whose values are the
+              number of rows archived from them
+        '''
+        if now is None:
+            now = time.time()
+        before = (int(now * 1000) // MS_PER_DAY - self.settings['retention']) * MS_PER_DAY
+        self.cdb.flush()
+        counts = {}
+        for tableName in self.cdb.columns:
+            counts[tableName] = self.compactTable(tableName, before)
+        if self.settings['vacuum'] and any(counts.values()):
+            self.cdb.vacuum()
+        return counts
+
+
+def isCarDB(dbFile, schema):
+    ''' Return True if a DB file has all of the tables in the schema (i.e.,
+        it's a car's DB, and not some other file in the DB directory).
+    '''
+    db = sqlite3.connect(dbFile)
+    try:
+        names = set(r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type='table';"))
+    except sqlite3.Error:
+        return False
+    finally:
+        db.close()
+    return set(schema['tables'].keys()) <= names
+
+
+def archiveFiles(archiveDir, tableName, vins=None, start=None, end=None):
+    ''' Return a list of the paths of the archive files of a table that can
+        hold rows of the given cars in the given (inclusive) time range.
+
+        Inputs
+          archiveDir: path to the root directory of the archive
+          tableName: String with name of table
+          vins: optional list of the VINs of the cars (defaults to all)
+          start: optional start of the time range (in ms since the epoch)
+          end: optional end of the time range (in ms since the epoch)
+    '''
+    startDay = dayOf(start) if start is not None else None
+    endDay = dayOf(end) if end is not None else None
+    paths = []
+    pattern = os.path.join(archiveDir, "vin=*", f"table={tableName}", "date=*", "*.parquet")
+    for path in sorted(glob.glob(pattern)):
+        dirPath, _ = os.path.split(path)
+        day = os.path.basename(dirPath)[len("date="):]
+        vin = os.path.basename(os.path.dirname(os.path.dirname(dirPath)))[len("vin="):]
+        if vins and vin not in vins:
+            continue
+        # N.B. delta-logged rows can be valid beyond the day they started on
+        if endDay and day > endDay:
+            continue
+        if startDay and day < startDay and VALID_UNTIL_COL not in pq.read_schema(path).names:
+            continue
+        paths.append(path)
+    return paths
+
+
+def readArchive(archiveDir, tableName, columns=None, vins=None, start=None,
+                end=None, filter=None):
+    ''' Read the archived rows of a table.
+
+        Inputs
+          archiveDir: path to the root directory of the archive
+          tableName: String with name of table to be read
+          columns: optional list of the names of the columns to return
+            (defaults to all of them, plus the 'vin' and 'date' partitions)
+          vins: optional list of the VINs of the cars (defaults to all)
+          start: optional start of the (inclusive) time range, in ms since
+            the epoch
+          end: optional end of the (inclusive) time range, in ms since the
+            epoch
+          filter: optional pyarrow.compute expression that rows must match
+
+        Returns
+          pyarrow Table with the rows, or None if there aren't any files
+    '''
+    paths = archiveFiles(archiveDir, tableName, vins, start, end)
+    if not paths:
+        return None
+    # N.B. the files' columns change as the DB's tables evolve
+    schema = pa.unify_schemas([pq.read_schema(p) for p in paths],
+                              promote_options="permissive")
+    for field in PARTITIONING.schema:
+        if field.name not in schema.names:
+            schema = schema.append(field)
+    dataset = ds.dataset(paths, schema=schema, format="parquet",
+                         partitioning=PARTITIONING, partition_base_dir=archiveDir)
+
+    expr = pc.field('table') == tableName
+    if vins:
+        expr &= pc.field('vin').isin(vins)
+    if start is not None:
+        if VALID_UNTIL_COL in schema.names:
+            expr &= ((pc.field('timestamp') >= start) |
+                     (pc.field(VALID_UNTIL_COL) >= start))
+        else:
+            expr &= pc.field('timestamp') >= start
+    if end is not None:
+        expr &= pc.field('timestamp') <= end
+    if filter is not None:
+        expr &= filter
+    if columns is None:
+        columns = [n for n in schema.names if n != 'table']
+    return dataset.to_table(columns=columns, filter=expr)
+
+
+#
+# MAIN
+#
+def main():
+    usage = f"Usage: {sys.argv[0]} [-v] [-a <archiveDir>] [-c <configsFile>] [-d <dbDir>] [-s <schemaFile>] [-V <VIN>] [-t <table>] [-C <column>] [-S <start>] [-E <end>] [-o <outFile>] {{compact|read}}"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-a", "--archiveDir", action="store", type=str,
+        help="path to the root directory of the archive")
+    ap.add_argument(
+        "-c", "--configsFile", action="store", type=str,
+        default=DEF_CONFIGS_FILE, help="path to file with configurations")
+    ap.add_argument(
+        "-d", "--dbDir", action="store", type=str,
+        help="path to a directory that contains the DB files for cars")
+    ap.add_argument(
+        "-r", "--retention", action="store", type=int,
+        help="number of days of rows to keep in the DBs")
+    ap.add_argument(
+        "-s", "--schemaFile", action="store", type=str, default=DEF_SCHEMA_FILE,
+        help="path to the JSON Schema file that describes the DB's tables")
+    ap.add_argument(
+        "-V", "--VIN", action="append", type=str,
+        help="VIN of a car to use (defaults to all)")
+    ap.add_argument(
+        "-t", "--table", action="store", type=str, default="driveState",
+        help="name of the table to read")
+    ap.add_argument(
+        "-C", "--column", action="append", type=str,
+        help="name of a column to read (defaults to all)")
+    ap.add_argument(
+        "-S", "--start", action="store", type=str,
+        help="start of the time range to read (ms since the epoch, or ISO 8601)")
+    ap.add_argument(
+        "-E", "--end", action="store", type=str,
+        help="end of the time range to read (ms since the epoch, or ISO 8601)")
+    ap.add_argument(
+        "-o", "--outFile", action="store", type=str,
+        help="path to a (.parquet or .csv) file to write the rows read to")
+    ap.add_argument(
+        "-v", "--verbose", action="count", default=0, help="print debug info")
+    ap.add_argument(
+        "cmd", action="store", type=str, choices=("compact", "read"),
+        help="move old rows into the archive, or read rows from it")
+    opts = ap.parse_args()
+
+    confs = {}
+    if os.path.exists(opts.configsFile):
+        with open(opts.configsFile, "r") as confsFile:
+            confs = list(yaml.load_all(confsFile, Loader=yaml.Loader))[0]
+    settings = dict(confs.get('archive') or {})
+    if opts.archiveDir:
+        settings['archiveDir'] = opts.archiveDir
+    if opts.retention is not None:
+        settings['retention'] = opts.retention
+    if not settings.get('archiveDir'):
+        fatalError("Must give an archive directory")
+
+    if opts.cmd == "read":
+        table = readArchive(settings['archiveDir'], opts.table, opts.column,
+                            opts.VIN, toTimestamp(opts.start), toTimestamp(opts.end))
+        if table is None:
+            fatalError(f"No archived rows for table '{opts.table}'")
+        if opts.outFile and opts.outFile.endswith(".csv"):
+            import pyarrow.csv
+            pyarrow.csv.write_csv(table, opts.outFile)
+        elif opts.outFile:
+            pq.write_table(table, opts.outFile, compression=settings.get('compression', "zstd"))
+        else:
+            for row in table.slice(0, 10).to_pylist():
+                print(json.dumps(row, sort_keys=True, default=str))
+        print(f"Rows: {table.num_rows}; Columns: {table.column_names}")
+        return
+
+    dbDir = opts.dbDir or confs.get('dbDir')
+    if not dbDir or not os.path.isdir(dbDir):
+        fatalError(f"Invalid DB directory path: {dbDir}")
+    schemaFile = opts.schemaFile
+    if not os.path.isfile(schemaFile):
+        schemaFile = confs.get('schema')
+    if not schemaFile or not os.path.isfile(schemaFile):
+        fatalError(f"Invalid DB schema file: {schemaFile}")
+    with open(schemaFile, "r") as f:
+        schema = yaml.load(f, Loader=yaml.Loader)
+    dbSettings = dict(confs.get('dbSettings') or {})
+    dbSettings['writerThread'] = False
+
+    vins = opts.VIN or sorted(os.path.basename(p)[:-len(".db")]
+                              for p in glob.glob(os.path.join(dbDir, "*.db")))
+    for vin in vins:
+        dbFile = os.path.join(dbDir, vin + ".db")
+        if not os.path.isfile(dbFile) or not isCarDB(dbFile, schema):
+            if opts.VIN:
+                sys.stderr.write(f"WARNING: no DB file for '{vin}'; skipping...\n")
+            continue
+        with CarDB(vin, dbFile, schema, create=False, settings=dbSettings) as cdb:
+            counts = Archiver(cdb, settings).compact()
+        if opts.verbose:
+            print(f"{vin}: {counts}")
+
+
+#
+# TESTING
+#
+def selfTest():
+    ''' Archive a few days of rows of a temporary DB, and check that they
+        are read back from the archive, and removed from the DB.
+    '''
+    import tempfile
+
+    with open(DEF_SCHEMA_FILE, "r") as f:
+        schema = yaml.load(f, Loader=yaml.Loader)
+    tmpDir = tempfile.mkdtemp()
+    vin = "5YJSA1H1XTEST0000"
+    now = 1700000000
+    today = (now * 1000 // MS_PER_DAY) * MS_PER_DAY
+    # N.B. more rows per day than are fetched per chunk by the DB's queries
+    numDays, perDay = 4, 600
+    timestamps = [today - (numDays - d) * MS_PER_DAY + i * 60000
+                  for d in range(numDays + 1) for i in range(perDay)]
+    with CarDB(vin, os.path.join(tmpDir, vin + ".db"), schema,
+               settings={'batchSize': 1000, 'batchAge': 60}) as cdb:
+        for t in timestamps:
+            cdb.insertRow('driveState', {'timestamp': t, 'latitude': 37.46,
+                                         'longitude': -122.16, 'speed': t % 90})
+        counts = Archiver(cdb, {'archiveDir': os.path.join(tmpDir, "archive"),
+                                'retention': 1}).compact(now)
+        kept = [r['timestamp'] for r in cdb.query('driveState', columns=['timestamp'])]
+    archived = [t for t in timestamps if t < today - MS_PER_DAY]
+    table = readArchive(os.path.join(tmpDir, "archive"), 'driveState', vins=[vin])
+    failed = False
+    if counts['driveState'] != len(archived):
+        print(f"FAILED: archived {counts['driveState']} rows, not {len(archived)}")
+        failed = True
+    if table is None or sorted(table.column('timestamp').to_pylist()) != archived:
+        print("FAILED: rows read from the archive")
+        failed = True
+    if kept != [t for t in timestamps if t >= today - MS_PER_DAY]:
+        print("FAILED: rows kept in the DB")
+        failed = True
+    if table is not None:
+        print(f"Archived: {table.num_rows} rows of {sorted(set(table.column('date').to_pylist()))}")
+    if failed:
+        sys.exit(1)
+    print("SUCCEEDED")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        selfTest()
+    else:
+        main()
@@ -0,0 +1,211 @@
+'''
+################################################################################
+#
+# Single-Process (asyncio) Tracker Engine for TeslaWatch Application
+#
+# Runs all of the Trackers as coroutines on one event loop, instead of one
+#  process per car.  The Tesla API library is synchronous, so its requests are
+#  made from a shared, bounded thread pool, with a limit on the number of
+#  requests that can be in flight at once across all of the cars, and
+#  (optionally) a limit on their rate that waits on the loop.
+#
+################################################################################
+'''
+
+import asyncio
+import concurrent.futures
+import functools
+import sys
+import threading
+
+from ipc import command
+
+
+# default max number of concurrent requests to the Tesla API
+DEF_MAX_CONCURRENT = 8
+
+
+class ApiClient(object):
+    ''' Shared, concurrency-limited client for making (blocking) requests of
+        the Tesla API from coroutines.
+    '''
+    def __init__(self, maxConcurrent=DEF_MAX_CONCURRENT, limiter=None):
+        ''' Construct an API client object
+
+            Inputs
+              maxConcurrent: max number of requests that can be in flight
+              limiter: optional AsyncTokenBucket that limits the rate of the
+                requests
+        '''
+        self.maxConcurrent = maxConcurrent
+        self.limiter = limiter
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=maxConcurrent, thread_name_prefix="teslaApi")
+        self.semaphore = None
+
+    async def call(self, func, *args, priority=None, tokens=1):
+        ''' Call the given (blocking) function that makes Tesla API requests
+            in the client's thread pool, and return its result.
+
+            N.B. the priority and number of tokens (i.e., requests the function
+                 makes) are used with the rate limiter, if there is one
+        '''
+        if self.limiter:
+            await self.limiter.acquireAsync(tokens, priority)
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.maxConcurrent)
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(self.executor,
+                                              functools.partial(func, *args))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class CmdQueue(object):
+    ''' Object with the put() method of a Queue that can be used by other
+        threads to send commands to a Tracker running on the engine's loop.
+    '''
+    def __init__(self, engine, vin):
+        self.engine = engine
+        self.vin = vin
+
+    def put(self, cmd):
+        self.engine.sendCmd(self.vin, cmd)
+
+
+class AsyncEngine(object):
+    ''' Object that runs a set of Trackers as coroutines on a single event
+        loop, sharing one ApiClient.
+    '''
+    def __init__(self, trackers, maxConcurrent=DEF_MAX_CONCURRENT, limiter=None):
+        ''' Construct an engine object
+
+            Inputs
+              trackers: dict of Tracker objects, whose keys are VINs
+              maxConcurrent: max number of concurrent Tesla API requests
+              limiter: optional AsyncTokenBucket that limits the rate of the
+                Tesla API requests made by all of the Trackers
+        '''
+        self.trackers = dict(trackers)
+        self.client = ApiClient(maxConcurrent, limiter)
+        self.loop = None
+        self.ready = threading.Event()
+        self.tasks = {}
+        self.closed = None
+
+    def cmdQueues(self):
+        ''' Return a dict of objects (one per VIN) whose put() method sends a
+            command to the corresponding Tracker.
+        '''
+        return {vin: CmdQueue(self, vin) for vin in self.trackers}
+
+    def sendCmd(self, vin, cmd):
+        ''' Send a command to the Tracker of the given car (from any thread).
+        '''
+        self.ready.wait()
+        self.loop.call_soon_threadsafe(self._putCmd, vin, cmd)
+
+    def _putCmd(self, vin, cmd):
+        if vin in self.tasks:
+            self.trackers[vin].inQ.put_nowait(cmd)
+
+    def stop(self):
+        ''' Tell all of the Trackers to stop.
+        '''
+        for vin in self.trackers:
+            self.sendCmd(vin, command("STOP"))
+
+    def addTracker(self, vin, tracker):
+        ''' Start running another Tracker (from another thread), replacing any
+            (stopped) Tracker of the same car, and return once it's running.
+        '''
+        self.ready.wait()
+        started = concurrent.futures.Future()
+
+        def start():
+            self._startTracker(vin, tracker)
+            started.set_result(None)
+        self.loop.call_soon_threadsafe(start)
+        started.result()
+
+    def cancelTracker(self, vin):
+        ''' Cancel the coroutine of the Tracker of the given car (from any
+            thread), e.g., if it doesn't stop when told to.
+        '''
+        self.ready.wait()
+        self.loop.call_soon_threadsafe(self._cancelTracker, vin)
+
+    def isRunning(self, vin):
+        ''' Return True if the Tracker of the given car is running.
+        '''
+        return vin in self.tasks
+
+    def close(self):
+        ''' Tell all of the Trackers to stop, and make run() return once they
+            have, even if it was called with 'persistent'.
+        '''
+        self.stop()
+        self.loop.call_soon_threadsafe(self.closed.set)
+
+    def _cancelTracker(self, vin):
+        task = self.tasks.get(vin)
+        if task:
+            task.cancel()
+
+    def _trackerDone(self, vin, task):
+        # N.B. the car's Tracker might have been replaced already
+        if self.tasks.get(vin) is task:
+            del self.tasks[vin]
+        if not task.cancelled() and task.exception():
+            sys.stderr.write(f"WARNING: tracker for '{vin}' failed: {task.exception()}\n")
+
+    def _startTracker(self, vin, tracker):
+        if vin in self.tasks:
+            sys.stderr.write(f"WARNING: tracker for '{vin}' is already running\n")
+            return
+        self.trackers[vin] = tracker
+        tracker.inQ = asyncio.Queue()
+        task = self.loop.create_task(tracker.runAsync(self.client))
+        self.tasks[vin] = task
+        task.add_done_callback(functools.partial(self._trackerDone, vin))
+
+    async def _main(self, persistent):
+        self.loop = asyncio.get_running_loop()
+        self.closed = asyncio.Event()
+        for vin, tracker in self.trackers.items():
+            self._startTracker(vin, tracker)
+        self.ready.set()
+        try:
+            if persistent:
+                await self.closed.wait()
+            while self.tasks:
+                await asyncio.wait(list(self.tasks.values()))
+        finally:
+            self.client.close()
+
+    def run(self, persistent=False):
+        ''' Run all of the Trackers until they've all stopped.
+
+            Inputs
+              persistent: if True, keep running (so that Trackers can be
+                added) until close() is called
+        '''
+        asyncio.run(self._main(persistent))
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    import time
+
+    async def test():
+        client = ApiClient(2)
+        start = time.time()
+        await asyncio.gather(*[client.call(time.sleep, 0.1) for _ in range(4)])
+        print(f"4 calls, 2 at a time: {time.time() - start:.2f} secs")
+        client.close()
+
+    asyncio.run(test())
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+'''
+################################################################################
+#
+# Benchmarks for TeslaWatch Application
+#
+# Runs the trackers of N virtual cars against a mock Tesla API server (see
+#  mockTesla.py), in each of the engine modes (i.e., a process per car, or all
+#  cars on one asyncio loop), and measures:
+#   * samples/sec: table samples served by the mock (and so processed)
+#   * event latency: real time from when a car starts/stops moving in its
+#     trace, to when its tracker emits the event
+#   * DB rows/sec: rows written to the cars' DBs
+#   * memory per car: resident memory of the trackers
+#  along with the raw write rate of a CarDB with various settings.
+#
+# The traces are replayed 'speed' times faster than real time, and all of
+#  the trackers' polling intervals are scaled down to match, so a run covers
+#  'speed' times its duration of (virtual) driving and parking.
+#
+################################################################################
+'''
+
+import argparse
+import contextlib
+import copy
+import json
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from asyncEngine import AsyncEngine, DEF_MAX_CONCURRENT
+from ipc import Hub
+from mockTesla import HttpConnection, MockApi, MockServer, makeCars, loadTrace, syntheticTrace
+from teslaCar import Car
+from teslaDB import CarDB
+from teslaWatch import DEF_API_SETTINGS, DEF_DB_SETTINGS, DEF_SETTINGS, ENGINES
+from tracker import Tracker
+
+
+DEF_NUM_CARS = [1, 4]
+
+# default number of (real) secs each engine is run for
+DEF_DURATION = 30
+
+# default number of secs of trace replayed per (real) sec
+DEF_SPEED = 60
+
+# default mean latency (in real secs) of the mock's requests
+DEF_LATENCY = 0.02
+
+# default number of rows written in the DB write benchmark
+DEF_DB_ROWS = 20000
+
+# settings of the CarDB that are compared in the DB write benchmark
+DB_BENCH_SETTINGS = {
+    'commitEachRow': {'batchSize': 1},
+    'batched': {'batchSize': 100, 'batchAge': 30},
+    'writerThread': {'batchSize': 100, 'batchAge': 30, 'writerThread': True},
+    'deltaLogging': {'batchSize': 100, 'batchAge': 30, 'deltaLogging': True}
+}
+
+# keys of the settings whose values are secs (of the car's time), and that
+#  are scaled to match the replay's speed
+SCALED_SETTINGS = ('intervals', 'stateIntervals', 'sleep', 'regionDwell')
+
+
+def rss(pid=None):
+    ''' Return the resident memory (in bytes) of the given process (defaults
+        to this one), or its peak if the current value can't be read.
+    '''
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF if pid is None else resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def scaleSettings(settings, factor, scale=False):
+    ''' Return a copy of the trackers' settings with the times in them
+        multiplied by the given factor.
+    '''
+    if isinstance(settings, dict):
+        return {k: scaleSettings(v, factor, scale or k in SCALED_SETTINGS)
+                for k, v in settings.items()}
+    if scale and isinstance(settings, (int, float)) and not isinstance(settings, bool):
+        return settings * factor
+    return copy.deepcopy(settings)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def eventLatencies(transitions, events):
+    ''' Match the events emitted by the trackers with the transitions in the
+        cars' traces that caused them, and return the list of their latencies
+        (in secs), along with the number of transitions.
+
+        Inputs
+          transitions: dict whose keys are VINs and whose values are lists of
+            (time, eventType) tuples of the transitions in the traces
+          events: dict whose keys are VINs and whose values are lists of
+            (time, eventType) tuples of the events emitted
+
+        N.B. an event is matched to the latest (unmatched) transition of the
+             same type that came before it, so missed transitions don't count
+    '''
+    latencies = []
+    numTransitions = 0
+    for vin, truth in transitions.items():
+        numTransitions += len(truth)
+        matched = set()
+        for t, eventType in events.get(vin, []):
+            candidates = [i for i, (tt, et) in enumerate(truth)
+                          if et == eventType and tt <= t and i not in matched]
+            if candidates:
+                i = candidates[-1]
+                matched.add(i)
+                latencies.append(t - truth[i][0])
+    return latencies, numTransitions
+
+
+def runEngine(engine, url, numCars, duration, schema, dbDir, speed, maxConcurrent):
+    ''' Run the trackers of the given number of cars of the mock server with
+        the given engine, and return a dict with the results.
+    '''
+    conn = HttpConnection(url)
+    conn.control("POST", "reset")
+    baseRss = rss()
+
+    settings = scaleSettings(DEF_SETTINGS, 1.0 / speed)
+    settings['nightHours'] = None
+    apiSettings = DEF_API_SETTINGS
+    dbSettings = dict(DEF_DB_SETTINGS)
+    dbSettings['batchAge'] = max(1, DEF_DB_SETTINGS['batchAge'] / speed)
+    carSettings = {k: apiSettings[k] for k in ('snapshotMode', 'retry', 'breaker')}
+    carSettings['retry'] = dict(apiSettings['retry'])
+    for k in ('baseDelay', 'maxDelay'):
+        carSettings['retry'][k] /= speed
+
+    events = {}
+
+    def recordEvent(msg):
+        # N.B. called in the hub's thread, as the messages arrive
+        if msg.type == "EVENT":
+            events[msg.vin].append((time.time(), msg.data['eventType']))
+
+    hub = Hub(handler=recordEvent)
+    trackers = {}
+    dbFiles = {}
+    for vehicle in conn.vehicles[:numCars]:
+        vin = vehicle['vin']
+        car = Car(vin, {}, vehicle, carSettings)
+        dbFiles[vin] = os.path.join(dbDir, f"{engine}-{vin}.db")
+        cdb = CarDB(vin, dbFiles[vin], schema, settings=dbSettings)
+        events[vin] = []
+        channel = hub.add(vin)
+        trackers[vin] = Tracker(car, cdb, schema['tables'].keys(), copy.deepcopy(settings),
+                                [], None, None if engine == "async" else channel, channel)
+
+    start = time.time()
+    if engine == "async":
+        runner = AsyncEngine(trackers, maxConcurrent)
+        thread = threading.Thread(target=runner.run, name="asyncEngine")
+        thread.start()
+    else:
+        procs = {vin: mp.Process(target=tracker.run) for vin, tracker in trackers.items()}
+        for proc in procs.values():
+            proc.start()
+    hub.start()
+    time.sleep(duration)
+
+    if engine == "async":
+        memory = rss() - baseRss
+    else:
+        memory = sum(rss(p.pid) for p in procs.values())
+    transitions = {vin: ts for vin, ts in conn.control("GET", "transitions").items()
+                   if vin in trackers}
+    stats = conn.control("GET", "stats")
+    elapsed = time.time() - start
+
+    if engine == "async":
+        runner.stop()
+        thread.join()
+    else:
+        for vin in trackers:
+            hub.send(vin, "STOP")
+        for proc in procs.values():
+            proc.join(10)
+            if proc.is_alive():
+                proc.terminate()
+        # N.B. the trackers closed their (forked) copies of the DBs
+        for tracker in trackers.values():
+            tracker.db.close()
+    hub.close()
+
+    rows = 0
+    for vin, dbFile in dbFiles.items():
+        with CarDB(vin, dbFile, schema, create=False) as cdb:
+            rows += sum(len(cdb.getTable(t)) for t in schema['tables'])
+    latencies, numTransitions = eventLatencies(transitions, events)
+    return {
+        'engine': engine,
+        'cars': numCars,
+        'secs': round(elapsed, 2),
+        'samplesPerSec': round(stats['samples'] / elapsed, 1),
+        'requests': stats['requests'],
+        'errors': sum(stats['errors'].values()),
+        'asleep': stats['asleep'],
+        'sleeps': stats['sleeps'],
+        'events': sum(len(e) for e in events.values()),
+        'transitions': numTransitions,
+        'latencyP50': round(percentile(latencies, 50), 3) if latencies else None,
+        'latencyP95': round(percentile(latencies, 95), 3) if latencies else None,
+        'dbRowsPerSec': round(rows / elapsed, 1),
+        'memoryPerCarMB': round(memory / numCars / (1024 * 1024), 2)
+    }
+
+
+def benchDB(schema, dbDir, numRows=DEF_DB_ROWS):
+    ''' Measure the rate at which driveState rows can be written to a CarDB
+        with each of the settings in DB_BENCH_SETTINGS.
+
+        Returns
+          Dict whose keys are the names of the settings and whose values are
+          the number of rows written per sec
+    '''
+    trace = syntheticTrace(duration=numRows, seed=0)['driveState']
+    rates = {}
+    for name, settings in DB_BENCH_SETTINGS.items():
+        dbFile = os.path.join(dbDir, f"db-{name}.db")
+        dbSettings = dict(DEF_DB_SETTINGS)
+        dbSettings.update({'batchSize': 1, 'batchAge': 0, 'writerThread': False,
+                           'deltaLogging': False})
+        dbSettings.update(settings)
+        # N.B. a full queue drops rows, so make room for all of them
+        dbSettings['queueSize'] = len(trace) + 1
+        cdb = CarDB("BENCH", dbFile, schema, settings=dbSettings)
+        start = time.perf_counter()
+        for row in trace:
+            cdb.insertRow('driveState', row)
+        cdb.close()
+        rates[name] = round(len(trace) / (time.perf_counter() - start), 1)
+    return rates
+
+
+#
+# MAIN
+#
+def main():
+    usage = f"Usage: {sys.argv[0]} [-v] [-n <numCars>] [-d <duration>] [-e <engine>] [-S <speed>] [-l <latency>] [-E <errorRate>] [-t <traceFile>] [-s <schemaFile>] [-r <dbRows>] [-o <outFile>]"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-n", "--numCars", action="append", type=int,
+        help=f"number of cars to run (defaults to {DEF_NUM_CARS})")
+    ap.add_argument(
+        "-d", "--duration", action="store", type=float, default=DEF_DURATION,
+        help="number of secs to run each engine for")
+    ap.add_argument(
+        "-e", "--engine", action="append", type=str, choices=ENGINES,
+        help="engine to run (defaults to all)")
+    ap.add_argument(
+        "-S", "--speed", action="store", type=float, default=DEF_SPEED,
+        help="number of secs of the traces replayed per sec")
+    ap.add_argument(
+        "-l", "--latency", action="store", type=float, default=DEF_LATENCY,
+        help="mean number of secs each request of the mock takes")
+    ap.add_argument(
+        "-E", "--errorRate", action="store", type=float, default=0.0,
+        help="fraction of the mock's requests that fail")
+    ap.add_argument(
+        "-t", "--traceFile", action="store", type=str,
+        help="path to a JSON or DB file with the trace to replay (defaults to a synthetic one)")
+    ap.add_argument(
+        "-s", "--schemaFile", action="store", type=str, default="./dbSchema.yml",
+        help="path to the JSON Schema file that describes the DB's tables")
+    ap.add_argument(
+        "-r", "--dbRows", action="store", type=int, default=DEF_DB_ROWS,
+        help="number of rows written in the DB benchmark (0 to skip it)")
+    ap.add_argument(
+        "-o", "--outFile", action="store", type=str,
+        help="path to a file to write the results to (as JSON)")
+    ap.add_argument(
+        "-v", "--verbose", action="count", default=0, help="print debug info")
+    options = ap.parse_args()
+
+    with open(options.schemaFile, "r") as f:
+        schema = yaml.load(f, Loader=yaml.Loader)
+    trace = loadTrace(options.traceFile, schema) if options.traceFile else syntheticTrace(seed=0)
+    numCars = options.numCars or DEF_NUM_CARS
+    engines = options.engine or ENGINES
+
+    mockSettings = {'speed': options.speed, 'latency': options.latency,
+                    'errorRate': options.errorRate}
+    api = MockApi(makeCars(max(numCars), trace, mockSettings), mockSettings)
+    server = MockServer(api)
+    # N.B. the server runs in its own process, so it doesn't compete with the
+    #      async engine for the GIL
+    serverProc = mp.Process(target=server.serve_forever, daemon=True)
+    serverProc.start()
+    server.server_close()
+
+    results = {'engines': [], 'db': None}
+    with tempfile.TemporaryDirectory() as dbDir:
+        for n in numCars:
+            for engine in engines:
+                # N.B. the trackers print every sample
+                with open(os.devnull, "w") as devNull, contextlib.redirect_stdout(devNull):
+                    result = runEngine(engine, server.url(), n, options.duration, schema,
+                                       dbDir, options.speed, DEF_MAX_CONCURRENT)
+                results['engines'].append(result)
+                print(json.dumps(result))
+        if options.dbRows > 0:
+            results['db'] = benchDB(schema, dbDir, options.dbRows)
+            print(f"DB rows/sec: {json.dumps(results['db'])}")
+    serverProc.terminate()
+
+    if options.outFile:
+        with open(options.outFile, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+'''
+################################################################################
+#
+# Notification Dispatcher for TeslaWatch Application
+#
+# Runs the (external) notifier programs in a bounded pool of worker threads,
+#  so the trackers only have to put a job on a queue when an event happens,
+#  and never wait on a (slow or failing) notifier.  The programs are run
+#  directly (i.e., without a shell), with a timeout, and failed jobs are
+#  retried with exponential backoff before being written to a dead-letter log.
+#
+################################################################################
+'''
+
+import collections
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+
+# default number of worker threads
+DEF_WORKERS = 4
+
+# default max number of jobs waiting to be run
+DEF_QUEUE_SIZE = 256
+
+# default number of secs a notifier program is allowed to run for
+DEF_TIMEOUT = 30
+
+# default number of times a failed job is retried, and the number of secs
+#  before the first retry (which doubles with each subsequent retry)
+DEF_RETRIES = 3
+DEF_BACKOFF = 2
+
+# default max number of instances of any one notifier run at the same time
+DEF_MAX_PER_NOTIFIER = 1
+
+# default settings for the dispatcher
+DEF_DISPATCHER_SETTINGS = {
+    'workers': DEF_WORKERS,
+    'queueSize': DEF_QUEUE_SIZE,
+    'timeout': DEF_TIMEOUT,
+    'retries': DEF_RETRIES,
+    'backoff': DEF_BACKOFF,
+    'maxPerNotifier': DEF_MAX_PER_NOTIFIER,
+    'deadLetterFile': None
+}
+
+# marker put on the queue to stop a worker thread
+_STOP_WORKER = None
+
+
+class Dispatcher(object):
+    ''' Object that runs notifier programs asynchronously, on behalf of one or
+        more Notifier objects.
+
+        N.B. the worker threads are started on first use, so a dispatcher can
+             be created before the tracker processes are forked
+    '''
+    def __init__(self, settings=None):
+        ''' Construct a dispatcher object
+
+            Inputs
+              settings: optional dict that overrides the values in
+                DEF_DISPATCHER_SETTINGS, where 'deadLetterFile' is the path to
+                a file that jobs that failed all of their retries are appended
+                to (as JSON lines) -- written to stderr if not given
+        '''
+        self.settings = dict(DEF_DISPATCHER_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        if self.settings['workers'] < 1 or self.settings['maxPerNotifier'] < 1:
+            raise ValueError(f"Invalid dispatcher settings: {self.settings}")
+        self.jobs = None
+        self.workers = []
+        self.pid = None
+        self.lock = threading.Lock()
+        # N.B. a job whose notifier is already being run as many times as
+        #      allowed is parked (instead of tying up a worker waiting for
+        #      it), and is run next by a worker that finishes that notifier
+        self.running = {}
+        self.parked = {}
+        self.timers = set()
+        self.stats = {
+            'submitted': 0,
+            'succeeded': 0,
+            'retried': 0,
+            'failed': 0,
+            'dropped': 0
+        }
+
+    def _start(self):
+        # N.B. threads don't survive a fork, so restart them in a new process
+        with self.lock:
+            if self.workers and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.jobs = queue.Queue(self.settings['queueSize'])
+            self.running = {}
+            self.parked = {}
+            self.timers = set()
+            self.workers = [threading.Thread(target=self._worker, name=f"notifier{i}",
+                                             daemon=True)
+                            for i in range(self.settings['workers'])]
+            for worker in self.workers:
+                worker.start()
+
+    def _claim(self, job):
+        ''' Take a slot for running a job's notifier and return True, or park
+            the job (if there are no free slots) and return False.
+        '''
+        notifier = job['notifier']
+        with self.lock:
+            if self.running.get(notifier, 0) >= self.settings['maxPerNotifier']:
+                self.parked.setdefault(notifier, collections.deque()).append(job)
+                return False
+            self.running[notifier] = self.running.get(notifier, 0) + 1
+            return True
+
+    def _release(self, notifier):
+        ''' Give up a slot for running a notifier, unless it has parked jobs,
+            in which case return the next one of them (which keeps the slot).
+        '''
+        with self.lock:
+            parked = self.parked.get(notifier)
+            if parked:
+                return parked.popleft()
+            self.running[notifier] -= 1
+            return None
+
+    def _put(self, job):
+        ''' Queue up a job, raising queue.Full if the number of jobs that are
+            waiting (queued or parked) is at the limit.
+        '''
+        with self.lock:
+            numParked = sum(len(jobs) for jobs in self.parked.values())
+        if self.jobs.qsize() + numParked >= self.settings['queueSize']:
+            raise queue.Full
+        self.jobs.put_nowait(job)
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def submit(self, notifier, eventType, arg):
+        ''' Queue up a run of a notifier program, and return without waiting
+            for it.
+
+            Inputs
+              notifier: path to the notifier program
+              eventType: type of the event that is being notified
+              arg: argument passed to the notifier program
+
+            Returns
+              True if the job was queued, False if the queue was full (in
+              which case the job goes to the dead-letter log)
+        '''
+        self._start()
+        job = {'notifier': notifier, 'eventType': eventType, 'arg': str(arg),
+               'attempts': 0, 'time': time.time()}
+        self._count('submitted')
+        try:
+            self._put(job)
+        except queue.Full:
+            self._count('dropped')
+            self._deadLetter(job, "queue full")
+            return False
+        return True
+
+    def _retry(self, job):
+        # N.B. this runs in the job's Timer thread
+        with self.lock:
+            self.timers.discard(threading.current_thread())
+        try:
+            self._put(job)
+        except queue.Full:
+            self._count('dropped')
+            self._deadLetter(job, "queue full")
+
+    def _run(self, job):
+        ''' Run a job's notifier program once, and return None if it succeeded,
+            or a description of the error if it failed.
+        '''
+        try:
+            proc = subprocess.run([job['notifier'], job['arg']],
+                                  stdin=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE,
+                                  timeout=self.settings['timeout'])
+        except subprocess.TimeoutExpired:
+            return f"timed out after {self.settings['timeout']} secs"
+        except Exception as e:
+            # N.B. e.g., OSError if the program can't be run, or ValueError if
+            #      the arg has a NUL byte -- the job must still be finished
+            return str(e) or type(e).__name__
+        if proc.returncode:
+            stderr = proc.stderr.decode(errors="replace").strip()
+            return f"exit status {proc.returncode}: {stderr[-200:]}"
+        return None
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is _STOP_WORKER:
+                break
+            if not self._claim(job):
+                continue
+            while job:
+                self._finish(job, self._run(job))
+                job = self._release(job['notifier'])
+
+    def _finish(self, job, error):
+        ''' Count a job that was run, and retry it (after a delay) or record
+            it as failed if it didn't succeed.
+        '''
+        job['attempts'] += 1
+        if error is None:
+            self._count('succeeded')
+        elif job['attempts'] <= self.settings['retries']:
+            self._count('retried')
+            delay = self.settings['backoff'] * (2 ** (job['attempts'] - 1))
+            timer = threading.Timer(delay, self._retry, (job,))
+            timer.daemon = True
+            with self.lock:
+                self.timers.add(timer)
+            timer.start()
+        else:
+            self._count('failed')
+            self._deadLetter(job, error)
+
+    def _deadLetter(self, job, error):
+        ''' Record a job that could not be run.
+        '''
+        entry = dict(job, error=error, failedAt=time.time())
+        line = json.dumps(entry, sort_keys=True)
+        path = self.settings['deadLetterFile']
+        with self.lock:
+            if path:
+                try:
+                    with open(path, "a") as f:
+                        f.write(line + "\n")
+                    return
+                except OSError as e:
+                    sys.stderr.write(f"WARNING: failed to write dead-letter file '{path}': {e}\n")
+            sys.stderr.write(f"WARNING: notification failed: {line}\n")
+
+    def getStats(self):
+        ''' Return a dict with the counts of the jobs that were submitted,
+            succeeded, retried, failed, and dropped, and the number waiting.
+        '''
+        with self.lock:
+            stats = dict(self.stats)
+            numParked = sum(len(jobs) for jobs in self.parked.values())
+        stats['queued'] = (self.jobs.qsize() if self.jobs else 0) + numParked
+        return stats
+
+    def close(self, wait=True):
+        ''' Stop the worker threads, after running the jobs that are already
+            queued or parked (but not those waiting to be retried) if 'wait'
+            is True.
+
+            N.B. the dispatcher restarts if it's used again after this
+        '''
+        with self.lock:
+            if not self.workers or self.pid != os.getpid():
+                return
+            workers, self.workers = self.workers, []
+            for timer in self.timers:
+                timer.cancel()
+            self.timers = set()
+            if not wait:
+                self.parked = {}
+        if not wait:
+            while True:
+                try:
+                    self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+        for _ in workers:
+            self.jobs.put(_STOP_WORKER)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        deadLetters = os.path.join(tmpDir, "deadLetters.jsonl")
+        d = Dispatcher({'timeout': 1, 'retries': 1, 'backoff': 0.1,
+                        'deadLetterFile': deadLetters})
+        start = time.time()
+        d.submit("/bin/echo", "ENTER_REGION", "it's a; test")
+        d.submit("/bin/sleep", "EXIT_REGION", "5")
+        d.submit("/bin/false", "STOPPED_MOVING", "xxx")
+        d.submit("/bin/echo", "ENTER_REGION", "bad\0arg")
+        d.submit("/bin/echo", "ENTER_REGION", "after the bad arg")
+        print(f"Submitted in {time.time() - start:.3f} secs")
+        time.sleep(2.5)
+        d.close()
+        print(f"Stats: {d.getStats()}")
+        with open(deadLetters) as f:
+            failed = [json.loads(line) for line in f]
+        print(f"Dead letters: {[(j['notifier'], j['error']) for j in failed]}")
+        if len(failed) != 3 or d.getStats()['succeeded'] != 2:
+            print("FAILED")
+            sys.exit(1)
+
+    # N.B. the jobs of a slow notifier are parked, so they don't keep the
+    #      other notifiers' jobs from running
+    d = Dispatcher({'workers': 2})
+    for i in range(4):
+        d.submit("/bin/sleep", "EXIT_REGION", "0.5")
+    d.submit("/bin/echo", "ENTER_REGION", "fast")
+    time.sleep(0.3)
+    fastStats = d.getStats()
+    d.close()
+    slowStats = d.getStats()
+    print(f"Stats after 0.3 secs: {fastStats}, when closed: {slowStats}")
+    if fastStats['succeeded'] != 1 or slowStats['succeeded'] != 5:
+        print("FAILED")
+        sys.exit(1)
+    print("SUCCEEDED")
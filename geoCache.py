@@ -0,0 +1,208 @@
+'''
+################################################################################
+#
+# Reverse Geocoding Cache for TeslaWatch Application
+#
+# Place names are looked up by quantizing a location to a geohash bucket, and
+#  checking an in-memory LRU cache, then an on-disk (Sqlite3) cache, before
+#  falling back to the (remote, rate-limited) geocoder.  So, repeated visits to
+#  the same places (e.g., home and work) never leave the process.
+#
+################################################################################
+'''
+
+import collections
+import sqlite3
+import threading
+import time
+
+
+# number of geohash characters used to quantize locations (7 => ~150m)
+DEF_PRECISION = 7
+
+# max number of entries held in memory
+DEF_MAX_ENTRIES = 4096
+
+GEOHASH_CHARS = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat, lon, precision=DEF_PRECISION):
+    ''' Take a lat/lon pair and return its geohash string of the given length.
+    '''
+    latRange = [-90.0, 90.0]
+    lonRange = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    numBits = 0
+    even = True
+    while len(chars) < precision:
+        rng, val = (lonRange, lon) if even else (latRange, lat)
+        mid = (rng[0] + rng[1]) / 2.0
+        if val >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        numBits += 1
+        if numBits == 5:
+            chars.append(GEOHASH_CHARS[bits])
+            bits = 0
+            numBits = 0
+    return "".join(chars)
+
+
+class GeocodeCache(object):
+    ''' Object that reverse geocodes locations into place names, through a
+        persistent, quantized, LRU cache.
+    '''
+    def __init__(self, geocoder=None, cacheFile=None, precision=DEF_PRECISION,
+                 maxEntries=DEF_MAX_ENTRIES):
+        ''' Construct a geocoding cache object
+
+            Inputs
+              geocoder: optional geopy geocoder object used on cache misses
+                (if None, only cached places are returned)
+              cacheFile: optional path to a Sqlite3 file that persists the
+                cache (created if doesn't exist).  It's opened on first use,
+                so a cache object can be created before forking processes.
+              precision: number of geohash characters to quantize locations to
+              maxEntries: max number of entries held in memory
+        '''
+        self.geocoder = geocoder
+        self.precision = precision
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'diskHits': 0, 'misses': 0}
+
+        self.cacheFile = cacheFile
+        self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def _getDB(self):
+        ''' Return the connection to the cache file, opening it if necessary,
+            or None if there is no cache file.
+        '''
+        if self.db is None and self.cacheFile:
+            self.db = sqlite3.connect(self.cacheFile, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL;")
+            self.db.execute("CREATE TABLE IF NOT EXISTS places (geohash TEXT PRIMARY KEY, "
+                            "address TEXT, latitude REAL, longitude REAL, time INTEGER);")
+            self.db.commit()
+        return self.db
+
+    def _remember(self, key, address):
+        self.entries[key] = address
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def _lookup(self, key):
+        ''' Return a (found, address) tuple for a geohash key from the memory
+            or disk caches.
+        '''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return True, self.entries[key]
+        db = self._getDB()
+        if db:
+            r = db.execute("SELECT address FROM places WHERE geohash = ?;", (key,)).fetchone()
+            if r:
+                self.stats['diskHits'] += 1
+                self._remember(key, r[0])
+                return True, r[0]
+        return False, None
+
+    def _store(self, entries):
+        ''' Save a list of (key, address, lat, lon) tuples in the caches.
+        '''
+        for key, address, _, _ in entries:
+            self._remember(key, address)
+        db = self._getDB()
+        if db and entries:
+            now = int(time.time())
+            with db:
+                db.executemany("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?);",
+                                    [(k, a, lat, lon, now) for k, a, lat, lon in entries])
+
+    def cached(self, lat, lon):
+        ''' Take a lat/lon pair and return a (found, address) tuple for it from
+            the caches, without ever calling the geocoder.
+        '''
+        key = geohash(lat, lon, self.precision)
+        with self.lock:
+            return self._lookup(key)
+
+    def reverse(self, lat, lon):
+        ''' Take a lat/lon pair and return the name of the place (i.e., address
+            string), or None if it isn't known.
+
+            N.B. the geocoder is called without holding the lock, so a slow
+                 lookup doesn't hold up the other users of the cache
+        '''
+        key = geohash(lat, lon, self.precision)
+        with self.lock:
+            found, address = self._lookup(key)
+            if found:
+                return address
+            self.stats['misses'] += 1
+        if self.geocoder is None:
+            return None
+        location = self.geocoder.reverse((lat, lon))
+        address = location.address if location else None
+        with self.lock:
+            self._store([(key, address, lat, lon)])
+        return address
+
+    def preload(self, places):
+        ''' Take an iterable of places and add them to the cache, where each
+            place is either a (lat, lon, address) tuple, or a (lat, lon) tuple
+            that is to be geocoded if it isn't already in the cache.
+
+            Returns
+              Number of places added to the cache
+        '''
+        entries = []
+        misses = []
+        with self.lock:
+            for place in places:
+                lat, lon = place[0], place[1]
+                key = geohash(lat, lon, self.precision)
+                if len(place) > 2:
+                    entries.append((key, place[2], lat, lon))
+                elif not self._lookup(key)[0] and self.geocoder is not None:
+                    misses.append((key, lat, lon))
+        for key, lat, lon in misses:
+            location = self.geocoder.reverse((lat, lon))
+            entries.append((key, location.address if location else None, lat, lon))
+        with self.lock:
+            self._store(entries)
+        return len(entries)
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    if geohash(57.64911, 10.40744, 11) != "u4pruydqqvj":
+        print("FAILED: geohash")
+    cache = GeocodeCache(precision=7)
+    cache.preload([(37.460184, -122.166203, "Home")])
+    print(f"Home: {cache.reverse(37.4602, -122.1662)}")
+    print(f"Elsewhere: {cache.reverse(37.3848558, -121.9947407)}")
+    if cache.cached(37.4602, -122.1662) != (True, "Home") or cache.cached(0.0, 0.0)[0]:
+        print("FAILED: cached")
+    print(f"Stats: {cache.stats}")
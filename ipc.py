@@ -0,0 +1,310 @@
+'''
+################################################################################
+#
+# Master/Tracker Messaging for TeslaWatch Application
+#
+# Typed messages (commands from the master, and status, events, and metrics
+#  from the trackers), sent over one duplex pipe per tracker.  The master's
+#  Hub receives the messages of all of the trackers in a single thread, that
+#  waits on all of their pipes at once (rather than polling a queue per
+#  tracker), and keeps the recent ones for each tracker so they can be
+#  drained without blocking.
+#
+################################################################################
+'''
+
+import collections
+import multiprocessing as mp
+import multiprocessing.connection
+import queue
+import sys
+import threading
+import time
+
+
+# types of commands sent from the master to the trackers
+CMD_TYPES = ("STOP", "PAUSE", "RESUME", "RECONFIGURE")
+
+# types of messages sent from the trackers to the master
+MSG_TYPES = ("TRACKING", "SLEEPING", "RESUMING", "STOPPING", "BAILING",
+             "EVENT", "SCHEMA", "METRICS", "STATE")
+
+# default max number of a tracker's messages kept by the hub
+DEF_MAX_MESSAGES = 1000
+
+
+# N.B. commands have no VIN, and the data of the message depends on its type:
+#  * RECONFIGURE: dict with the tracker's new 'settings' and/or 'regions'
+#  * STOP, PAUSE, RESUME: None
+#  * TRACKING: dict with the car's 'name', 'place', and (optional) 'state'
+#  * SLEEPING, RESUMING, STOPPING: None
+#  * BAILING: string with the error
+#  * EVENT: dict with the 'eventType', its 'arg', and the name of the 'car'
+#  * SCHEMA: dict with the 'table', and the 'added' and 'removed' fields
+#  * METRICS: snapshot of the tracker process' metrics registry
+#  * STATE: dict with the 'table', and its latest 'sample' and its 'time'
+Message = collections.namedtuple('Message', ('type', 'vin', 'time', 'data'))
+
+
+def command(cmdType, data=None):
+    ''' Return a command message of the given type.
+    '''
+    if cmdType not in CMD_TYPES:
+        raise ValueError(f"Unknown command type '{cmdType}'")
+    return Message(cmdType, None, time.time(), data)
+
+
+def message(msgType, vin, data=None):
+    ''' Return a tracker's message of the given type.
+    '''
+    if msgType not in MSG_TYPES:
+        raise ValueError(f"Unknown message type '{msgType}'")
+    return Message(msgType, vin, time.time(), data)
+
+
+def formatMessage(msg):
+    ''' Return a one-line, human-readable, string for a message.
+    '''
+    data = msg.data
+    if msg.type == "TRACKING":
+        text = f"{data['name']} at {data['place']}"
+        if data.get('state'):
+            text += f" ({data['state']})"
+    elif msg.type == "EVENT":
+        text = f"{data['eventType']} {data['arg']}"
+    elif msg.type == "SCHEMA":
+        text = f"table {data['table']}: ADD={data['added']}, REM={data['removed']}"
+    elif msg.type == "STATE":
+        text = f"{data['table']} at {data['time']}"
+    elif msg.type == "METRICS":
+        text = f"{len(data['counters'])} counters, {len(data['histograms'])} histograms"
+    else:
+        text = "" if data is None else str(data)
+    prefix = f"{msg.type} {msg.vin}" if msg.vin else msg.type
+    return f"{prefix}: {text}" if text else prefix
+
+
+class Channel(object):
+    ''' Object with the methods of a Queue that sends and receives messages on
+        one end of a pipe.
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def put(self, msg):
+        with self.lock:
+            self.conn.send(msg)
+
+    def get(self, block=True, timeout=None):
+        ''' Return the next message, waiting (up to the given number of secs,
+            or forever, if None) for one if block is True.
+
+            N.B. raises queue.Empty if no message arrived (like a Queue)
+        '''
+        if not self.conn.poll(timeout if block else 0):
+            raise queue.Empty
+        return self.conn.recv()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self):
+        return not self.conn.poll(0)
+
+    def close(self):
+        self.conn.close()
+
+
+class Hub(object):
+    ''' Object in the master that sends commands to the trackers, and receives
+        all of their messages in a (daemon) thread.
+
+        N.B. STATE messages are only passed to the handler (e.g., of a
+             stateStore.StateStore), not kept with the other messages
+    '''
+    def __init__(self, maxMessages=DEF_MAX_MESSAGES, handler=None):
+        ''' Construct a hub object
+
+            Inputs
+              maxMessages: max number of each tracker's messages that are kept
+                (the oldest are dropped)
+              handler: optional function that is called (in the hub's thread)
+                with each message received
+        '''
+        self.maxMessages = maxMessages
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.messages = {}
+        self.metrics = {}
+        # N.B. the hub's thread is woken up (by a message on this pipe) when
+        #      channels are added or removed
+        self.wakeReader, self.wakeWriter = mp.Pipe(False)
+        self.thread = None
+        self.closing = False
+
+    def add(self, vin):
+        ''' Create the channel for the tracker of the given car, and return the
+            tracker's end of it.
+        '''
+        masterEnd, trackerEnd = mp.Pipe()
+        with self.lock:
+            self.channels[vin] = Channel(masterEnd)
+            self.messages.setdefault(vin, collections.deque(maxlen=self.maxMessages))
+        self._wake()
+        return Channel(trackerEnd)
+
+    def remove(self, vin):
+        ''' Close the channel for the tracker of the given car (keeping the
+            messages received from it).
+        '''
+        with self.lock:
+            channel = self.channels.pop(vin, None)
+            self.metrics.pop(vin, None)
+        self._wake()
+        if channel:
+            channel.close()
+
+    def send(self, vin, cmdType, data=None):
+        ''' Send a command to the tracker of the given car, and return True if
+            it was sent.
+        '''
+        channel = self.channels.get(vin)
+        if not channel:
+            return False
+        try:
+            channel.put(command(cmdType, data))
+        except OSError as e:
+            sys.stderr.write(f"WARNING: failed to send '{cmdType}' to '{vin}': {e}\n")
+            return False
+        return True
+
+    def drain(self, vin):
+        ''' Return (and forget) the messages received from the tracker of the
+            given car, without waiting for any.
+        '''
+        with self.lock:
+            msgs = self.messages.get(vin)
+            if not msgs:
+                return []
+            result = list(msgs)
+            msgs.clear()
+        return result
+
+    def metricsSnapshots(self):
+        ''' Return the latest metrics snapshot of each of the trackers.
+        '''
+        with self.lock:
+            return list(self.metrics.values())
+
+    def start(self):
+        ''' Start the hub's thread, if it isn't running.
+
+            N.B. should be called after the tracker processes are started
+        '''
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="hub", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        ''' Stop the hub's thread, once it has received all of the messages
+            waiting on the channels, and close the channels (keeping the
+            messages received from them).
+        '''
+        if self.thread:
+            self.closing = True
+            self._wake()
+            self.thread.join()
+            self.thread = None
+            self.closing = False
+        with self.lock:
+            channels = list(self.channels.values())
+            self.channels = {}
+        for channel in channels:
+            channel.close()
+
+    def _wake(self):
+        if self.thread:
+            self.wakeWriter.send(None)
+
+    def _receive(self, vin, conn):
+        ''' Take all of the messages that are waiting on a tracker's channel,
+            and return False if the channel was closed.
+        '''
+        try:
+            while conn.poll(0):
+                msg = conn.recv()
+                with self.lock:
+                    if msg.type == "METRICS":
+                        self.metrics[vin] = msg.data
+                    elif msg.type != "STATE":
+                        self.messages[vin].append(msg)
+                if self.handler:
+                    self.handler(msg)
+        except (EOFError, OSError):
+            return False
+        return True
+
+    def _run(self):
+        closed = set()
+        while True:
+            with self.lock:
+                conns = {c.conn: vin for vin, c in self.channels.items()}
+            closed &= set(conns)
+            conns = {conn: vin for conn, vin in conns.items() if conn not in closed}
+            ready = mp.connection.wait([self.wakeReader] + list(conns))
+            for conn in ready:
+                if conn is self.wakeReader:
+                    self.wakeReader.recv()
+                elif not self._receive(conns[conn], conn):
+                    closed.add(conn)
+            if self.closing:
+                for conn, vin in conns.items():
+                    self._receive(vin, conn)
+                return
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    def tracker(channel, vin, num):
+        channel.put(message("TRACKING", vin, {'name': vin, 'place': "home"}))
+        while channel.get().type != "STOP":
+            pass
+        for i in range(num):
+            channel.put(message("EVENT", vin, {'eventType': "ENTER_REGION", 'arg': str(i),
+                                                'car': vin}))
+        channel.put(message("STOPPING", vin))
+
+    received = []
+    hub = Hub(handler=received.append)
+    num = 5000
+    procs = []
+    for vin in ("V1", "V2", "V3"):
+        channel = hub.add(vin)
+        procs.append(mp.Process(target=tracker, args=(channel, vin, num)))
+        procs[-1].start()
+        channel.close()
+    hub.start()
+
+    start = time.time()
+    for vin in ("V1", "V2", "V3"):
+        hub.send(vin, "PAUSE")
+        hub.send(vin, "STOP")
+    for p in procs:
+        p.join()
+    hub.close()
+    elapsed = time.time() - start
+    msgs = hub.drain("V2")
+    print(formatMessage(msgs[0]))
+    print(formatMessage(msgs[-1]))
+    print(f"{len(received)} messages in {elapsed:.2f} secs")
+
+    if (len(received) != 3 * (num + 2) or len(msgs) != DEF_MAX_MESSAGES or
+            hub.drain("V2") or msgs[-1].type != "STOPPING"):
+        print("FAILED")
+        sys.exit(1)
+    print("SUCCEEDED")
@@ -0,0 +1,340 @@
+'''
+################################################################################
+#
+# Metrics for TeslaWatch Application
+#
+# Low-overhead counters and latency histograms for the hot paths of the
+#  trackers (i.e., API requests, DB writes, region checks, notifications, and
+#  the lag of the polling loop), kept in a per-process registry.  Tracker
+#  processes periodically send snapshots of their registry to the master (as
+#  METRICS messages), which merges them with its own, and serves them on a
+#  local HTTP endpoint in the Prometheus text format.
+#
+################################################################################
+'''
+
+import bisect
+import contextlib
+import http.server
+import math
+import threading
+import time
+
+from ipc import message
+
+
+# default settings for the metrics
+#  * host: address the HTTP endpoint listens on
+#  * port: port the HTTP endpoint listens on (no endpoint, if None)
+#  * publishInterval: number of secs between the snapshots published by the
+#    tracker processes
+DEF_METRICS_SETTINGS = {
+    'host': "127.0.0.1",
+    'port': None,
+    'publishInterval': 5
+}
+
+# default upper bounds (in secs) of the buckets of the latency histograms
+DEF_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# the metrics that are recorded, as (type, help) tuples keyed by their names
+METRICS = {
+    'teslawatch_api_requests_total':
+        ("counter", "Tesla API requests made, by outcome (ok, or the class of error)"),
+    'teslawatch_api_request_seconds':
+        ("histogram", "Time taken by each attempt of a Tesla API request"),
+    'teslawatch_api_retries_total':
+        ("counter", "Retries of failed Tesla API requests, by class of error"),
+    'teslawatch_samples_total':
+        ("counter", "Samples of the cars' tables processed by the trackers"),
+    'teslawatch_db_rows_total':
+        ("counter", "Rows handed to the car DBs"),
+    'teslawatch_db_insert_seconds':
+        ("histogram", "Time taken to hand a row to a car DB"),
+    'teslawatch_db_commit_seconds':
+        ("histogram", "Time taken by each commit of a batch of rows to a car DB"),
+    'teslawatch_db_dropped_rows_total':
+        ("counter", "Rows that couldn't be written to a car DB"),
+    'teslawatch_region_check_seconds':
+        ("histogram", "Time taken to check a car's location against its regions"),
+    'teslawatch_notifications_total':
+        ("counter", "Events notified, by type of event"),
+    'teslawatch_notify_seconds':
+        ("histogram", "Time taken to hand an event to the notifiers"),
+    'teslawatch_loop_lag_seconds':
+        ("histogram", "Time by which the trackers' polling loops wake up late")
+}
+
+
+def _labels(labels):
+    # N.B. label sets are keyed by a sorted tuple, so the order they're given
+    #      in doesn't matter
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class Registry(object):
+    ''' Object that holds the counters and histograms of a process.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def reset(self):
+        ''' Clear all of the metrics.
+
+            N.B. the lock is replaced too, as it might have been held by another
+                 thread when the process was forked
+        '''
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=None, value=1):
+        ''' Add the given value to a counter.
+        '''
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None, buckets=DEF_BUCKETS):
+        ''' Add a value (e.g., a latency, in secs) to a histogram.
+        '''
+        key = (name, _labels(labels))
+        i = bisect.bisect_left(buckets, value)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = {'buckets': buckets,
+                                            'counts': [0] * (len(buckets) + 1),
+                                            'sum': 0.0}
+            h['counts'][i] += 1
+            h['sum'] += value
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        ''' Context manager that adds the time taken by its body to a histogram
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def snapshot(self):
+        ''' Return a (picklable) copy of the registry's metrics.
+        '''
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {k: {'buckets': h['buckets'], 'counts': list(h['counts']),
+                                       'sum': h['sum']}
+                                   for k, h in self.histograms.items()}}
+
+
+# the registry of the current process
+REGISTRY = Registry()
+
+
+def inc(name, labels=None, value=1):
+    REGISTRY.inc(name, labels, value)
+
+
+def observe(name, value, labels=None):
+    REGISTRY.observe(name, value, labels)
+
+
+def timer(name, labels=None):
+    return REGISTRY.timer(name, labels)
+
+
+def merge(snapshots):
+    ''' Take a list of snapshots (e.g., of different processes) and return a
+        single snapshot with their sums.
+    '''
+    merged = {'counters': {}, 'histograms': {}}
+    for snap in snapshots:
+        for key, value in snap['counters'].items():
+            merged['counters'][key] = merged['counters'].get(key, 0) + value
+        for key, h in snap['histograms'].items():
+            m = merged['histograms'].get(key)
+            if m is None:
+                merged['histograms'][key] = {'buckets': h['buckets'],
+                                             'counts': list(h['counts']), 'sum': h['sum']}
+            elif m['buckets'] == h['buckets']:
+                m['counts'] = [a + b for a, b in zip(m['counts'], h['counts'])]
+                m['sum'] += h['sum']
+    return merged
+
+
+def _formatLabels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    vals = ",".join('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                    for k, v in pairs)
+    return "{" + vals + "}"
+
+
+def _formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshot):
+    ''' Return the metrics in a snapshot in the Prometheus text format.
+    '''
+    byName = {}
+    for (name, labels), value in snapshot['counters'].items():
+        byName.setdefault(name, []).append((labels, value))
+    for (name, labels), h in snapshot['histograms'].items():
+        byName.setdefault(name, []).append((labels, h))
+
+    lines = []
+    for name in sorted(byName):
+        metricType, helpText = METRICS.get(name, ("untyped", ""))
+        lines.append(f"# HELP {name} {helpText}")
+        lines.append(f"# TYPE {name} {metricType}")
+        for labels, value in sorted(byName[name], key=lambda x: x[0]):
+            if not isinstance(value, dict):
+                lines.append(f"{name}{_formatLabels(labels)} {_formatValue(value)}")
+                continue
+            total = 0
+            for bound, count in zip(list(value['buckets']) + [math.inf], value['counts']):
+                total += count
+                lines.append(f"{name}_bucket{_formatLabels(labels, ('le', _formatValue(bound)))} {total}")
+            lines.append(f"{name}_sum{_formatLabels(labels)} {_formatValue(value['sum'])}")
+            lines.append(f"{name}_count{_formatLabels(labels)} {total}")
+    return "\n".join(lines) + "\n"
+
+
+class Publisher(object):
+    ''' Object that periodically sends the snapshot of a tracker process'
+        registry to the master.
+    '''
+    def __init__(self, channel, vin, interval=DEF_METRICS_SETTINGS['publishInterval']):
+        ''' Construct a publisher object
+
+            Inputs
+              channel: the tracker's ipc.Channel to the master
+              vin: VIN of the tracker's car
+              interval: number of secs between snapshots
+        '''
+        self.channel = channel
+        self.vin = vin
+        self.interval = interval
+        self.nextTime = 0
+
+    def start(self):
+        ''' Start publishing from a (newly forked) tracker process.
+
+            N.B. a forked process starts with a copy of its parent's registry
+        '''
+        REGISTRY.reset()
+        self.nextTime = 0
+
+    def publish(self, now=None, force=False):
+        ''' Publish the registry's snapshot, if it's time to (or if forced).
+        '''
+        now = time.time() if now is None else now
+        if not force and now < self.nextTime:
+            return
+        self.nextTime = now + self.interval
+        self.channel.put(message("METRICS", self.vin, REGISTRY.snapshot()))
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        data = render(self.server.collect()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    ''' HTTP server for the metrics of the master and of all of the tracker
+        processes, that runs in a (daemon) thread of the master.
+    '''
+    daemon_threads = True
+
+    def __init__(self, snapshots=None, host=DEF_METRICS_SETTINGS['host'], port=0):
+        ''' Construct (and start) a metrics server
+
+            Inputs
+              snapshots: optional function that returns a list of the latest
+                snapshots of the tracker processes (e.g., Hub.metricsSnapshots)
+              host: address to listen on
+              port: port to listen on
+        '''
+        super().__init__((host, port), _MetricsHandler)
+        self.snapshots = snapshots
+        self.thread = threading.Thread(target=self.serve_forever, name="metrics",
+                                       daemon=True)
+        self.thread.start()
+
+    def collect(self):
+        ''' Return the merged snapshot of all of the processes.
+        '''
+        snapshots = [REGISTRY.snapshot()]
+        if self.snapshots:
+            snapshots += self.snapshots()
+        return merge(snapshots)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    import multiprocessing as mp
+    import sys
+    import urllib.request
+
+    from ipc import Hub
+
+    def child(channel, vin):
+        publisher = Publisher(channel, vin)
+        publisher.start()
+        for i in range(100):
+            inc('teslawatch_api_requests_total', {'vin': "V1", 'result': "ok"})
+            observe('teslawatch_api_request_seconds', i / 1000.0, {'vin': "V1"})
+        publisher.publish(force=True)
+
+    inc('teslawatch_api_requests_total', {'result': "ok", 'vin': "V1"}, 5)
+    hub = Hub()
+    procs = [mp.Process(target=child, args=(hub.add(vin), vin)) for vin in ("C1", "C2")]
+    for p in procs:
+        p.start()
+    hub.start()
+    for p in procs:
+        p.join()
+    time.sleep(0.1)
+    server = MetricsServer(hub.metricsSnapshots)
+    url = f"http://{server.server_address[0]}:{server.server_address[1]}/metrics"
+    text = urllib.request.urlopen(url).read().decode()
+    server.close()
+    print(text)
+
+    n = 100000
+    start = time.perf_counter()
+    for _ in range(n):
+        observe('teslawatch_db_insert_seconds', 0.0003, {'vin': "V1"})
+    print(f"observe(): {(time.perf_counter() - start) / n * 1e6:.2f} usec")
+
+    if ('teslawatch_api_requests_total{result="ok",vin="V1"} 205' not in text or
+            'teslawatch_api_request_seconds_count{vin="V1"} 200' not in text):
+        print("FAILED")
+        sys.exit(1)
+    print("SUCCEEDED")
@@ -0,0 +1,724 @@
+#!/usr/bin/env python3
+'''
+################################################################################
+#
+# Mock Tesla API for TeslaWatch Application
+#
+# Local stand-in for the Tesla API that replays recorded (or synthetic)
+#  traces of the cars' tables for any number of virtual cars, with a given
+#  latency, rate of failed requests, and sleep behavior -- i.e., a parked car
+#  falls asleep once it hasn't had any data requests for a while, doesn't
+#  answer data requests while asleep, and takes a while to wake up.
+#
+# It can be used in-process (MockConnection), or over HTTP (MockServer and
+#  HttpConnection), and both have the interface of the teslajson Connection
+#  and Vehicle objects that the Car objects use.
+#
+# Traces are dicts whose keys are table names and whose values are lists of
+#  samples (as they come from the Tesla API), in time order.  They are
+#  replayed (in a loop) at 'speed' times real time, with their timestamps
+#  moved to the replay's (virtual) time.  Tables without a trace return a
+#  fixed sample.
+#
+################################################################################
+'''
+
+import argparse
+import bisect
+import copy
+import http.server
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from teslaCar import TABLES_NAME_MAP
+from tracker import MotionStateMachine
+
+
+# default settings for the mock API
+#  * speed: number of secs of the traces replayed per (real) sec
+#  * latency: mean number of (real) secs each request takes
+#  * jitter: fraction of the latency by which each request's time varies
+#  * errorRate: fraction of the requests that fail
+#  * errors: relative frequency of each kind of failure (see ERROR_KINDS)
+#  * sleepAfter: number of secs (of trace time) without data requests after
+#    which a parked car falls asleep (never, if None)
+#  * wakeTime: number of secs (of trace time) a car takes to wake up
+#  * startAsleep: if True, the cars are asleep when the replay starts
+DEF_MOCK_SETTINGS = {
+    'speed': 1.0,
+    'latency': 0.05,
+    'jitter': 0.5,
+    'errorRate': 0.0,
+    'errors': {
+        'server': 0.5,
+        'throttled': 0.3,
+        'network': 0.2
+    },
+    'sleepAfter': 10 * 60,
+    'wakeTime': 15,
+    'startAsleep': False
+}
+
+# kinds of failed requests, and the HTTP status they're returned with (where
+#  None means the connection is dropped without a response)
+ERROR_KINDS = {
+    'server': 503,
+    'throttled': 429,
+    'network': None
+}
+
+# samples returned for the tables that aren't in a car's trace
+STATIC_SAMPLES = {
+    'guiSettings': {
+        'gui_24_hour_time': False,
+        'gui_charge_rate_units': "mi/hr",
+        'gui_distance_units': "mi/hr",
+        'gui_range_display': "Rated",
+        'gui_temperature_units': "F",
+        'show_range_units': True
+    },
+    'chargeState': {
+        'battery_level': 80,
+        'battery_range': 240.0,
+        'charge_limit_soc': 90,
+        'charge_port_door_open': False,
+        'charging_state': "Disconnected"
+    },
+    'climateSettings': {
+        'inside_temp': 21.0,
+        'outside_temp': 18.0,
+        'is_climate_on': False,
+        'driver_temp_setting': 21.0,
+        'passenger_temp_setting': 21.0
+    },
+    'vehicleState': {
+        'api_version': 7,
+        'car_version': "2019.40.50.7",
+        'locked': True,
+        'odometer': 12345.6,
+        'sentry_mode': False,
+        'vehicle_name': "Mock"
+    },
+    'driveState': {
+        'heading': 0,
+        'latitude': 37.460184,
+        'longitude': -122.166203,
+        'power': 0,
+        'shift_state': None,
+        'speed': None
+    }
+}
+
+# prefix of the (real) API's paths
+API_PATH = "/api/1/"
+
+# prefix of the paths that control the mock
+MOCK_PATH = "/mock/"
+
+# miles in a degree of latitude
+MILES_PER_DEGREE = 69.0
+
+
+class MockHTTPError(Exception):
+    ''' Exception raised by a request that got an HTTP error status.
+    '''
+    def __init__(self, code, message=""):
+        super().__init__(f"HTTP Error {code}: {message}")
+        self.code = code
+
+
+def syntheticTrace(duration=2 * 60 * 60, step=1, parkTime=30 * 60, driveTime=10 * 60,
+                   latitude=37.460184, longitude=-122.166203, seed=None):
+    ''' Generate a trace of the driveState and chargeState tables of a car
+        that is parked and driven in turn, and stops for a bit (e.g., at a
+        light) every couple of minutes while driving.
+
+        Inputs
+          duration: number of secs in the trace
+          step: number of secs between driveState samples (the chargeState
+            samples are a tenth as frequent)
+          parkTime: number of secs the car is parked for at a time
+          driveTime: number of secs the car is driven for at a time
+          latitude: latitude at which the car starts
+          longitude: longitude at which the car starts
+          seed: optional seed of the random numbers
+
+        Returns
+          Dict with the trace
+    '''
+    rand = random.Random(seed)
+    drive = []
+    charge = []
+    lat, lon = latitude, longitude
+    heading = rand.randrange(360)
+    battery = 80.0
+    speed = 0.0
+    for i in range(0, int(duration / step)):
+        t = i * step
+        cycle = t % (parkTime + driveTime)
+        if cycle < parkTime:
+            shiftState, speed, power = None, None, 0
+            battery = min(90.0, battery + step * 0.002)
+        elif (cycle - parkTime) % 120 >= 100:
+            shiftState, speed, power = "D", 0, 0
+        else:
+            shiftState = "D"
+            speed = max(5, min(70, (speed or 25) + rand.uniform(-3, 3)))
+            power = int(speed * 0.4)
+            heading = (heading + rand.uniform(-5, 5)) % 360
+            miles = speed * step / 3600.0
+            lat += miles * math.cos(math.radians(heading)) / MILES_PER_DEGREE
+            lon += (miles * math.sin(math.radians(heading)) /
+                    (MILES_PER_DEGREE * math.cos(math.radians(lat))))
+            battery = max(5.0, battery - miles * 0.3)
+        drive.append({'timestamp': t * 1000, 'gps_as_of': t, 'heading': int(heading),
+                      'latitude': round(lat, 6), 'longitude': round(lon, 6),
+                      'power': power, 'shift_state': shiftState,
+                      'speed': None if speed is None else int(speed)})
+        if i % 10 == 0:
+            charge.append({'timestamp': t * 1000, 'battery_level': int(battery),
+                           'battery_range': round(battery * 3.0, 2),
+                           'usable_battery_level': int(battery),
+                           'charge_limit_soc': 90,
+                           'charging_state': "Charging" if shiftState is None and battery < 90 else "Disconnected"})
+    return {'driveState': drive, 'chargeState': charge}
+
+
+def loadTrace(path, schema=None):
+    ''' Load a trace from a JSON file (with the same format as the traces),
+        or from the tables of a car's DB file.
+
+        Inputs
+          path: path to a JSON file, or to a DB file (ending in '.db')
+          schema: dict with the DB's schema (needed for DB files)
+
+        Returns
+          Dict with the trace
+    '''
+    if not path.endswith(".db"):
+        with open(path, "r") as f:
+            return json.load(f)
+
+    from teslaDB import CarDB, OVERFLOW_COL, VALID_UNTIL_COL
+    if not schema:
+        raise ValueError("Must give the schema of the DB")
+    trace = {}
+    with CarDB("trace", path, schema, create=False, settings={'writerThread': False}) as cdb:
+        for tableName, layout in cdb.layouts.items():
+            samples = []
+            for row in cdb.query(tableName, columns=layout.columns, namedTuples=True):
+                sample = layout.unflatten(row)
+                del sample[VALID_UNTIL_COL]
+                del sample[OVERFLOW_COL]
+                samples.append(sample)
+            if samples:
+                trace[tableName] = samples
+    return trace
+
+
+class VirtualCar(object):
+    ''' Object that replays the trace of a car, and models whether it's awake.
+    '''
+    def __init__(self, vin, vehicleId, trace, settings=None, phase=0):
+        ''' Construct a virtual car object
+
+            Inputs
+              vin: VIN string for the car
+              vehicleId: (integer) id of the car in the API
+              trace: dict with the trace that is replayed
+              settings: optional dict that overrides the values in
+                DEF_MOCK_SETTINGS
+              phase: number of secs into the trace that the replay starts at
+        '''
+        self.vin = vin
+        self.vehicleId = vehicleId
+        self.settings = dict(DEF_MOCK_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        self.phase = phase
+        self.lock = threading.Lock()
+
+        # N.B. the samples are looked up by their offset from the trace's start
+        self.tables = {}
+        start = min((samples[0].get('timestamp') or 0)
+                    for samples in trace.values() if samples) if trace else 0
+        self.length = 1.0
+        for tableName, samples in trace.items():
+            if not samples:
+                continue
+            offsets = [((s.get('timestamp') or start) - start) / 1000.0 for s in samples]
+            self.tables[tableName] = (offsets, samples)
+            self.length = max(self.length, offsets[-1] + 1)
+        self.transitions = self._findTransitions()
+        self.reset(time.time())
+
+    def _findTransitions(self):
+        ''' Return a list of (offset, eventType) tuples of the times in the
+            trace at which the car starts or stops moving.
+        '''
+        if 'driveState' not in self.tables:
+            return []
+        motion = MotionStateMachine()
+        transitions = []
+        prev = None
+        for offset, sample in zip(*self.tables['driveState']):
+            state = motion.classify(sample)
+            if prev is not None and (state == "MOVING") != (prev == "MOVING"):
+                transitions.append((offset, "STARTED_MOVING" if state == "MOVING" else "STOPPED_MOVING"))
+            prev = state
+        return transitions
+
+    def reset(self, now):
+        ''' Restart the replay at the given (real) time.
+        '''
+        with self.lock:
+            self.start = now
+            self.state = "asleep" if self.settings['startAsleep'] else "online"
+            self.lastActive = 0.0
+            self.wakeAt = None
+            self.sleeps = 0
+
+    def traceTime(self, now):
+        ''' Return the number of secs into the replay at the given (real) time
+        '''
+        return (now - self.start) * self.settings['speed']
+
+    def _lookup(self, tableName, t):
+        if tableName not in self.tables:
+            sample = dict(STATIC_SAMPLES.get(tableName, {}))
+        else:
+            offsets, samples = self.tables[tableName]
+            i = bisect.bisect_right(offsets, (t + self.phase) % self.length) - 1
+            sample = copy.deepcopy(samples[max(0, i)])
+        # N.B. the replay's virtual time runs from the start of the replay
+        virtualTime = self.start + t
+        sample['timestamp'] = int(virtualTime * 1000)
+        if tableName == 'driveState':
+            sample['gps_as_of'] = int(virtualTime)
+        return sample
+
+    def isMoving(self, t):
+        ''' Return True if the car is in gear at the given trace time.
+        '''
+        return self._lookup('driveState', t).get('shift_state') is not None
+
+    def _update(self, t):
+        # N.B. a car that's driven wakes up by itself
+        if self.state == "online":
+            sleepAfter = self.settings['sleepAfter']
+            if sleepAfter is not None and t - self.lastActive >= sleepAfter and not self.isMoving(t):
+                self.state = "asleep"
+                self.sleeps += 1
+        elif self.isMoving(t) or (self.wakeAt is not None and t >= self.wakeAt):
+            self.state = "online"
+            self.lastActive = t
+            self.wakeAt = None
+
+    def info(self, now):
+        ''' Return the car's entry in the account's list of vehicles.
+        '''
+        with self.lock:
+            self._update(self.traceTime(now))
+            state = self.state
+        return {'id': self.vehicleId, 'vehicle_id': self.vehicleId, 'vin': self.vin,
+                'display_name': f"Mock {self.vin[-4:]}", 'state': state,
+                'in_service': False}
+
+    def getTable(self, tableName, now):
+        ''' Return the sample of a table at the given (real) time, or None if
+            the car is asleep.
+        '''
+        t = self.traceTime(now)
+        with self.lock:
+            self._update(t)
+            if self.state != "online":
+                return None
+            self.lastActive = t
+        return self._lookup(tableName, t)
+
+    def wakeUp(self, now):
+        ''' Start waking up the car, and return its entry in the vehicle list.
+        '''
+        t = self.traceTime(now)
+        with self.lock:
+            self._update(t)
+            if self.state != "online" and self.wakeAt is None:
+                self.wakeAt = t + self.settings['wakeTime']
+        return self.info(now)
+
+    def getTransitions(self, now):
+        ''' Return a list of (time, eventType) tuples of the (real) times at
+            which the car started or stopped moving, since the replay started.
+        '''
+        t = self.traceTime(now)
+        speed = self.settings['speed']
+        transitions = []
+        loop = 0
+        while loop * self.length - self.phase <= t and self.transitions:
+            for offset, eventType in self.transitions:
+                tt = loop * self.length + offset - self.phase
+                if 0 < tt <= t:
+                    transitions.append((self.start + tt / speed, eventType))
+            loop += 1
+        return transitions
+
+
+class MockApi(object):
+    ''' Object that answers the requests of the Tesla API for a set of virtual
+        cars, with the latency and failures given in its settings.
+    '''
+    def __init__(self, cars, settings=None, seed=None):
+        ''' Construct a mock API object
+
+            Inputs
+              cars: list of VirtualCar objects
+              settings: optional dict that overrides the values in
+                DEF_MOCK_SETTINGS (only those about requests are used here)
+              seed: optional seed of the random numbers
+        '''
+        self.cars = {car.vehicleId: car for car in cars}
+        self.settings = dict(DEF_MOCK_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.apiNames = {v: k for k, v in TABLES_NAME_MAP.items()}
+        self.resetStats()
+
+    def resetStats(self):
+        with self.lock:
+            self.stats = {
+                'requests': 0,
+                'samples': 0,
+                'asleep': 0,
+                'wakeUps': 0,
+                'errors': {kind: 0 for kind in ERROR_KINDS}
+            }
+
+    def reset(self, now=None):
+        ''' Restart the replay of all of the cars, and clear the stats.
+        '''
+        now = time.time() if now is None else now
+        for car in self.cars.values():
+            car.reset(now)
+        self.resetStats()
+
+    def getStats(self):
+        with self.lock:
+            stats = copy.deepcopy(self.stats)
+        stats['sleeps'] = sum(car.sleeps for car in self.cars.values())
+        return stats
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def _delay(self):
+        latency = self.settings['latency']
+        if latency > 0:
+            jitter = self.settings['jitter'] * latency
+            time.sleep(max(0.0, self.rand.uniform(latency - jitter, latency + jitter)))
+
+    def _error(self):
+        ''' Return the kind of failure of a request (if it fails), or None
+        '''
+        if self.settings['errorRate'] <= 0 or self.rand.random() >= self.settings['errorRate']:
+            return None
+        kinds = list(self.settings['errors'].items())
+        r = self.rand.uniform(0, sum(w for _, w in kinds))
+        for kind, weight in kinds:
+            r -= weight
+            if r <= 0:
+                return kind
+        return kinds[-1][0]
+
+    def handle(self, method, path, now=None):
+        ''' Answer a request of the API.
+
+            Inputs
+              method: HTTP method of the request (i.e., "GET" or "POST")
+              path: path of the request, relative to the API's root (e.g.,
+                'vehicles/1/data_request/drive_state')
+              now: optional (real) time of the request
+
+            Returns
+              (status, body) tuple, where the status is the HTTP status (or
+              None if the connection is to be dropped), and the body is the
+              (JSON-able) response
+        '''
+        self._delay()
+        now = time.time() if now is None else now
+        self._count('requests')
+        kind = self._error()
+        if kind:
+            with self.lock:
+                self.stats['errors'][kind] += 1
+            return ERROR_KINDS[kind], {'error': kind}
+
+        parts = path.strip("/").split("/")
+        if parts == ["vehicles"] and method == "GET":
+            return 200, {'response': [car.info(now) for car in self.cars.values()]}
+        if len(parts) < 3 or parts[0] != "vehicles":
+            return 404, {'error': "not found"}
+        try:
+            car = self.cars[int(parts[1])]
+        except (ValueError, KeyError):
+            return 404, {'error': "unknown vehicle"}
+        cmd = parts[2:]
+
+        if cmd == ["wake_up"] and method == "POST":
+            self._count('wakeUps')
+            return 200, {'response': car.wakeUp(now)}
+        if method != "GET":
+            return 404, {'error': "not found"}
+        if cmd == ["vehicle_data"]:
+            data = {}
+            for tableName, apiName in TABLES_NAME_MAP.items():
+                data[apiName] = car.getTable(tableName, now)
+                if data[apiName] is None:
+                    self._count('asleep')
+                    return 408, {'error': "vehicle unavailable"}
+            self._count('samples', len(data))
+            data.update(car.info(now))
+            return 200, {'response': data}
+        if len(cmd) == 2 and cmd[0] == "data_request" and cmd[1] in self.apiNames:
+            sample = car.getTable(self.apiNames[cmd[1]], now)
+            if sample is None:
+                self._count('asleep')
+                return 408, {'error': "vehicle unavailable"}
+            self._count('samples')
+            return 200, {'response': sample}
+        return 404, {'error': "not found"}
+
+    def control(self, method, path):
+        ''' Answer a request of the mock's control paths (i.e., 'stats',
+            'reset', and 'transitions').
+        '''
+        cmd = path.strip("/")
+        if cmd == "stats" and method == "GET":
+            return 200, self.getStats()
+        if cmd == "reset" and method == "POST":
+            self.reset()
+            return 200, {}
+        if cmd == "transitions" and method == "GET":
+            now = time.time()
+            return 200, {car.vin: car.getTransitions(now) for car in self.cars.values()}
+        return 404, {'error': "not found"}
+
+
+class Vehicle(dict):
+    ''' Object with the interface of a (pre-OAuth) teslajson Vehicle object,
+        that makes its requests with the given connection.
+    '''
+    def __init__(self, data, connection):
+        super().__init__(data)
+        self.connection = connection
+
+    def data_request(self, name):
+        return self.get(f"data_request/{name}")['response']
+
+    def wake_up(self):
+        return self.post("wake_up")
+
+    def get(self, command):
+        return self.connection.get(f"vehicles/{self['id']}/{command}")
+
+    def post(self, command, data=None):
+        return self.connection.post(f"vehicles/{self['id']}/{command}", data)
+
+
+class MockConnection(object):
+    ''' Object with the interface of a teslajson Connection object, for the
+        cars of a (local) MockApi.
+    '''
+    def __init__(self, api):
+        self.api = api
+        now = time.time()
+        self.vehicles = [Vehicle(car.info(now), self) for car in api.cars.values()]
+
+    def _request(self, method, command):
+        status, body = self.api.handle(method, command)
+        if status is None:
+            raise ConnectionError("connection dropped")
+        if status != 200:
+            raise MockHTTPError(status, body.get('error', ""))
+        return body
+
+    def get(self, command):
+        return self._request("GET", command)
+
+    def post(self, command, data=None):
+        return self._request("POST", command)
+
+
+class HttpConnection(object):
+    ''' Object with the interface of a teslajson Connection object, that makes
+        its requests of a MockServer (or anything else that serves the
+        same paths) over HTTP.
+    '''
+    def __init__(self, url, timeout=30, retries=3):
+        ''' Construct a connection object, and get the list of vehicles
+
+            Inputs
+              url: base URL of the server (e.g., 'http://localhost:8080')
+              timeout: number of secs to wait for a response
+              retries: number of times the vehicle list is retried
+        '''
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        for attempt in range(retries + 1):
+            try:
+                vehicles = self.get("vehicles")['response']
+                break
+            except (urllib.error.URLError, ConnectionError) as e:
+                if attempt == retries:
+                    raise
+                sys.stderr.write(f"WARNING: failed to get vehicles from '{self.url}': {e}\n")
+                time.sleep(0.1 * (2 ** attempt))
+        self.vehicles = [Vehicle(v, self) for v in vehicles]
+
+    def _request(self, method, path, data=None):
+        body = json.dumps(data).encode() if data is not None else None
+        req = urllib.request.Request(self.url + path, data=body, method=method)
+        # N.B. urllib's HTTPError has the response's status as its 'code'
+        with urllib.request.urlopen(req, timeout=self.timeout) as r:
+            return json.loads(r.read() or b"{}")
+
+    def get(self, command):
+        return self._request("GET", API_PATH + command)
+
+    def post(self, command, data=None):
+        return self._request("POST", API_PATH + command, data or {})
+
+    def control(self, method, command):
+        ''' Make a request of the mock's control paths (see MockApi.control)
+        '''
+        return self._request(method, MOCK_PATH + command, {} if method == "POST" else None)
+
+
+class MockRequestHandler(http.server.BaseHTTPRequestHandler):
+    ''' Handler for the HTTP requests of a MockServer.
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        api = self.server.api
+        if self.path.startswith(API_PATH):
+            status, body = api.handle(method, self.path[len(API_PATH):])
+        elif self.path.startswith(MOCK_PATH):
+            status, body = api.control(method, self.path[len(MOCK_PATH):])
+        else:
+            status, body = 404, {'error': "not found"}
+        if status is None:
+            # N.B. a network failure, so hang up without a response
+            self.close_connection = True
+            return
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    ''' HTTP server for a MockApi.
+
+        N.B. the server's socket is bound when it's constructed, so it can be
+             created before forking a process to run it in
+    '''
+    daemon_threads = True
+
+    def __init__(self, api, host="127.0.0.1", port=0):
+        super().__init__((host, port), MockRequestHandler)
+        self.api = api
+
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def makeCars(numCars, trace, settings=None):
+    ''' Return a list of VirtualCar objects that all replay the given trace,
+        each starting at a different point in it.
+    '''
+    cars = []
+    for i in range(numCars):
+        car = VirtualCar(f"5YJSA1H1XMOCK{i:04d}", 1000 + i, trace, settings)
+        car.phase = i * car.length / numCars
+        cars.append(car)
+    return cars
+
+
+#
+# MAIN
+#
+if __name__ == '__main__':
+    usage = f"Usage: {sys.argv[0]} [-v] [-n <numCars>] [-p <port>] [-t <traceFile>] [-s <schemaFile>] [-S <speed>] [-l <latency>] [-e <errorRate>] [-a <sleepAfter>]"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-n", "--numCars", action="store", type=int, default=1,
+        help="number of virtual cars")
+    ap.add_argument(
+        "-p", "--port", action="store", type=int, default=8080,
+        help="port the server listens on")
+    ap.add_argument(
+        "-t", "--traceFile", action="store", type=str,
+        help="path to a JSON or DB file with the trace to replay (defaults to a synthetic one)")
+    ap.add_argument(
+        "-s", "--schemaFile", action="store", type=str, default="./dbSchema.yml",
+        help="path to the JSON Schema file that describes the DB's tables")
+    ap.add_argument(
+        "-S", "--speed", action="store", type=float, default=DEF_MOCK_SETTINGS['speed'],
+        help="number of secs of the trace replayed per sec")
+    ap.add_argument(
+        "-l", "--latency", action="store", type=float, default=DEF_MOCK_SETTINGS['latency'],
+        help="mean number of secs each request takes")
+    ap.add_argument(
+        "-e", "--errorRate", action="store", type=float, default=DEF_MOCK_SETTINGS['errorRate'],
+        help="fraction of the requests that fail")
+    ap.add_argument(
+        "-a", "--sleepAfter", action="store", type=float, default=DEF_MOCK_SETTINGS['sleepAfter'],
+        help="secs (of trace time) without requests before a parked car falls asleep (<0 for never)")
+    ap.add_argument(
+        "-v", "--verbose", action="count", default=0, help="print debug info")
+    options = ap.parse_args()
+
+    schema = None
+    if options.traceFile and options.traceFile.endswith(".db"):
+        import yaml
+        with open(options.schemaFile, "r") as f:
+            schema = yaml.load(f, Loader=yaml.Loader)
+    trace = loadTrace(options.traceFile, schema) if options.traceFile else syntheticTrace(seed=0)
+    settings = {'speed': options.speed, 'latency': options.latency,
+                'errorRate': options.errorRate,
+                'sleepAfter': options.sleepAfter if options.sleepAfter >= 0 else None}
+    api = MockApi(makeCars(options.numCars, trace, settings), settings)
+    server = MockServer(api, port=options.port)
+    print(f"Serving {options.numCars} cars at {server.url()}")
+    if options.verbose:
+        for car in api.cars.values():
+            print(f"  {car.vin}: id {car.vehicleId}, {car.length:.0f} secs of trace")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Stats: {api.getStats()}")
@@ -3,29 +3,288 @@
 #
 # Notifier Object for TeslaWatch Application
 #
+# Notifiers are either (external) programs in the NOTIFIER_DIR, which are run
+#  once per event by a Dispatcher, or plugins -- i.e., Python modules in the
+#  NOTIFIER_DIR that define subclasses of NotifierPlugin.  Plugins are loaded
+#  into the process once, and are handed batches of the events that happened
+#  within a (configurable) window, so they can coalesce them into fewer
+#  messages, and are limited in the rate they can send to any one destination.
+#
 ################################################################################
 '''
 
+import collections
+import importlib.util
+import inspect
 import json
 import os
 import sys
+import threading
+import time
 
+from dispatcher import Dispatcher
+import metrics
+from rateLimiter import TokenBucket
 from tracker import EVENT_TYPES
 
 
 # path to notifier programs
 NOTIFIER_DIR = "./notifiers"
 
+# default number of secs that events are collected for before being handed to
+#  the plugins
+DEF_WINDOW = 10
+
+# default max rate (in messages per minute) and burst of messages a plugin can
+#  send to any one destination
+DEF_DEST_RATE = 6
+DEF_DEST_BURST = 3
+
+# marker used as the destination of plugins that don't have any
+DEFAULT_DEST = None
+
+
+class NotifierPlugin(object):
+    ''' Base class for notifiers that are loaded into the process.
+
+        Subclasses must implement send(), and can override format() to change
+        how a batch of events is turned into messages.
+
+        The (optional) settings include:
+          * destinations: list of where messages are to be sent (e.g., phone
+            numbers), each of which are passed to send()
+          * maxRate: max number of messages per minute sent to a destination
+          * burst: max number of messages sent to a destination at once
+    '''
+    def __init__(self, name, settings=None):
+        ''' Construct a notifier plugin object
+
+            Inputs
+              name: name the plugin is referred to by in the configs (i.e., the
+                name of the file it was loaded from)
+              settings: optional dict of settings for the plugin
+        '''
+        self.name = name
+        self.settings = settings if settings else {}
+        self.destinations = self.settings.get('destinations', [DEFAULT_DEST])
+        rate = self.settings.get('maxRate', DEF_DEST_RATE) / 60.0
+        burst = self.settings.get('burst', DEF_DEST_BURST)
+        self.limiters = {dest: TokenBucket(rate, burst) for dest in self.destinations}
+        self.stats = {'events': 0, 'sent': 0, 'limited': 0, 'failed': 0}
+
+    def format(self, events):
+        ''' Take a batch of events and return a list of messages for them,
+            with one message for all of the cars that had the same event.
+
+            Inputs
+              events: list of event dicts, with 'time', 'car', 'eventType',
+                and 'arg' keys
+
+            Returns
+              List of message strings
+        '''
+        groups = collections.OrderedDict()
+        for event in events:
+            groups.setdefault((event['eventType'], event['arg']), []).append(event['car'])
+        msgs = []
+        for (eventType, arg), cars in groups.items():
+            cars = list(collections.OrderedDict.fromkeys(cars))
+            if len(cars) == 1:
+                msgs.append(f"{cars[0]}: {eventType} {arg}")
+            else:
+                msgs.append(f"{len(cars)} cars ({', '.join(map(str, cars))}): {eventType} {arg}")
+        return msgs
+
+    def send(self, destination, message):
+        ''' Send a message to the given destination, raising an exception if
+            it can't be sent.
+        '''
+        raise NotImplementedError
+
+    def deliver(self, events):
+        ''' Take a batch of events and send the messages for them to all of the
+            plugin's destinations, dropping those that exceed the rate caps.
+        '''
+        self.stats['events'] += len(events)
+        for msg in self.format(events):
+            for dest in self.destinations:
+                if not self.limiters[dest].tryAcquire():
+                    self.stats['limited'] += 1
+                    sys.stderr.write(f"WARNING: rate cap exceeded for '{self.name}' to '{dest}', dropping: {msg}\n")
+                    continue
+                try:
+                    self.send(dest, msg)
+                    self.stats['sent'] += 1
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    sys.stderr.write(f"WARNING: '{self.name}' failed to send to '{dest}': {e}\n")
+
+
+def loadPlugins(settings=None, path=NOTIFIER_DIR):
+    ''' Load the Python modules in the given directory, and create an instance
+        of each NotifierPlugin subclass that they define.
+
+        Inputs
+          settings: optional dict whose keys are the names of plugins (i.e.,
+            the names of the files they're in), and whose values are the
+            settings to create them with
+          path: path to the directory with the plugin modules
+
+        Returns
+          Dict whose keys are plugin names and whose values are plugin objects
+    '''
+    if settings is None:
+        settings = {}
+    plugins = {}
+    if not os.path.isdir(path):
+        return plugins
+    for fileName in sorted(os.listdir(path)):
+        if not fileName.endswith(".py"):
+            continue
+        fPath = os.path.join(path, fileName)
+        try:
+            spec = importlib.util.spec_from_file_location(f"notifiers.{fileName[:-3]}", fPath)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except Exception as e:
+            sys.stderr.write(f"WARNING: failed to load notifier plugin '{fPath}': {e}\n")
+            continue
+        for _, cls in inspect.getmembers(module, inspect.isclass):
+            if (issubclass(cls, NotifierPlugin) and cls is not NotifierPlugin and
+                    cls.__module__ == module.__name__):
+                plugins[fileName] = cls(fileName, settings.get(fileName))
+                break
+    return plugins
+
+
+class EventBatcher(object):
+    ''' Object that collects the events for plugins, and hands them to each
+        plugin in a batch once the window after the first of them has passed.
+
+        N.B. the flushing thread is started on first use, so a batcher can
+             be created before any processes are forked
+        N.B. one batcher (in the master) gets the events of all of the cars,
+             so the plugins can coalesce the same event across cars
+    '''
+    def __init__(self, window=DEF_WINDOW):
+        ''' Construct an event batcher object
+
+            Inputs
+              window: number of secs events are collected for
+        '''
+        self.window = window
+        self.pending = {}
+        self.plugins = {}
+        self.firstTime = None
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.thread = None
+        self.pid = None
+        self.stopping = False
+
+    def _start(self):
+        # N.B. threads don't survive a fork, so restart it in a new process
+        if self.thread and self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.pending = {}
+        self.firstTime = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._flusher, name="eventBatcher",
+                                       daemon=True)
+        self.thread.start()
+
+    def add(self, plugin, event):
+        ''' Add an event to the batch for the given plugin
+        '''
+        with self.lock:
+            self._start()
+            self.plugins[plugin.name] = plugin
+            self.pending.setdefault(plugin.name, []).append(event)
+            if self.firstTime is None:
+                self.firstTime = time.time()
+                self.cond.notify()
+
+    def _take(self):
+        pending, self.pending = self.pending, {}
+        self.firstTime = None
+        return pending
+
+    def _deliver(self, pending):
+        for name, events in pending.items():
+            try:
+                self.plugins[name].deliver(events)
+            except Exception as e:
+                sys.stderr.write(f"WARNING: notifier plugin '{name}' failed: {e}\n")
+
+    def _flusher(self):
+        while True:
+            with self.lock:
+                while not self.stopping:
+                    if self.firstTime is None:
+                        self.cond.wait()
+                        continue
+                    wait = self.firstTime + self.window - time.time()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                stopping = self.stopping
+                pending = self._take()
+            self._deliver(pending)
+            if stopping:
+                break
+
+    def flush(self):
+        ''' Hand the events collected so far to the plugins now.
+        '''
+        with self.lock:
+            pending = self._take()
+        self._deliver(pending)
+
+    def close(self):
+        ''' Deliver the pending events and stop the flushing thread.
+
+            N.B. the batcher restarts if it's used again after this
+        '''
+        with self.lock:
+            if not self.thread or self.pid != os.getpid():
+                return
+            thread, self.thread = self.thread, None
+            self.stopping = True
+            self.cond.notify()
+        thread.join()
+
 
 class Notifier(object):
-    ''' Per-car object that can encapsulates the events and (external) programs
-        that re used to generate notifications for each type of event.
+    ''' Object that can encapsulates the events and (external) programs that
+        are used to generate notifications for each type of event.
+
+        N.B. the programs are run by a Dispatcher and the events for plugins
+             are collected by an EventBatcher, so notify() doesn't wait for
+             them (or fail if they do)
     '''
-    def __init__(self, notifiers):
+    def __init__(self, notifiers, dispatcher=None, plugins=None, batcher=None):
+        ''' Construct a notifier object
+
+            Inputs
+              notifiers: dict whose keys are the names of programs or plugins
+                in the NOTIFIER_DIR, and whose values are lists of event types
+              dispatcher: optional (shared) Dispatcher object that runs the
+                programs -- a private one is created if not given
+              plugins: optional (shared) dict of loaded plugins, as returned
+                by loadPlugins() -- loaded here if not given
+              batcher: optional (shared) EventBatcher object that collects the
+                events for plugins -- a private one is created if not given
+        '''
+        self.dispatcher = dispatcher if dispatcher else Dispatcher()
+        self.plugins = plugins if plugins is not None else loadPlugins()
+        self.batcher = batcher if batcher else EventBatcher()
         self.notifiers = {}
         for notifier, eventTypes in notifiers.items():
             fPath = os.path.join(NOTIFIER_DIR, notifier)
-            if not os.path.isfile(fPath) or not os.access(fPath, os.X_OK):
+            if notifier in self.plugins:
+                fPath = self.plugins[notifier]
+            elif not os.path.isfile(fPath) or not os.access(fPath, os.X_OK):
                 raise ValueError(f"Invalid notifier program '{fPath}' for events '{eventTypes}")
             if not set(eventTypes).issubset(set(EVENT_TYPES)):
                 raise ValueError(f"Invalid event types '{set(eventTypes) - set(EVENT_TYPES)}' for notifier '{notifier}'")
@@ -36,27 +295,76 @@ class Notifier(object):
 
     def __str__(self):
         s = "eventsNotifiers: "
-        j = json.dumps(self.notifiers, indent=4, sort_keys=True)
+        j = json.dumps(self.notifiers, indent=4, sort_keys=True,
+                       default=lambda p: f"plugin:{p.name}")
         return s + j
 
-    def notify(self, eventType, arg=None):
+    def notify(self, eventType, arg=None, car=None):
+        ''' Queue up runs of all of the programs, and add to the batches of all
+            of the plugins, associated with the given event type (with the
+            given arg), and return without waiting for them.
+
+            Inputs
+              eventType: one of the EVENT_TYPES
+              arg: argument for the event (e.g., the region's name)
+              car: optional name of the car the event happened to
+        '''
         if not arg:
             raise ValueError("Must provide arg")
-        for notifier in self.notifiers[eventType]:
-            #### FIXME call all the notifiers (with the given arg) that ar associated with this event type
-            print(f"Event: {eventType}, Notifier: {notifier}({arg})")
-            if os.system(f"{notifier} {arg}"):
-                raise Exception(f"Command '{notifier}({arg})' failed")
+        start = time.perf_counter()
+        for notifier in self.notifiers.get(eventType, []):
+            if isinstance(notifier, NotifierPlugin):
+                self.batcher.add(notifier, {'time': time.time(), 'car': car,
+                                            'eventType': eventType, 'arg': arg})
+            elif not self.dispatcher.submit(notifier, eventType, arg):
+                sys.stderr.write(f"WARNING: dropped notification '{notifier}({arg})'\n")
+        labels = {'event': eventType}
+        metrics.observe('teslawatch_notify_seconds', time.perf_counter() - start, labels)
+        metrics.inc('teslawatch_notifications_total', labels)
+
+    def close(self):
+        ''' Wait for the queued notifications to be run, and deliver the
+            pending batches of events to the plugins.
+
+            N.B. closes the dispatcher and batcher (even if they were given),
+                 so it's only called by the notifier's owner, once nothing
+                 else uses them
+        '''
+        self.batcher.close()
+        self.dispatcher.close()
 
 
 #
 # TESTING
 #
 if __name__ == '__main__':
+    import http.server
+    import json
+
+    # N.B. the plugins subclass notifier.NotifierPlugin, not __main__'s
+    from notifier import EventBatcher, Notifier, loadPlugins
+
+    class SmsHandler(http.server.BaseHTTPRequestHandler):
+        ''' Stand-in for the SMS service, that accepts every text
+        '''
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(json.dumps({'success': True}).encode())
+
+        def log_message(self, *args):
+            pass
+
+    smsServer = http.server.HTTPServer(("127.0.0.1", 0), SmsHandler)
+    threading.Thread(target=smsServer.serve_forever, daemon=True).start()
+    smsUrl = f"http://127.0.0.1:{smsServer.server_port}/text"
+
     TEST_NOTIFIERS = {
         'sms.py': [
             "STOPPED_MOVING",
-            "STARTED_MOVING"
+            "STARTED_MOVING",
+            "ENTER_REGION"
         ],
         'testScript.sh': [
             "ENTER_REGION"
@@ -65,14 +373,24 @@ if __name__ == '__main__':
 
     # should work
     try:
-        n = Notifier(TEST_NOTIFIERS)
+        plugins = loadPlugins({'sms.py': {'destinations': ["5551234567"], 'url': smsUrl}})
+        print(f"Plugins: {list(plugins.keys())}")
+        batcher = EventBatcher(0.5)
+        n = Notifier(TEST_NOTIFIERS, plugins=plugins, batcher=batcher)
         print(n)
 
-        n.notify("STOPPED_MOVING", "xxx")
+        n.notify("STOPPED_MOVING", "xxx", "car1")
 
-        n.notify("ENTER_REGION", "yyy")
+        for car in ("car1", "car2", "car3"):
+            n.notify("ENTER_REGION", "HOME", car)
+        time.sleep(1)
+        n.close()
+        print(f"Dispatcher: {n.dispatcher.getStats()}")
+        print(f"Plugin: {plugins['sms.py'].stats}")
+        if plugins['sms.py'].stats['sent'] != 2:
+            raise Exception("events not coalesced")
     except Exception as e:
-        print("FAILED: {e}")
+        print(f"FAILED: {e}")
         sys.exit(1)
 
     # should fail
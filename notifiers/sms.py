@@ -7,7 +7,16 @@
 ################################################################################
 '''
 
+import json
 import sys
+import urllib.parse
+import urllib.request
+
+try:
+    from notifier import NotifierPlugin
+except ImportError:
+    # N.B. being run as a program, rather than loaded as a plugin
+    NotifierPlugin = object
 
 '''
 --------------------
@@ -35,6 +44,40 @@ TODO:
   * create structure with Event types (and args)
 '''
 
+# default URL of the (textbelt) service that texts are sent through
+DEF_SMS_URL = "https://textbelt.com/text"
+
+# default API key for the service (N.B. the free key allows one text a day)
+DEF_SMS_KEY = "textbelt"
+
+# max time (in secs) to wait for the service to respond
+DEF_SMS_TIMEOUT = 10
+
+
+class SmsNotifier(NotifierPlugin):
+    ''' Notifier plugin that sends (coalesced) event messages as SMS texts to
+        the phone numbers given as its destinations.
+
+        The texts are sent through textbelt (or a service with the same API),
+        and the plugin's settings can also include:
+          * url: URL that texts are posted to
+          * key: API key for the service
+          * timeout: max time (in secs) to wait for the service
+    '''
+    def send(self, destination, message):
+        data = urllib.parse.urlencode({
+            'phone': destination,
+            'message': message,
+            'key': self.settings.get('key', DEF_SMS_KEY)
+        }).encode()
+        url = self.settings.get('url', DEF_SMS_URL)
+        timeout = self.settings.get('timeout', DEF_SMS_TIMEOUT)
+        with urllib.request.urlopen(url, data, timeout=timeout) as resp:
+            result = json.loads(resp.read())
+        if not result.get('success'):
+            raise Exception(f"failed to text {destination}: {result.get('error', result)}")
+
+
 def main(args):
     if len(args) != 2:
         sys.stderr.write("Error: invalid number of args '{0}' != 2\n".format(len(args)))
@@ -0,0 +1,213 @@
+'''
+################################################################################
+#
+# Rate Limiter for requests to the Tesla API from the TeslaWatch Application
+#
+################################################################################
+'''
+
+import asyncio
+import multiprocessing as mp
+import threading
+import time
+
+
+# classes of requests, from the most to the least important
+PRIORITIES = ("high", "normal", "low")
+
+# fraction of a bucket's burst that is held in reserve for the more important
+#  classes of requests -- i.e., a request can only take a token if this many
+#  would still be left in the bucket
+PRIORITY_RESERVES = {
+    'high': 0.0,
+    'normal': 0.2,
+    'low': 0.5
+}
+
+
+class TokenBucket(object):
+    ''' Thread-safe token bucket that limits the rate of requests made with a
+        Tesla account.
+
+        Tokens are added at a fixed rate, up to a maximum (burst) number, and
+        each request must take a token before it can be made.  Less important
+        requests must leave a reserve of tokens in the bucket, so when it runs
+        low, the more important requests get the tokens.
+    '''
+    def __init__(self, rate, burst):
+        ''' Construct a token bucket object
+
+            Inputs
+              rate: number of tokens added per second
+              burst: max number of tokens that the bucket can hold
+        '''
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Invalid rate '{rate}' or burst '{burst}'")
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._init()
+
+    def _init(self):
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def _needed(self, tokens, priority):
+        # N.B. a request can't need more than a full bucket, or it'd never run
+        if priority is None:
+            return min(self.burst, tokens)
+        if priority not in PRIORITY_RESERVES:
+            raise ValueError(f"Invalid priority '{priority}'")
+        return min(self.burst, tokens + PRIORITY_RESERVES[priority] * self.burst)
+
+    def _take(self, tokens, priority):
+        ''' Take the tokens if they're available (the lock must be held), and
+            return 0, or the number of secs until they might be otherwise.
+        '''
+        self._refill(time.monotonic())
+        needed = self._needed(tokens, priority)
+        if self.tokens >= needed:
+            self.tokens -= tokens
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def tryAcquire(self, tokens=1, priority=None):
+        ''' Take the given number of tokens if they're available.
+
+            Returns
+              True if the tokens were taken, False otherwise
+        '''
+        with self.lock:
+            return self._take(tokens, priority) == 0
+
+    def acquire(self, tokens=1, priority=None):
+        ''' Take the given number of tokens, waiting until they're available.
+
+            Inputs
+              tokens: number of tokens to take
+              priority: one of the PRIORITIES, or None to not leave a reserve
+
+            Returns
+              Number of seconds spent waiting
+        '''
+        waited = 0.0
+        while True:
+            with self.lock:
+                wait = self._take(tokens, priority)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+class SharedTokenBucket(TokenBucket):
+    ''' Token bucket whose state is in shared memory, so it limits the
+        combined rate of the requests made by all of the (tracker) processes
+        that are forked after it's created.
+
+        N.B. this relies on the monotonic clock being system-wide
+    '''
+    def _init(self):
+        self.state = mp.RawArray('d', [self.burst, time.monotonic()])
+        self.lock = mp.Lock()
+
+    @property
+    def tokens(self):
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, value):
+        self.state[0] = value
+
+    @property
+    def last(self):
+        return self.state[1]
+
+    @last.setter
+    def last(self, value):
+        self.state[1] = value
+
+
+class AsyncTokenBucket(TokenBucket):
+    ''' Token bucket for use by coroutines on a single event loop, which
+        waits without blocking the loop.
+    '''
+    def _init(self):
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = None
+
+    def tryAcquire(self, tokens=1, priority=None):
+        return self._take(tokens, priority) == 0
+
+    def acquire(self, tokens=1, priority=None):
+        raise TypeError("use acquireAsync() with an AsyncTokenBucket")
+
+    async def acquireAsync(self, tokens=1, priority=None):
+        ''' Coroutine that takes the given number of tokens, waiting until
+            they're available, and returns the number of secs spent waiting.
+        '''
+        waited = 0.0
+        while True:
+            # N.B. nothing else runs on the loop between checking and taking
+            wait = self._take(tokens, priority)
+            if not wait:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    import sys
+
+    bucket = TokenBucket(10, 5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire(priority="high")
+    elapsed = time.monotonic() - start
+    print(f"15 requests at 10/sec with a burst of 5: {elapsed:.2f} secs")
+    if not 0.9 <= elapsed <= 1.2:
+        print("FAILED")
+        sys.exit(1)
+
+    # low priority requests can't drain the reserve
+    bucket = TokenBucket(0.1, 10)
+    low = sum(bucket.tryAcquire(priority="low") for _ in range(10))
+    high = sum(bucket.tryAcquire(priority="high") for _ in range(10))
+    print(f"Low priority got {low}, then high priority got {high}")
+    if (low, high) != (5, 5):
+        print("FAILED")
+        sys.exit(1)
+
+    # the tokens are shared across processes
+    bucket = SharedTokenBucket(0.1, 10)
+    procs = [mp.Process(target=bucket.tryAcquire, kwargs={'priority': "high"})
+             for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    print(f"Tokens left after 4 processes took one: {bucket.tokens:.1f}")
+    if int(bucket.tokens) != 6:
+        print("FAILED")
+        sys.exit(1)
+
+    async def test():
+        bucket = AsyncTokenBucket(10, 1)
+        await asyncio.gather(*[bucket.acquireAsync(priority="high") for _ in range(6)])
+
+    start = time.monotonic()
+    asyncio.run(test())
+    elapsed = time.monotonic() - start
+    print(f"6 async requests at 10/sec with a burst of 1: {elapsed:.2f} secs")
+    if not 0.4 <= elapsed <= 0.7:
+        print("FAILED")
+        sys.exit(1)
+    print("SUCCEEDED")
@@ -9,11 +9,11 @@
 import sys
 import time
 import json
+import math
 import random
 from datetime import datetime
 
-from geopy import distance
-from teslawatch import geocoder
+import numpy as np
 
 import teslajson
 
@@ -62,39 +62,47 @@ import teslajson
 #Location(184, Seminary Drive, Menlo Park, San Mateo County, California, 94025, United States of America, (37.4601311, -122.16625850563815, 0.0))
 
 
-"""
 DEG_TO_RAD = (math.pi / 180.0)
-EARTH_RADIUS = ?
-
-# Take a pair of lat/lon points and return the distance between them
-#  in meters.
-def distance(lat1, lon1, lat2, lon2):
-    # phi = 90 - latitude
-    phi1 = (90.0 - lat1) * DEG_TO_RAD
-    phi2 = (90.0 - lat2) * DEG_TO_RAD
-
-    # theta = longitude
-    theta1 = lon1 * DEG_TO_RAD
-    theta2 = lon2 * DEG_TO_RAD
-
-    # compute spherical distance from spherical coordinates
-    # For two locations in spherical coordinates: (1, theta, phi) and
-    #  (1, theta', phi'), cosine( arc length ) =
-    #    sin phi sin phi' cos(theta-theta') + cos phi cos phi'
-    # distance = rho * arc length
-    cos = (math.sin(phi1) * math.sin(phi2) * math.cos(theta1 - theta2) +
-           math.cos(phi1) * math.cos(phi2))
-    arc = math.acos(cos)
-
-    # multiply arc by the radius of the earth in meters to get distance
-    return arc * EARTH_RADIUS
-"""
+
+# mean radius of the earth in Km
+EARTH_RADIUS = 6371.0088
+
+# number of Km per degree of latitude (and of longitude at the equator)
+KM_PER_DEG = EARTH_RADIUS * DEG_TO_RAD
+
+# default size (in degrees) of the cells of a GridIndex (~1Km of latitude)
+DEF_CELL_SIZE = 0.01
+
+# max number of cells a shape can be put in before a GridIndex treats it as
+#  a large shape that is checked for every point
+MAX_SHAPE_CELLS = 1024
+
+# default distance (in Km) a point must be past a region's edge before a
+#  TransitionDetector considers it to have crossed it
+DEF_REGION_MARGIN = 0.025
+
+# default number of seconds a crossing must persist before a
+#  TransitionDetector reports it
+DEF_REGION_DWELL = 30
+
+# Take a pair of lat/lon points and return the (great circle) distance between
+#  them in Km, using the haversine formula.
+def haversine(lat1, lon1, lat2, lon2):
+    phi1 = lat1 * DEG_TO_RAD
+    phi2 = lat2 * DEG_TO_RAD
+    dPhi = phi2 - phi1
+    dLambda = (lon2 - lon1) * DEG_TO_RAD
+    a = (math.sin(dPhi / 2.0) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(dLambda / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
 
 # Base class for shapes that define geographic regions of interest.
 #### TODO consider using abc to define the abstract base class's methods
 #### For now, must provide the following methods:
 ####  * getDistance(lat, lon) -- returns distance to closest edge in Km (float)
 ####  * isInside(lat, lon) -- returns True if given point is inside
+####  * getBounds() -- returns bounding box as (minLat, minLon, maxLat, maxLon)
 class Shape(object):
     def __init__(self, id=None):
         if id is None:
@@ -111,15 +119,26 @@ class Shape(object):
 # Can also ask if a given location is inside the circle or not.
 # The 'radius' arg is Km (float), and 'id' is a string (or a random number is
 #  generated if none is given).
+# N.B. all of the distance math is done on the raw coordinates, no geocoding
 class Circle(Shape):
     def __init__(self, lat, lon, radius, id=None):
         super(Circle, self).__init__(id)
-        self.location = geocoder.reverse((lat, lon))
+        self.lat = lat
+        self.lon = lon
         self.radius = radius
 
     def _getDistance(self, lat, lon):
-        d = distance.distance(self.location.point, (lat, lon))
-        return d
+        return haversine(self.lat, self.lon, lat, lon)
+
+    # Return the signed distance (in Km) to the edge of the circle, which is
+    #  negative if the point is inside.
+    def getDistance(self, lat, lon):
+        return self._getDistance(lat, lon) - self.radius
+
+    def getBounds(self):
+        dLat = self.radius / KM_PER_DEG
+        dLon = dLat / max(math.cos(self.lat * DEG_TO_RAD), 1e-6)
+        return (self.lat - dLat, self.lon - dLon, self.lat + dLat, self.lon + dLon)
 
     def isInside(self, lat, lon):
         d = self._getDistance(lat, lon)
@@ -148,6 +167,27 @@ def isInsidePolygon(lat, lon, poly):
     return inside
 
 
+# Take a lat/lon pair and a polygon (defined by a list of lat/lon tuples),
+#  and return the distance (in Km) to the closest edge of the polygon, using a
+#  local equirectangular projection around the point.
+def distanceToPolygon(lat, lon, poly):
+    scale = math.cos(lat * DEG_TO_RAD) * KM_PER_DEG
+    pts = [((vLon - lon) * scale, (vLat - lat) * KM_PER_DEG) for vLat, vLon in poly]
+    best = None
+    for i, (ax, ay) in enumerate(pts):
+        bx, by = pts[(i + 1) % len(pts)]
+        ex = bx - ax
+        ey = by - ay
+        lenSq = ex * ex + ey * ey
+        t = 0.0
+        if lenSq > 0:
+            t = min(1.0, max(0.0, -(ax * ex + ay * ey) / lenSq))
+        d = math.hypot(ax + t * ex, ay + t * ey)
+        if best is None or d < best:
+            best = d
+    return best
+
+
 # This object defines a polygon (given by a set of latitude and longitude
 #  tuples representing verticies).
 class Polygon(Shape):
@@ -158,6 +198,17 @@ class Polygon(Shape):
     def isInside(self, lat, lon):
         return isInsidePolygon(lat, lon, self.poly)
 
+    # Return the signed distance (in Km) to the closest edge of the polygon,
+    #  which is negative if the point is inside.
+    def getDistance(self, lat, lon):
+        d = distanceToPolygon(lat, lon, self.poly)
+        return -d if self.isInside(lat, lon) else d
+
+    def getBounds(self):
+        lats = [v[0] for v in self.poly]
+        lons = [v[1] for v in self.poly]
+        return (min(lats), min(lons), max(lats), max(lons))
+
 
 # This object defines a rectangle (given by a pair of latitude and longitude
 #  pairs representing a set of diagonal corners).
@@ -172,6 +223,226 @@ class Rectangle(Polygon):
         super(Rectangle, self).__init__(poly, id)
 
 
+# Take arrays of lat/lon pairs and return the (great circle) distances between
+#  them in Km, using the haversine formula (with NumPy broadcasting).
+def haversineArray(lat1, lon1, lat2, lon2):
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dPhi = phi2 - phi1
+    dLambda = np.radians(lon2 - lon1)
+    a = (np.sin(dPhi / 2.0) ** 2 +
+         np.cos(phi1) * np.cos(phi2) * np.sin(dLambda / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+# This object precompiles a set of Circle/Polygon/Rectangle shapes into NumPy
+#  arrays (with bounding boxes), so that all of them can be tested against a
+#  point (or a batch of points) with a few vectorized operations.
+# Circles use the haversine distance, and polygons are tested with the same
+#  ray-casting rule as isInsidePolygon().  Distances to polygon edges use a
+#  local equirectangular projection around each point, which is accurate for
+#  regions that are small compared to the earth.
+# The shapes are given in the order of the columns of the arrays returned by
+#  the batch methods, and their ids are in 'ids'.
+class GeofenceSet(object):
+    def __init__(self, shapes):
+        self.shapes = list(shapes)
+        self.ids = [shape.id for shape in self.shapes]
+        n = len(self.shapes)
+
+        circles = [i for i, s in enumerate(self.shapes) if isinstance(s, Circle)]
+        polys = [i for i, s in enumerate(self.shapes) if isinstance(s, Polygon)]
+        if len(circles) + len(polys) != n:
+            raise ValueError("GeofenceSet only supports Circle, Polygon, and Rectangle shapes")
+
+        self.circleIdx = np.array(circles, dtype=int)
+        self.circleLat = np.array([self.shapes[i].lat for i in circles], dtype=float)
+        self.circleLon = np.array([self.shapes[i].lon for i in circles], dtype=float)
+        self.circleRadius = np.array([self.shapes[i].radius for i in circles], dtype=float)
+
+        # pad all polygons to the same number of vertices (plus one) by
+        #  repeating their first vertex, which closes them and otherwise only
+        #  adds zero-length edges
+        self.polyIdx = np.array(polys, dtype=int)
+        maxVerts = max([len(self.shapes[i].poly) for i in polys], default=1)
+        self.vertLat = np.zeros((len(polys), maxVerts + 1))
+        self.vertLon = np.zeros((len(polys), maxVerts + 1))
+        for j, i in enumerate(polys):
+            poly = list(self.shapes[i].poly)
+            poly += [poly[0]] * (maxVerts + 1 - len(poly))
+            self.vertLat[j] = [v[0] for v in poly]
+            self.vertLon[j] = [v[1] for v in poly]
+
+        # bounding boxes (in degrees) of all of the shapes
+        self.minLat = np.zeros(n)
+        self.maxLat = np.zeros(n)
+        self.minLon = np.zeros(n)
+        self.maxLon = np.zeros(n)
+        if circles:
+            dLat = self.circleRadius / KM_PER_DEG
+            dLon = dLat / np.maximum(np.cos(np.radians(self.circleLat)), 1e-6)
+            self.minLat[self.circleIdx] = self.circleLat - dLat
+            self.maxLat[self.circleIdx] = self.circleLat + dLat
+            self.minLon[self.circleIdx] = self.circleLon - dLon
+            self.maxLon[self.circleIdx] = self.circleLon + dLon
+        if polys:
+            self.minLat[self.polyIdx] = self.vertLat.min(axis=1)
+            self.maxLat[self.polyIdx] = self.vertLat.max(axis=1)
+            self.minLon[self.polyIdx] = self.vertLon.min(axis=1)
+            self.maxLon[self.polyIdx] = self.vertLon.max(axis=1)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def _inPolygons(self, lats, lons, polys):
+        # ray-casting test of N points against the given P polygons -> (N, P)
+        lat = lats[:, None, None]
+        lon = lons[:, None, None]
+        p1Lat = self.vertLat[polys][None, :, :-1]
+        p1Lon = self.vertLon[polys][None, :, :-1]
+        p2Lat = self.vertLat[polys][None, :, 1:]
+        p2Lon = self.vertLon[polys][None, :, 1:]
+        straddles = (np.minimum(p1Lon, p2Lon) < lon) & (lon <= np.maximum(p1Lon, p2Lon))
+        dLon = np.where(p1Lon != p2Lon, p2Lon - p1Lon, 1.0)
+        latIntrs = (lon - p1Lon) * (p2Lat - p1Lat) / dLon + p1Lat
+        crossings = straddles & (lat <= latIntrs)
+        return (crossings.sum(axis=2) % 2) == 1
+
+    def _polyEdgeDistances(self, lats, lons, polys):
+        # distance (in Km) from N points to the closest edge of the given P
+        #  polygons -> (N, P)
+        scale = np.cos(np.radians(lats))[:, None, None] * KM_PER_DEG
+        ax = (self.vertLon[polys][None, :, :-1] - lons[:, None, None]) * scale
+        ay = (self.vertLat[polys][None, :, :-1] - lats[:, None, None]) * KM_PER_DEG
+        bx = np.concatenate([ax[..., 1:], ax[..., :1]], axis=2)
+        by = np.concatenate([ay[..., 1:], ay[..., :1]], axis=2)
+        ex = bx - ax
+        ey = by - ay
+        lenSq = ex * ex + ey * ey
+        t = np.where(lenSq > 0, -(ax * ex + ay * ey) / np.where(lenSq > 0, lenSq, 1.0), 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        dx = ax + t * ex
+        dy = ay + t * ey
+        return np.sqrt(dx * dx + dy * dy).min(axis=2)
+
+    # Take arrays of N lats and lons and return an (N, S) boolean array that
+    #  is True where point n is inside shape s.
+    def containsBatch(self, lats, lons):
+        lats = np.asarray(lats, dtype=float).reshape(-1)
+        lons = np.asarray(lons, dtype=float).reshape(-1)
+        result = np.zeros((len(lats), len(self.shapes)), dtype=bool)
+        inBox = ((self.minLat[None, :] <= lats[:, None]) & (lats[:, None] <= self.maxLat[None, :]) &
+                 (self.minLon[None, :] <= lons[:, None]) & (lons[:, None] <= self.maxLon[None, :]))
+        if len(self.circleIdx):
+            d = haversineArray(lats[:, None], lons[:, None],
+                               self.circleLat[None, :], self.circleLon[None, :])
+            result[:, self.circleIdx] = d < self.circleRadius[None, :]
+        if len(self.polyIdx):
+            # only test the polygons whose bounding boxes contain some point
+            cand = np.nonzero(inBox[:, self.polyIdx].any(axis=0))[0]
+            if len(cand):
+                result[:, self.polyIdx[cand]] = self._inPolygons(lats, lons, cand)
+        return result & inBox
+
+    # Take arrays of N lats and lons and return an (N, S) array of the signed
+    #  distances (in Km) from each point to the edge of each shape, which are
+    #  negative when the point is inside the shape.
+    def distancesBatch(self, lats, lons):
+        lats = np.asarray(lats, dtype=float).reshape(-1)
+        lons = np.asarray(lons, dtype=float).reshape(-1)
+        result = np.zeros((len(lats), len(self.shapes)))
+        if len(self.circleIdx):
+            d = haversineArray(lats[:, None], lons[:, None],
+                               self.circleLat[None, :], self.circleLon[None, :])
+            result[:, self.circleIdx] = d - self.circleRadius[None, :]
+        if len(self.polyIdx):
+            polys = np.arange(len(self.polyIdx))
+            d = self._polyEdgeDistances(lats, lons, polys)
+            inside = self._inPolygons(lats, lons, polys)
+            result[:, self.polyIdx] = np.where(inside, -d, d)
+        return result
+
+    # Take a lat/lon pair and return a list of the ids of the shapes that
+    #  contain it.
+    def contains(self, lat, lon):
+        inside = self.containsBatch([lat], [lon])[0]
+        return [self.ids[i] for i in np.nonzero(inside)[0]]
+
+    # Take a lat/lon pair and return an array of the signed distances (in Km)
+    #  to the edges of all of the shapes (negative when inside).
+    def distances(self, lat, lon):
+        return self.distancesBatch([lat], [lon])[0]
+
+
+# This object is a spatial index over a (changing) set of shapes, where each
+#  cell of a fixed lat/lon grid holds the ids of the shapes whose bounding boxes
+#  overlap it.  So, finding the shapes that might contain a point is a single
+#  dict lookup (no matter how many shapes there are), and only those shapes get
+#  the exact isInside() test.
+# Shapes can be inserted and deleted at any time.  Shapes that would cover more
+#  than MAX_SHAPE_CELLS cells are kept in a separate list that is always
+#  checked.
+class GridIndex(object):
+    def __init__(self, shapes=(), cellSize=DEF_CELL_SIZE):
+        self.cellSize = cellSize
+        self.shapes = {}
+        self.cells = {}
+        self.shapeCells = {}
+        self.large = set()
+        for shape in shapes:
+            self.insert(shape)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __contains__(self, id):
+        return id in self.shapes
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cellSize)), int(math.floor(lon / self.cellSize)))
+
+    # Add a shape to the index, replacing any shape with the same id.
+    def insert(self, shape):
+        if shape.id in self.shapes:
+            self.delete(shape.id)
+        self.shapes[shape.id] = shape
+        minLat, minLon, maxLat, maxLon = shape.getBounds()
+        lat0, lon0 = self._cell(minLat, minLon)
+        lat1, lon1 = self._cell(maxLat, maxLon)
+        if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > MAX_SHAPE_CELLS:
+            self.large.add(shape.id)
+            self.shapeCells[shape.id] = []
+            return
+        cells = [(i, j) for i in range(lat0, lat1 + 1) for j in range(lon0, lon1 + 1)]
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(shape.id)
+        self.shapeCells[shape.id] = cells
+
+    # Remove the shape with the given id from the index, and return it (or None
+    #  if it isn't in the index).
+    def delete(self, id):
+        shape = self.shapes.pop(id, None)
+        if shape is None:
+            return None
+        self.large.discard(id)
+        for cell in self.shapeCells.pop(id):
+            ids = self.cells[cell]
+            ids.discard(id)
+            if not ids:
+                del self.cells[cell]
+        return shape
+
+    # Return a list of the shapes whose bounding boxes might contain the given
+    #  point.
+    def candidates(self, lat, lon):
+        ids = self.cells.get(self._cell(lat, lon), ())
+        return [self.shapes[id] for id in ids] + [self.shapes[id] for id in self.large]
+
+    # Return a list of the shapes that contain the given point.
+    def findContaining(self, lat, lon):
+        return [s for s in self.candidates(lat, lon) if s.isInside(lat, lon)]
+
+
 # This object takes a circle and makes a geofence out of it.
 # ????
 # do things like delete when departs, keep track of entry and exit times,
@@ -206,32 +477,184 @@ class Fence(Shape):
                     # was inside, and now it isn't
                     self.exitTime = now
                     callback = self.onExit
-                # ????
+                self.inside = inside
+                if callback:
+                    callback(self)
+
+
+# This object detects when a moving point enters or exits any of the shapes in
+#  a GridIndex, and reports only those transitions.
+# The regions that the point is inside are kept as a bit vector (one bit per
+#  region), so each sample costs one compare against the last committed state.
+# To keep GPS jitter at an edge from causing a storm of events, a point must be
+#  more than 'margin' Km past a region's edge before the crossing counts
+#  (hysteresis), and a crossing must persist for 'dwell' seconds before it is
+#  committed and reported.
+# The first update just sets the initial state, without reporting events.
+class TransitionDetector(object):
+    def __init__(self, index, margin=DEF_REGION_MARGIN, dwell=DEF_REGION_DWELL):
+        self.index = index
+        self.margin = margin
+        self.dwell = dwell
+        self.bits = {}
+        self.ids = {}
+        self.inside = 0
+        self.pending = 0
+        self.pendingSince = {}
+        self.initialized = False
+
+    def _bit(self, id):
+        if id not in self.bits:
+            bit = 1 << len(self.bits)
+            self.bits[id] = bit
+            self.ids[bit] = id
+        return self.bits[id]
+
+    # Stop tracking the region with the given id (e.g., when it's deleted from
+    #  the index).
+    def forget(self, id):
+        bit = self.bits.get(id)
+        if bit:
+            self.inside &= ~bit
+            self.pending &= ~bit
+            self.pendingSince.pop(id, None)
+
+    # Return the set of ids of the regions that the point is (committed to be)
+    #  inside.
+    def insideIds(self):
+        return set(id for bit, id in self.ids.items() if self.inside & bit)
+
+    # Take a new location and the time (in secs) it was taken, and return a
+    #  list of (eventType, regionId) tuples for the committed transitions.
+    def update(self, lat, lon, now):
+        # N.B. regions the point is inside must be checked even if it has left
+        #      their bounding boxes, as it might still be within the margin
+        shapes = {s.id: s for s in self.index.candidates(lat, lon)}
+        for id in self.insideIds():
+            if id in self.index and id not in shapes:
+                shapes[id] = self.index.shapes[id]
+        current = 0
+        for id, shape in shapes.items():
+            bit = self._bit(id)
+            d = shape.getDistance(lat, lon)
+            if d < (self.margin if self.inside & bit else -self.margin):
+                current |= bit
+
+        if not self.initialized:
+            self.inside = current
+            self.initialized = True
+            return []
+
+        changed = current ^ self.inside
+        if not changed:
+            self.pending = 0
+            self.pendingSince.clear()
+            return []
+
+        events = []
+        for bit, id in self.ids.items():
+            if not changed & bit:
+                if self.pending & bit:
+                    self.pendingSince.pop(id, None)
+                continue
+            if not self.pending & bit:
+                self.pendingSince[id] = now
+            if now - self.pendingSince[id] >= self.dwell:
+                self.inside ^= bit
+                changed &= ~bit
+                self.pendingSince.pop(id)
+                events.append(("ENTER_REGION" if current & bit else "EXIT_REGION", id))
+        self.pending = changed
+        return events
 
 
 class Region(object):
-    '''
-        Inputs
-          specs: dict of Region Specifications
+    ''' Named geographic region of interest for a car (e.g., HOME or WORK).
+
+        A region's specification is a dict with its name as the (only) key,
+        and a dict that defines its shape as the value -- one of:
+          * {'circle': {'latitude': <lat>, 'longitude': <lon>, 'radius': <Km>}}
+          * {'polygon': [[<lat>, <lon>], [<lat>, <lon>], ...]}
+          * {'rectangle': [<lat1>, <lon1>, <lat2>, <lon2>]}
     '''
     def __init__(self, specs):
-        pass
+        ''' Construct a region object
+
+            Inputs
+              specs: dict of Region Specifications
+        '''
+        if not isinstance(specs, dict) or len(specs) != 1:
+            raise ValueError(f"Invalid region specification: {specs}")
+        self.name, shapeSpec = next(iter(specs.items()))
+        if not isinstance(shapeSpec, dict) or len(shapeSpec) != 1:
+            raise ValueError(f"Invalid shape for region '{self.name}': {shapeSpec}")
+        shapeType, args = next(iter(shapeSpec.items()))
+        if shapeType == 'circle':
+            self.shape = Circle(args['latitude'], args['longitude'], args['radius'], self.name)
+        elif shapeType == 'polygon':
+            self.shape = Polygon([tuple(v) for v in args], self.name)
+        elif shapeType == 'rectangle':
+            self.shape = Rectangle(*args, id=self.name)
+        else:
+            raise ValueError(f"Invalid shape type '{shapeType}' for region '{self.name}'")
+        self.specs = specs
 
     def isInRegion(self, location):
         ''' Take a location object and return True if it is in the Region.
             Inputs
-              location: a Location object
+              location: a (lat, lon) tuple
 
             Returns
               True if location within the Region, or False if not
         '''
-        pass
+        return self.shape.isInside(*location)
 
 
 #
 # TESTING
 #
 if __name__ == '__main__':
+    # N.B. with no args, check that a GeofenceSet gives the same results as the
+    #      (per-point) methods of its shapes, for a batch of random points
+    if len(sys.argv) == 1:
+        random.seed(1)
+        center = (37.46, -122.16)
+        shapes = [Circle(center[0] + random.uniform(-0.05, 0.05),
+                         center[1] + random.uniform(-0.05, 0.05),
+                         random.uniform(0.1, 2.0), f"C{i}") for i in range(10)]
+        shapes += [Rectangle(center[0] + random.uniform(-0.05, 0.0), center[1] + random.uniform(-0.05, 0.0),
+                             center[0] + random.uniform(0.0, 0.05), center[1] + random.uniform(0.0, 0.05),
+                             id=f"R{i}") for i in range(5)]
+        shapes.append(Polygon([(37.44, -122.18), (37.48, -122.17), (37.47, -122.14),
+                               (37.455, -122.155), (37.45, -122.13)], "P0"))
+        fences = GeofenceSet(shapes)
+        lats = [center[0] + random.uniform(-0.08, 0.08) for _ in range(2000)]
+        lons = [center[1] + random.uniform(-0.08, 0.08) for _ in range(2000)]
+
+        start = time.perf_counter()
+        inside = fences.containsBatch(lats, lons)
+        dists = fences.distancesBatch(lats, lons)
+        batchTime = time.perf_counter() - start
+        start = time.perf_counter()
+        mismatches = 0
+        maxError = 0.0
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            for j, shape in enumerate(shapes):
+                if bool(inside[i, j]) != shape.isInside(lat, lon):
+                    mismatches += 1
+                maxError = max(maxError, abs(dists[i, j] - shape.getDistance(lat, lon)))
+        loopTime = time.perf_counter() - start
+        print(f"{len(lats)} points x {len(fences)} shapes: batch {batchTime:.3f} secs, "
+              f"per-shape {loopTime:.3f} secs")
+        print(f"Containment mismatches: {mismatches}, max distance error: {maxError:.2e} Km")
+        single = fences.contains(lats[0], lons[0])
+        if (mismatches or maxError > 1e-6 or
+                single != [s.id for s in shapes if s.isInside(lats[0], lons[0])]):
+            print("FAILED")
+            sys.exit(1)
+        print("SUCCEEDED")
+        sys.exit(0)
+
     from optparse import OptionParser
 
     usage = "Usage: {0} [-v] [-u <email>] -p <pswd> [-V <vin>]"
@@ -0,0 +1,259 @@
+'''
+################################################################################
+#
+# Polling Scheduler for TeslaWatch Application
+#
+################################################################################
+'''
+
+import heapq
+import time
+
+from regions import haversine
+
+
+# states that a car can be in, for the purposes of choosing polling intervals
+#  N.B. these are also the keys of the 'stateIntervals' settings
+CAR_STATES = (
+    "moving",
+    "charging",
+    "parkedHome",
+    "parkedAway",
+    "night",
+    "asleep",
+    "probe",
+)
+
+# values of the driveState 'shift_state' field that mean the car is in gear
+DRIVING_SHIFT_STATES = ("D", "R", "N")
+
+# priority (see rateLimiter.PRIORITIES) of the requests for a table when the
+#  car is in a given state -- those not given here are "normal"
+TABLE_PRIORITIES = {
+    'moving': {
+        'driveState': "high",
+        'guiSettings': "low"
+    },
+    'charging': {
+        'guiSettings': "low",
+        'climateSettings': "low"
+    },
+    'parkedHome': {
+        'guiSettings': "low",
+        'climateSettings': "low"
+    },
+    'parkedAway': {
+        'guiSettings': "low",
+        'climateSettings': "low"
+    },
+    'night': {
+        'guiSettings': "low",
+        'climateSettings': "low"
+    },
+    'asleep': {
+        'guiSettings': "low",
+        'climateSettings': "low"
+    }
+}
+
+
+def isNight(now, nightHours):
+    ''' Return True if the given time falls within the given night hours.
+
+        Inputs
+          now: time in seconds since the epoch
+          nightHours: pair of (local time) hours, [start, end), that define
+            the night -- e.g., [23, 6]
+
+        Returns
+          True if it's night at the given time, False otherwise
+    '''
+    if not nightHours:
+        return False
+    start, end = nightHours
+    hour = time.localtime(now).tm_hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def inferState(samples, settings, now, asleep=False, regions=None, moving=None,
+               probing=False):
+    ''' Take the latest samples of a car's tables and infer the state the car
+        is in, for the purposes of polling.
+
+        Inputs
+          samples: dict whose keys are table names and whose values are dicts
+            with the table's latest 'sample' (and the 'time' it was taken)
+          settings: dict of tracker settings (uses 'home' and 'nightHours')
+          now: current time in seconds since the epoch
+          asleep: True if the car isn't responding to data requests
+          regions: optional set of the names of the regions the car is in
+            (being in the 'HOME' region means the car is at home)
+          moving: optional (debounced) indication of whether the car is being
+            driven, used instead of the driveState fields if given
+          probing: True if requests of the car are failing (i.e., its circuit
+            breaker is open), so it should only be probed now and then
+
+        Returns
+          One of the states in CAR_STATES
+    '''
+    if probing:
+        return "probe"
+    if asleep:
+        return "asleep"
+    drive = samples.get('driveState', {}).get('sample') or {}
+    if moving is None:
+        moving = drive.get('shift_state') in DRIVING_SHIFT_STATES or (drive.get('speed') or 0) > 0
+    if moving:
+        return "moving"
+    charge = samples.get('chargeState', {}).get('sample') or {}
+    if charge.get('charging_state') == "Charging":
+        return "charging"
+    if isNight(now, settings.get('nightHours')):
+        return "night"
+    if regions and "HOME" in regions:
+        return "parkedHome"
+    home = settings.get('home')
+    if home and drive.get('latitude') is not None and drive.get('longitude') is not None:
+        dist = haversine(home['latitude'], home['longitude'],
+                         drive['latitude'], drive['longitude'])
+        if dist <= home['radius']:
+            return "parkedHome"
+    return "parkedAway"
+
+
+class PollScheduler(object):
+    ''' Object that decides when each of a car's tables is to be polled next,
+        based on the state that the car is in.
+
+        The next deadline of each table is kept in a heap, so the tracker can
+        sleep until the earliest one instead of waking up on a fixed tick.
+    '''
+    def __init__(self, tables, settings, now=None):
+        ''' Construct a scheduler object
+
+            Inputs
+              tables: list of names of the tables to be polled
+              settings: dict of tracker settings, where 'intervals' gives the
+                default polling interval (in secs) for each table, and
+                'stateIntervals' gives per-state overrides of them
+              now: time (in secs since the epoch) that all tables were last
+                polled (defaults to the current time)
+        '''
+        if now is None:
+            now = time.time()
+        self.tables = list(tables)
+        self.settings = settings
+        self.state = None
+        self.lastPoll = {t: now for t in self.tables}
+        self.heap = []
+        self._reschedule()
+
+    def interval(self, tableName, state=None):
+        ''' Return the polling interval (in secs) for a table in a given state
+            (defaults to the current state).
+        '''
+        if state is None:
+            state = self.state
+        intervals = self.settings.get('stateIntervals', {}).get(state, {})
+        return intervals.get(tableName, self.settings['intervals'][tableName])
+
+    def priority(self, tableName):
+        ''' Return the priority of a request for a table in the current state
+        '''
+        return TABLE_PRIORITIES.get(self.state, {}).get(tableName, "normal")
+
+    def _reschedule(self):
+        self.heap = [(self.lastPoll[t] + self.interval(t), t) for t in self.tables]
+        heapq.heapify(self.heap)
+
+    def setState(self, state):
+        ''' Set the car's current state, and recompute the deadlines of all of
+            the tables if it changed.
+
+            N.B. this must not be called between due() and done()
+
+            Inputs
+              state: one of the states in CAR_STATES
+
+            Returns
+              True if the state changed, False otherwise
+        '''
+        if state == self.state:
+            return False
+        self.state = state
+        self._reschedule()
+        return True
+
+    def setSettings(self, settings):
+        ''' Replace the scheduler's settings (e.g., when the configs are
+            reloaded), and recompute the deadlines of all of the tables.
+
+            N.B. this must not be called between due() and done()
+        '''
+        self.settings = settings
+        self._reschedule()
+
+    def pollAll(self, now):
+        ''' Make all of the tables due at the given time (e.g., when polling of
+            a car is resumed).
+        '''
+        self.heap = [(now, t) for t in self.tables]
+        heapq.heapify(self.heap)
+
+    def nextDeadline(self):
+        ''' Return the time (in secs since the epoch) when the next table is due
+        '''
+        return self.heap[0][0] if self.heap else None
+
+    def timeToNext(self, now):
+        ''' Return the number of secs from the given time until the next table
+            is due (zero if one is overdue)
+        '''
+        deadline = self.nextDeadline()
+        if deadline is None:
+            return None
+        return max(0.0, deadline - now)
+
+    def due(self, now):
+        ''' Remove and return the names of the tables whose deadlines have
+            passed.  Each of them must be passed to done() once polled.
+        '''
+        tables = []
+        while self.heap and self.heap[0][0] <= now:
+            tables.append(heapq.heappop(self.heap)[1])
+        return tables
+
+    def done(self, tableName, now):
+        ''' Record that a table was polled at the given time, and schedule its
+            next poll.
+        '''
+        self.lastPoll[tableName] = now
+        heapq.heappush(self.heap, (now + self.interval(tableName), tableName))
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    TEST_SETTINGS = {
+        'intervals': {'driveState': 1, 'chargeState': 60},
+        'stateIntervals': {
+            'parkedHome': {'driveState': 30}
+        },
+        'home': {'latitude': 37.460184, 'longitude': -122.166203, 'radius': 0.1}
+    }
+    samples = {
+        'driveState': {'sample': {'latitude': 37.4602, 'longitude': -122.1662,
+                                  'shift_state': None, 'speed': None}},
+        'chargeState': {'sample': {'charging_state': "Disconnected"}}
+    }
+    now = time.time()
+    state = inferState(samples, TEST_SETTINGS, now)
+    print(f"State: {state}")
+    s = PollScheduler(TEST_SETTINGS['intervals'].keys(), TEST_SETTINGS, now)
+    s.setState(state)
+    print(f"Next: {s.timeToNext(now)}, due: {s.due(now + 30)}")
+    samples['driveState']['sample']['shift_state'] = "D"
+    print(f"State: {inferState(samples, TEST_SETTINGS, now)}")
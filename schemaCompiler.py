@@ -0,0 +1,261 @@
+'''
+################################################################################
+#
+# DB Schema Compiler for TeslaWatch Application
+#
+# Takes the JSON Schema of the car DB's tables (i.e., dbSchema.yml) and
+#  compiles each table into a flat column layout, where the fields of nested
+#  objects become columns named '<parent>__<child>', along with a prebuilt
+#  INSERT statement and a (generated) function that turns a row from the Tesla
+#  API into the tuple of values for that statement in a single call.
+#
+################################################################################
+'''
+
+import sys
+
+
+# separator between the names of a nested object and its fields in the names
+#  of the flattened columns
+SEPARATOR = "__"
+
+# map JSON Schema types to Sqlite3 column types
+TYPE_MAP = {
+    'integer': "INTEGER",
+    'number': "REAL",
+    'boolean': "INTEGER",
+    'string': "TEXT"
+}
+
+# map Sqlite3 column types back to JSON Schema types
+SQL_TYPE_MAP = {
+    "INTEGER": 'integer',
+    "REAL": 'number',
+    "TEXT": 'string'
+}
+
+_EMPTY = {}
+
+
+def _obj(value):
+    # N.B. the API sometimes returns null (or junk) in place of an object
+    return value if isinstance(value, dict) else _EMPTY
+
+
+def flattenProperties(properties, path=()):
+    ''' Take the 'properties' of a (JSON Schema) object and return a list of
+        (path, type) tuples for each of its (non-object) fields, where the
+        path is the tuple of names that leads to the field.
+    '''
+    fields = []
+    for name in sorted(properties.keys()):
+        prop = properties[name]
+        if prop.get('type') == 'object':
+            fields += flattenProperties(prop.get('properties', {}), path + (name,))
+        else:
+            fields.append((path + (name,), prop.get('type')))
+    return fields
+
+
+def inferType(value):
+    ''' Return the JSON Schema type of a (non-object) value, or None if it
+        can't be known (i.e., it's null).
+
+        N.B. lists are stored as JSON strings
+    '''
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'number'
+    if isinstance(value, (str, list)):
+        return 'string'
+    return None
+
+
+def addField(tableSchema, path, fieldType):
+    ''' Add a field (given by its path) of the given type to the (JSON Schema)
+        description of a table, adding any nested objects it's in.
+    '''
+    props = tableSchema.setdefault('properties', {})
+    for name in path[:-1]:
+        obj = props.setdefault(name, {'type': 'object', 'properties': {}})
+        props = obj.setdefault('properties', {})
+    props[path[-1]] = {'type': fieldType}
+
+
+def leafFields(value, path=()):
+    ''' Generator that returns the (path, value) tuples of all of the
+        (non-object) values in a nested dict.
+    '''
+    for name, v in value.items():
+        if isinstance(v, dict):
+            yield from leafFields(v, path + (name,))
+        else:
+            yield path + (name,), v
+
+
+class TableLayout(object):
+    ''' Object that holds the compiled (flattened) layout of a table.
+    '''
+    def __init__(self, tableName, tableSchema, extraColumns=None):
+        ''' Compile the schema of a table
+
+            Inputs
+              tableName: name of the table
+              tableSchema: dict with the (JSON Schema) description of the
+                table, with its fields in 'properties'
+              extraColumns: optional list of (name, SQL type) tuples of
+                columns that are added to the end of the table's columns, and
+                whose values are taken from the top level of the rows
+        '''
+        self.name = tableName
+        self.paths = []
+        self.types = []
+        for path, fieldType in flattenProperties(tableSchema['properties']):
+            if fieldType not in TYPE_MAP:
+                raise ValueError(f"Invalid type '{fieldType}' for field '{'.'.join(path)}' of table '{tableName}'")
+            self.paths.append(path)
+            self.types.append(TYPE_MAP[fieldType])
+        for colName, colType in (extraColumns or []):
+            self.paths.append((colName,))
+            self.types.append(colType)
+        self.columns = [SEPARATOR.join(path) for path in self.paths]
+        if len(set(self.columns)) != len(self.columns):
+            raise ValueError(f"Flattened column names collide in table '{tableName}'")
+
+        # the names of the fields at each level, used to find unknown fields
+        self.keys = {}
+        for path in self.paths:
+            for i in range(len(path)):
+                self.keys.setdefault(path[:i], set()).add(path[i])
+        self.objPaths = [p for p in self.keys if p]
+        self.leafPaths = set(self.paths)
+
+        colNames = ", ".join(f'"{col}"' for col in self.columns)
+        vals = ", ".join("?" for _ in self.columns)
+        self.insertCmd = f'INSERT INTO "{tableName}" ({colNames}) VALUES ({vals})'
+        self.extract = self._compileExtractor()
+
+    def covers(self, row):
+        ''' Return True if the layout has a column for every field of a row
+            (i.e., the fast path, with no unknown fields).
+        '''
+        if not row.keys() <= self.keys[()]:
+            return False
+        for objPath in self.objPaths:
+            obj = row
+            for name in objPath:
+                obj = obj.get(name)
+                if not isinstance(obj, dict):
+                    break
+            else:
+                if not obj.keys() <= self.keys[objPath]:
+                    return False
+        return True
+
+    def unknownFields(self, row):
+        ''' Return a list of (path, value) tuples for each of the (non-object)
+            fields of a row that the layout doesn't have a column for.
+        '''
+        unknown = []
+        for path, value in leafFields(row):
+            if path[-1] not in self.keys.get(path[:-1], ()):
+                unknown.append((path, value))
+        return unknown
+
+    def columnDefs(self):
+        ''' Return the SQL definitions of the table's columns (without the
+            primary key).
+        '''
+        return ", ".join(f'"{col}" {colType}' for col, colType in zip(self.columns, self.types))
+
+    def _compileExtractor(self):
+        ''' Generate a function that takes a row (as a dict, with nested
+            objects) and returns the tuple of its values for the INSERT.
+        '''
+        objs = {}
+        lines = ["def extract(row):", "    g = row.get"]
+
+        def objVar(objPath):
+            # N.B. each nested object is looked up once per row
+            if objPath not in objs:
+                src = "row" if len(objPath) == 1 else objVar(objPath[:-1])
+                objs[objPath] = var = f"o{len(objs)}"
+                lines.append(f"    {var} = _obj({src}.get({objPath[-1]!r}))")
+            return objs[objPath]
+
+        values = []
+        for path in self.paths:
+            if len(path) == 1:
+                values.append(f"g({path[0]!r})")
+            else:
+                values.append(f"{objVar(path[:-1])}.get({path[-1]!r})")
+        lines.append(f"    return ({', '.join(values)}{',' if len(values) == 1 else ''})")
+        namespace = {'_obj': _obj}
+        exec("\n".join(lines), namespace)
+        return namespace['extract']
+
+    def unflatten(self, values):
+        ''' Take a sequence of the values of the table's columns (e.g., a row
+            read from the DB) and return them as a dict with nested objects.
+        '''
+        row = {}
+        for path, value in zip(self.paths, values):
+            obj = row
+            for name in path[:-1]:
+                obj = obj.setdefault(name, {})
+            obj[path[-1]] = value
+        return row
+
+
+def compileSchema(schema, extraColumns=None):
+    ''' Take the schema for the car DB and return a dict whose keys are table
+        names and whose values are their compiled TableLayout objects.
+
+        Inputs
+          schema: dict with the schema, with the tables' schemas in 'tables'
+          extraColumns: optional list of (name, SQL type) tuples of columns
+            that are added to every table
+    '''
+    if 'tables' not in schema:
+        raise ValueError("'tables' field missing from schema")
+    return {tableName: TableLayout(tableName, tableSchema, extraColumns)
+            for tableName, tableSchema in schema['tables'].items()}
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    import time
+    import yaml
+
+    with open(sys.argv[1] if len(sys.argv) > 1 else "./dbSchema.yml", "r") as f:
+        schema = yaml.load(f, Loader=yaml.Loader)
+    layouts = compileSchema(schema, [("valid_until", "INTEGER")])
+    layout = layouts['vehicleState']
+    print(f"vehicleState columns: {[c for c in layout.columns if SEPARATOR in c]}")
+
+    row = {'timestamp': 1, 'locked': True, 'valid_until': 1,
+           'media_state': {'remote_control_enable': True},
+           'software_update': None,
+           'speed_limit_mode': {'active': False, 'max_limit_mph': 90}}
+    values = layout.extract(row)
+    print(f"Values: {dict((c, v) for c, v in zip(layout.columns, values) if v is not None)}")
+    if layout.unflatten(values)['speed_limit_mode']['max_limit_mph'] != 90:
+        print("FAILED")
+        sys.exit(1)
+
+    n = 100000
+    start = time.perf_counter()
+    for _ in range(n):
+        layout.extract(row)
+    compiled = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(n):
+        tuple(row.get(c) for c in layout.columns)
+    walked = time.perf_counter() - start
+    print(f"Compiled: {compiled / n * 1e6:.2f} usec/row, dict walk: {walked / n * 1e6:.2f} usec/row")
+    print("SUCCEEDED")
@@ -0,0 +1,281 @@
+'''
+################################################################################
+#
+# Latest-State Store for TeslaWatch Application
+#
+# Keeps the latest sample of each of the tables of each car (sent by the
+#  trackers in STATE messages) in the master, so front-ends and scripts can
+#  read the cars' current state without making requests of the Tesla API
+#  (which might wake the cars up) or reading their DBs.  Each update gets a
+#  new version number, so readers can ask for only what changed since the
+#  version they last saw (and wait for it to change).  The state is served
+#  as JSON on a local HTTP endpoint, on a TCP port and/or a Unix socket.
+#
+################################################################################
+'''
+
+import http.server
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+import urllib.parse
+
+
+# default settings for the state API
+#  * host: address the HTTP endpoint listens on
+#  * port: port the HTTP endpoint listens on (none, if None)
+#  * socket: path of a Unix socket the HTTP endpoint listens on (none, if None)
+#  * maxWait: max number of secs a request can wait for the state to change
+DEF_STATE_SETTINGS = {
+    'host': "127.0.0.1",
+    'port': None,
+    'socket': None,
+    'maxWait': 60
+}
+
+
+class StateStore(object):
+    ''' Object that holds the versioned latest state of all of the cars.
+
+        N.B. entries are replaced on update (never changed), so readers only
+             copy references while holding the lock
+    '''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.version = 0
+        self.cars = {}
+
+    def update(self, vin, table, sample, sampleTime=None):
+        ''' Set the latest sample of one of a car's tables, and return the
+            store's new version.
+        '''
+        entry = {'sample': sample, 'time': time.time() if sampleTime is None else sampleTime}
+        with self.cond:
+            self.version += 1
+            entry['version'] = self.version
+            self.cars.setdefault(vin, {})[table] = entry
+            self.cond.notify_all()
+            return self.version
+
+    def handleMessage(self, msg):
+        ''' Take a tracker's message, and update the store if it's a STATE
+            message (e.g., as the handler of an ipc.Hub).
+        '''
+        if msg.type == "STATE":
+            self.update(msg.vin, msg.data['table'], msg.data['sample'], msg.data['time'])
+
+    def get(self, vin=None, table=None, since=0, wait=0):
+        ''' Return the store's current version, and the entries that are newer
+            than the given version.
+
+            N.B. raises KeyError if the given car (or table) isn't in the store
+
+            Inputs
+              vin: optional VIN of the only car to return entries of
+              table: optional name of the only table (of the given car) to
+                return the entry of
+              since: only return the entries newer than this version
+              wait: max number of secs to wait for a newer entry, if there
+                isn't one
+
+            Returns
+              (version, dict of {vin: {table: entry}}) tuple, where each entry
+              is a dict with the 'sample', and its 'time' and 'version'
+        '''
+        deadline = time.monotonic() + wait
+        with self.cond:
+            while True:
+                result = self._newer(vin, table, since)
+                remaining = deadline - time.monotonic()
+                if result or remaining <= 0:
+                    return self.version, result
+                self.cond.wait(remaining)
+
+    def _newer(self, vin, table, since):
+        cars = {vin: self.cars[vin]} if vin else self.cars
+        result = {}
+        for v, tables in cars.items():
+            if table:
+                tables = {table: tables[table]}
+            newer = {t: e for t, e in tables.items() if e['version'] > since}
+            if newer:
+                result[v] = newer
+        return result
+
+
+class _StateHandler(http.server.BaseHTTPRequestHandler):
+    ''' Serves GETs of "/state", "/state/<vin>", and "/state/<vin>/<table>",
+        with optional 'since' (version) and 'wait' (secs) query parameters.
+    '''
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if not parts or parts[0] != "state" or len(parts) > 3:
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            since = int(query.get('since', [0])[0])
+            wait = min(max(float(query.get('wait', [0])[0]), 0), self.server.maxWait)
+        except ValueError:
+            self.send_error(400, "Invalid 'since' or 'wait'")
+            return
+        vin = parts[1] if len(parts) > 1 else None
+        table = parts[2] if len(parts) > 2 else None
+        try:
+            version, cars = self.server.store.get(vin, table, since, wait)
+        except KeyError:
+            self.send_error(404)
+            return
+
+        body = {'version': version}
+        if not vin:
+            body['cars'] = cars
+        elif not table:
+            body['tables'] = cars.get(vin, {})
+        else:
+            body.update(cars.get(vin, {}).get(table, {}))
+            body['version'] = version
+        data = json.dumps(body, default=str).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Serving(object):
+    ''' Mixin for the state servers, that run in a (daemon) thread of the
+        master.
+    '''
+    daemon_threads = True
+
+    def _start(self, store, maxWait):
+        self.store = store
+        self.maxWait = maxWait
+        self.thread = threading.Thread(target=self.serve_forever, name="state",
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StateServer(_Serving, http.server.ThreadingHTTPServer):
+    ''' HTTP server for the state store, on a TCP port.
+    '''
+    def __init__(self, store, host=DEF_STATE_SETTINGS['host'], port=0,
+                 maxWait=DEF_STATE_SETTINGS['maxWait']):
+        ''' Construct (and start) a state server
+
+            Inputs
+              store: the StateStore to serve
+              host: address to listen on
+              port: port to listen on
+              maxWait: max number of secs a request can wait for changes
+        '''
+        super().__init__((host, port), _StateHandler)
+        self._start(store, maxWait)
+
+
+class UnixStateServer(_Serving, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' HTTP server for the state store, on a Unix socket.
+    '''
+    def __init__(self, store, path, maxWait=DEF_STATE_SETTINGS['maxWait']):
+        ''' Construct (and start) a state server
+
+            N.B. replaces a (stale) socket at the given path
+
+            Inputs
+              store: the StateStore to serve
+              path: path of the socket to listen on
+              maxWait: max number of secs a request can wait for changes
+        '''
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        super().__init__(path, _StateHandler)
+        self._start(store, maxWait)
+
+    def close(self):
+        super().close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+#
+# TESTING
+#
+if __name__ == '__main__':
+    import socket
+    import sys
+    import tempfile
+    import urllib.request
+
+    store = StateStore()
+    store.update("V1", "driveState", {'latitude': 37.46, 'longitude': -122.16, 'speed': None})
+    store.update("V1", "chargeState", {'battery_level': 80})
+    v = store.update("V2", "driveState", {'latitude': 37.38, 'longitude': -121.99, 'speed': 30})
+
+    server = StateServer(store)
+    base = f"http://{server.server_address[0]}:{server.server_address[1]}"
+
+    def getJson(path):
+        return json.loads(urllib.request.urlopen(base + path).read().decode())
+
+    full = getJson("/state")
+    print(full)
+    newer = getJson(f"/state?since={v - 1}")
+    one = getJson("/state/V1/chargeState")
+
+    def later():
+        time.sleep(0.2)
+        store.update("V1", "driveState", {'latitude': 37.47, 'longitude': -122.16, 'speed': 5})
+    threading.Thread(target=later).start()
+    start = time.time()
+    waited = getJson(f"/state/V1?since={v}&wait=5")
+    waitTime = time.time() - start
+    print(waited, f"{waitTime:.2f} secs")
+    try:
+        urllib.request.urlopen(base + "/state/V3")
+        missing = 200
+    except urllib.error.HTTPError as e:
+        missing = e.code
+    server.close()
+
+    path = os.path.join(tempfile.mkdtemp(), "state.sock")
+    userver = UnixStateServer(store, path)
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(path)
+    sock.sendall(b"GET /state/V2/driveState HTTP/1.0\r\n\r\n")
+    reply = b""
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        reply += data
+    sock.close()
+    userver.close()
+    print(reply.decode().split("\r\n\r\n")[1])
+
+    n = 100000
+    start = time.perf_counter()
+    for _ in range(n):
+        store.get("V1", "driveState")
+    print(f"get(): {(time.perf_counter() - start) / n * 1e6:.2f} usec")
+
+    if (full['version'] != 3 or set(full['cars']) != {"V1", "V2"} or
+            list(newer['cars']) != ["V2"] or one['sample']['battery_level'] != 80 or
+            list(waited['tables']) != ["driveState"] or waitTime > 2 or missing != 404 or
+            b'"speed": 30' not in reply or os.path.exists(path)):
+        print("FAILED")
+        sys.exit(1)
+    print("SUCCEEDED")
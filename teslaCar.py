@@ -6,10 +6,15 @@
 ################################################################################
 '''
 
+import asyncio
+import concurrent.futures
 import json
+import random
 import sys
+import threading
 import time
-##from urllib import HTTPError
+
+import metrics
 
 
 INTER_CMD_DELAY = 0.1
@@ -17,20 +22,230 @@ INTER_CMD_DELAY = 0.1
 # map the car DB schema name to the Tesla API name
 TABLES_NAME_MAP = {
     'chargeState': "charge_state",
-    'climateState': "climate_state",
+    'climateSettings': "climate_state",
     'driveState': "drive_state",
     'guiSettings': "gui_settings",
     'vehicleState': "vehicle_state"
 }
 
+# ways of getting a snapshot of all of a car's tables:
+#  * serial: one request per table, one after the other
+#  * concurrent: one request per table, all at the same time
+#  * vehicleData: a single request of the combined 'vehicle_data' endpoint
+SNAPSHOT_MODES = ("serial", "concurrent", "vehicleData")
+
+# order in which the tables are requested in the 'serial' snapshot mode
+SERIAL_ORDER = ("guiSettings", "chargeState", "climateSettings", "vehicleState", "driveState")
+
+# classes of failed requests:
+#  * asleep: the car is asleep or offline (don't retry, or it'd be woken up)
+#  * throttled: too many requests have been made with the account
+#  * server: the Tesla API had an internal error
+#  * network: the request didn't get a response (e.g., a connection error)
+#  * empty: the request got an empty response
+#  * permanent: the request itself is bad (don't retry)
+ERROR_CLASSES = ("asleep", "throttled", "server", "network", "empty", "permanent")
+
+# classes of failed requests that aren't retried
+NO_RETRY_CLASSES = ("asleep", "permanent")
+
+# classes of failed requests that count against a car's circuit breaker
+BREAKER_CLASSES = ("throttled", "server", "network", "empty")
+
+# Default settings for retrying failed requests
+#  * retries: max number of times a request is retried
+#  * baseDelay: secs before the first retry, which doubles with each retry
+#  * maxDelay: max secs before any retry
+#  * throttledFactor: multiplier of the delays after a throttled request
+DEF_RETRY_SETTINGS = {
+    'retries': 3,
+    'baseDelay': 1.0,
+    'maxDelay': 60.0,
+    'throttledFactor': 4.0
+}
+
+# Default settings for a car's circuit breaker
+#  * failures: number of consecutive failed requests that open the breaker
+#  * resetTime: secs the breaker stays open before a probe request is let by
+DEF_BREAKER_SETTINGS = {
+    'failures': 5,
+    'resetTime': 5 * 60
+}
+
+# Default settings for a Car
+DEF_CAR_SETTINGS = {
+    'snapshotMode': "serial",
+    'retry': DEF_RETRY_SETTINGS,
+    'breaker': DEF_BREAKER_SETTINGS
+}
+
+
+def errorStatus(e):
+    ''' Return the HTTP status code of an exception raised by a request, or
+        None if it doesn't have one.
+    '''
+    code = getattr(e, 'code', None)
+    if code is None:
+        response = getattr(e, 'response', None)
+        code = getattr(response, 'status_code', None)
+    try:
+        return int(code)
+    except (TypeError, ValueError):
+        return None
+
+
+def classifyError(e):
+    ''' Return the class (one of ERROR_CLASSES) of an exception raised by a
+        request.
+    '''
+    status = errorStatus(e)
+    if status == 408 or "vehicle unavailable" in str(e).lower():
+        return "asleep"
+    if status == 429:
+        return "throttled"
+    if status is None:
+        return "network"
+    if status >= 500:
+        return "server"
+    if status >= 400:
+        return "permanent"
+    return "network"
+
+
+class RetryPolicy(object):
+    ''' Object that decides if, and after how long, a failed request should
+        be retried, using exponential backoff with (full) jitter.
+    '''
+    def __init__(self, settings=None):
+        ''' Construct a retry policy object
+
+            Inputs
+              settings: optional dict that overrides the values in
+                DEF_RETRY_SETTINGS
+        '''
+        self.settings = dict(DEF_RETRY_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+
+    def shouldRetry(self, errorClass, attempt):
+        ''' Return True if a request that failed (with the given class of
+            error) on the given attempt (starting at 1) should be retried.
+        '''
+        if errorClass in NO_RETRY_CLASSES:
+            return False
+        return attempt <= self.settings['retries']
+
+    def delay(self, errorClass, attempt):
+        ''' Return the number of secs to wait before retrying a request that
+            failed (with the given class of error) on the given attempt.
+        '''
+        delay = self.settings['baseDelay'] * (2 ** (attempt - 1))
+        if errorClass == "throttled":
+            delay *= self.settings['throttledFactor']
+        return random.uniform(0, min(delay, self.settings['maxDelay']))
+
+
+class CircuitBreaker(object):
+    ''' Thread-safe, per-car object that stops requests from being made of a
+        car after a run of failures, until a probe request succeeds.
+
+        The breaker is 'closed' (requests are made) until enough consecutive
+        requests fail, when it opens (requests fail without being made).
+        After the reset time, it lets one probe request by ('halfOpen'), and
+        closes if it succeeds, or opens again if it fails.
+    '''
+    def __init__(self, settings=None):
+        ''' Construct a circuit breaker object
+
+            Inputs
+              settings: optional dict that overrides the values in
+                DEF_BREAKER_SETTINGS
+        '''
+        self.settings = dict(DEF_BREAKER_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        self.state = "closed"
+        self.failures = 0
+        self.openedAt = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        ''' Return True if a request can be made now.
+        '''
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self.openedAt >= self.settings['resetTime']:
+                self.state = "halfOpen"
+                return True
+            return False
+
+    def ready(self):
+        ''' Return True if a request would be allowed now, without letting a
+            probe request by (i.e., without changing the breaker's state).
+        '''
+        with self.lock:
+            if self.state == "closed":
+                return True
+            return self.state == "open" and time.time() - self.openedAt >= self.settings['resetTime']
+
+    def isOpen(self):
+        ''' Return True if requests aren't being made (other than probes).
+        '''
+        return self.state != "closed"
+
+    def recordSuccess(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.openedAt = None
+
+    def recordFailure(self):
+        ''' Record a failed request, and return True if it opened the breaker.
+        '''
+        with self.lock:
+            self.failures += 1
+            if self.state == "halfOpen" or (self.state == "closed" and
+                                            self.failures >= self.settings['failures']):
+                opened = self.state == "closed"
+                self.state = "open"
+                self.openedAt = time.time()
+                return opened
+            return False
+
 
 class Car(object):
     '''Car object that encapsulates the state of a car,
     '''
-    def __init__(self, vin, config, vehicle):
+    def __init__(self, vin, config, vehicle, settings=None, limiter=None):
+        ''' Construct a car object
+
+            Inputs
+              vin: VIN string for the car
+              config: dict with the car's configuration
+              vehicle: teslajson Vehicle object for the car
+              settings: optional dict of settings that override the defaults
+                in DEF_CAR_SETTINGS
+              limiter: optional rate limiter object (e.g., SharedTokenBucket),
+                shared by all of the cars of an account, that every request
+                must go through (N.B. not used by the *Async() methods, whose
+                requests are limited by the client they're made through)
+        '''
         self.vin = vin
         self.config = config
         self.vehicle = vehicle
+        self.settings = dict(DEF_CAR_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        if self.settings['snapshotMode'] not in SNAPSHOT_MODES:
+            raise ValueError(f"Invalid snapshot mode '{self.settings['snapshotMode']}'")
+        self.retryPolicy = RetryPolicy(self.settings['retry'])
+        self.breaker = CircuitBreaker(self.settings['breaker'])
+        self.limiter = limiter
+        self.executor = None
+        self.snapshot = {}
+        self.snapshotTimes = {}
+        self.errors = {}
 
     def __str__(self):
         s = "VIN: {0}\n".format(self.vin)
@@ -40,26 +255,171 @@ class Car(object):
         s += "vehicle: " + j + "\n"
         return s
 
-    def _dataRequest(self, cmd, retries=3):
-        r = None
+    def _dataRequest(self, cmd, retries=None, priority=None):
+        return self._request(self.vehicle.data_request, cmd, retries=retries,
+                             priority=priority)
+
+    def _request(self, func, cmd, retries=None, priority=None):
+        ''' Make a request of the Tesla API, retrying it (as given by the car's
+            RetryPolicy) if it fails, and return its response, or None if it
+            failed, or the car's circuit breaker is open.
+
+            Inputs
+              func: function that makes the request
+              cmd: argument to the function (e.g., the name of a table)
+              retries: optional max number of retries, which overrides the
+                retry policy's
+              priority: optional priority of the request with the rate limiter
+
+            Returns
+              the (non-empty) response to the request, or None
+        '''
+        if not self.breaker.allow():
+            self.errors[cmd] = "breaker"
+            return None
+        if retries is None:
+            retries = self.retryPolicy.settings['retries']
+        attempt = 0
         while True:
-            try:
-                r = self.vehicle.data_request(cmd)
-##            except HTTPError as e:
-            except Exception as e:
-                #### TODO better exception handler
-                sys.stderr.write("WARNING: {0}\n".format(e))
-                if e.code == 400:
-                    return None
-                elif e.code == 404:
-                    return None
-                retries -= 1
-                if retries < 0:
-                    return None
-                time.sleep(3)
+            attempt += 1
+            if self.limiter:
+                self.limiter.acquire(priority=priority)
+            r, errorClass, error = self._attempt(func, cmd)
             if r:
-                break
-        return r
+                return r
+            delay = self._retryDelay(cmd, errorClass, error, attempt, retries)
+            if delay is None:
+                return None
+            time.sleep(delay)
+            if self._blocked(cmd):
+                return None
+
+    async def _requestAsync(self, client, func, cmd, retries=None, priority=None):
+        ''' Coroutine that does the same thing as _request(), for use with the
+            asyncio engine.
+
+            N.B. each attempt is made through the given (shared) client, so
+                 each one takes a token from its rate limiter, and only holds
+                 one of its threads while it's being made (i.e., not while
+                 waiting to retry)
+
+            Inputs
+              client: ApiClient object used to make requests of the Tesla API
+              func, cmd, retries, priority: as with _request()
+        '''
+        if not self.breaker.allow():
+            self.errors[cmd] = "breaker"
+            return None
+        if retries is None:
+            retries = self.retryPolicy.settings['retries']
+        attempt = 0
+        while True:
+            attempt += 1
+            r, errorClass, error = await client.call(self._attempt, func, cmd,
+                                                     priority=priority)
+            if r:
+                return r
+            delay = self._retryDelay(cmd, errorClass, error, attempt, retries)
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+            if self._blocked(cmd):
+                return None
+
+    def _blocked(self, cmd):
+        ''' Return True (and record why) if a request that's waiting to be
+            retried was stopped by the breaker opening in the meantime (e.g.,
+            because of the car's other requests).
+        '''
+        if not self.breaker.isOpen():
+            return False
+        self.errors[cmd] = "breaker"
+        return True
+
+    def _attempt(self, func, cmd):
+        ''' Make one attempt at a request, and return its response, the class
+            of error ("ok" if it succeeded), and the error.
+        '''
+        start = time.perf_counter()
+        try:
+            r = func(cmd)
+            errorClass = "ok" if r else "empty"
+            error = "empty response"
+        except Exception as e:
+            r = None
+            errorClass = classifyError(e)
+            error = e
+        metrics.observe('teslawatch_api_request_seconds', time.perf_counter() - start,
+                        {'vin': self.vin, 'cmd': cmd})
+        metrics.inc('teslawatch_api_requests_total',
+                    {'vin': self.vin, 'cmd': cmd, 'result': errorClass})
+        self.errors[cmd] = errorClass
+        if r:
+            self.breaker.recordSuccess()
+        return r, errorClass, error
+
+    def _retryDelay(self, cmd, errorClass, error, attempt, retries):
+        ''' Record a failed attempt at a request, and return the number of
+            secs to wait before retrying it, or None if it isn't to be retried.
+        '''
+        if errorClass not in BREAKER_CLASSES:
+            # N.B. the API is working, even if the request failed
+            self.breaker.recordSuccess()
+        if errorClass == "asleep":
+            return None
+        sys.stderr.write(f"WARNING: request '{cmd}' of '{self.vin}' failed ({errorClass}, attempt {attempt}): {error}\n")
+        if errorClass in BREAKER_CLASSES and self.breaker.recordFailure():
+            sys.stderr.write(f"WARNING: too many failed requests of '{self.vin}', backing off\n")
+        if (attempt > retries or not self.retryPolicy.shouldRetry(errorClass, attempt) or
+                self.breaker.isOpen()):
+            return None
+        metrics.inc('teslawatch_api_retries_total', {'vin': self.vin, 'class': errorClass})
+        return self.retryPolicy.delay(errorClass, attempt)
+
+    def lastError(self, tableName):
+        ''' Return the class of error (see ERROR_CLASSES) of the last request
+            of one of the car's tables, "breaker" if it wasn't made because the
+            car's circuit breaker was open, or None if it succeeded.
+        '''
+        errorClass = self.errors.get(TABLES_NAME_MAP.get(tableName, tableName))
+        return None if errorClass == "ok" else errorClass
+
+    def _remember(self, tableName, sample):
+        if sample:
+            self.snapshot[tableName] = sample
+            self.snapshotTimes[tableName] = time.time()
+        return sample
+
+    def getSnapshot(self):
+        ''' Return the last successfully read sample of each of the car's
+            tables (without making any requests), in a dict with the tables'
+            names as keys, and None for tables that haven't been read.
+        '''
+        return {t: self.snapshot.get(t) for t in TABLES_NAME_MAP}
+
+    def getOnlineState(self):
+        ''' Get the car's state from the account's list of vehicles, which
+            (unlike requests of the car's data) doesn't wake the car up.
+
+            Returns
+                one of "online", "asleep", or "offline", or None if error
+        '''
+        return self._onlineState(self._request(self.vehicle.connection.get, 'vehicles'))
+
+    async def getOnlineStateAsync(self, client):
+        ''' Coroutine that does the same thing as getOnlineState(), making its
+            requests through the given ApiClient.
+        '''
+        return self._onlineState(await self._requestAsync(client, self.vehicle.connection.get,
+                                                          'vehicles'))
+
+    def _onlineState(self, r):
+        if not r:
+            return None
+        for v in r.get('response', []):
+            if v.get('vin') == self.vin:
+                return v.get('state')
+        return None
 
     def wakeUp(self):
         ''' Wakeup car'''
@@ -75,11 +435,13 @@ class Car(object):
         ''' Return car's name'''
         return self.vehicle['display_name']
 
-    def getTable(self, tableName):
+    def getTable(self, tableName, priority=None):
         ''' Take the name of a table in the Tesla API and return it as a dict.
 
             Inputs
                 tableName: name of one of the Tesla API's state tables
+                priority: optional priority of the request with the rate
+                  limiter (see rateLimiter.PRIORITIES)
 
             Returns
                 dict with contents of desired table, or None if error
@@ -87,7 +449,40 @@ class Car(object):
         if tableName not in TABLES_NAME_MAP.keys():
             sys.stderr.write("ERROR: invalid table name '{0}'".format(tableName))
             return None
-        return self._dataRequest(TABLES_NAME_MAP[tableName])
+        return self._remember(tableName,
+                              self._dataRequest(TABLES_NAME_MAP[tableName], priority=priority))
+
+    async def getTableAsync(self, client, tableName, priority=None):
+        ''' Coroutine that does the same thing as getTable(), making its
+            requests through the given ApiClient.
+        '''
+        if tableName not in TABLES_NAME_MAP.keys():
+            sys.stderr.write("ERROR: invalid table name '{0}'".format(tableName))
+            return None
+        r = await self._requestAsync(client, self.vehicle.data_request,
+                                     TABLES_NAME_MAP[tableName], priority=priority)
+        return self._remember(tableName, r)
+
+    async def getTablesAsync(self, client, tableNames, priorities=None):
+        ''' Coroutine that gets the given tables at the same time (see
+            getTableAsync()), and returns a list of them.
+
+            N.B. the breaker is checked first, so no coroutines are started
+                 (or tokens or threads of the client taken) while it's open
+
+            Inputs
+              client: ApiClient object used to make requests of the Tesla API
+              tableNames: list of the names of the tables to get
+              priorities: optional list of the requests' priorities
+        '''
+        if not self.breaker.ready():
+            for tableName in tableNames:
+                self.errors[TABLES_NAME_MAP.get(tableName, tableName)] = "breaker"
+            return [None] * len(tableNames)
+        if priorities is None:
+            priorities = [None] * len(tableNames)
+        return await asyncio.gather(*[self.getTableAsync(client, t, p)
+                                      for t, p in zip(tableNames, priorities)])
 
     def getChargeState(self):
         ''' Get the car's charge state'''
@@ -109,29 +504,165 @@ class Car(object):
         ''' Get the vehicle state for the car'''
         return self._dataRequest('vehicle_state')
 
+    def getVehicleData(self):
+        ''' Get all of the car's state tables with a single request of the
+            combined 'vehicle_data' endpoint, and return them in a dict with
+            the Tesla API's names as keys.
+        '''
+        r = self._request(self.vehicle.get, 'vehicle_data')
+        if r and 'response' in r:
+            r = r['response']
+        return r
+
+    async def getVehicleDataAsync(self, client):
+        ''' Coroutine that does the same thing as getVehicleData(), making its
+            requests through the given ApiClient.
+        '''
+        r = await self._requestAsync(client, self.vehicle.get, 'vehicle_data')
+        if r and 'response' in r:
+            r = r['response']
+        return r
+
     def getCarState(self):
         ''' Get all of the state records for the car from the Tesla API and
             return them in a dict, with the tables' names as keys.
+
+            Depending on the 'snapshotMode' setting, this makes one request of
+            the combined 'vehicle_data' endpoint (falling back to per-table
+            requests if that fails), makes concurrent requests for each table,
+            or makes the requests for each table one after the other.
         '''
+        mode = self.settings['snapshotMode']
+        if mode == "vehicleData":
+            data = self.getVehicleData()
+            if data:
+                return {t: self._remember(t, data.get(apiName))
+                        for t, apiName in TABLES_NAME_MAP.items()}
+            sys.stderr.write(f"WARNING: failed to get vehicle data for '{self.vin}'; getting tables\n")
+            mode = "concurrent"
+        if mode == "concurrent":
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(TABLES_NAME_MAP), thread_name_prefix=f"car-{self.vin}")
+            futures = {t: self.executor.submit(self.getTable, t) for t in TABLES_NAME_MAP}
+            return {t: f.result() for t, f in futures.items()}
+
+        # N.B. the rate limiter (if any) paces the requests, so don't sleep
+        delay = 0 if self.limiter else INTER_CMD_DELAY
         state = {}
         state['guiSettings'] = self.getGUISettings()
-        time.sleep(INTER_CMD_DELAY)
+        time.sleep(delay)
 
         state['chargeState'] = self.getChargeState()
-        time.sleep(INTER_CMD_DELAY)
+        time.sleep(delay)
 
         state['climateSettings'] = self.getClimateSettings()
-        time.sleep(INTER_CMD_DELAY)
+        time.sleep(delay)
 
         state['vehicleState'] = self.getVehicleState()
-        time.sleep(INTER_CMD_DELAY)
+        time.sleep(delay)
 
         state['driveState'] = self.getDriveState()
+        for tableName, sample in state.items():
+            self._remember(tableName, sample)
+        return state
+
+    async def getCarStateAsync(self, client):
+        ''' Coroutine that does the same thing as getCarState(), making its
+            requests through the given ApiClient (which limits their rate and
+            concurrency).
+        '''
+        mode = self.settings['snapshotMode']
+        if mode == "vehicleData":
+            data = await self.getVehicleDataAsync(client)
+            if data:
+                return {t: self._remember(t, data.get(apiName))
+                        for t, apiName in TABLES_NAME_MAP.items()}
+            sys.stderr.write(f"WARNING: failed to get vehicle data for '{self.vin}'; getting tables\n")
+            mode = "concurrent"
+        if mode == "concurrent":
+            samples = await self.getTablesAsync(client, list(TABLES_NAME_MAP))
+            return dict(zip(TABLES_NAME_MAP, samples))
+
+        # N.B. the rate limiter (if any) paces the requests, so don't sleep
+        delay = 0 if client.limiter else INTER_CMD_DELAY
+        state = {}
+        for tableName in SERIAL_ORDER:
+            if state:
+                await asyncio.sleep(delay)
+            state[tableName] = await self.getTableAsync(client, tableName)
         return state
 
 #
 # TESTING
 #
 if __name__ == '__main__':
-    #### TODO implement test cases
-    pass
+    class HTTPError(Exception):
+        def __init__(self, code):
+            super().__init__(f"HTTP Error {code}")
+            self.code = code
+
+    class TestVehicle(dict):
+        def __init__(self, responses):
+            super().__init__(display_name="test")
+            self.responses = list(responses)
+            self.requests = 0
+
+        def data_request(self, name):
+            self.requests += 1
+            r = self.responses.pop(0) if self.responses else {'timestamp': 1}
+            if isinstance(r, Exception):
+                raise r
+            return r
+
+    settings = {'retry': {'retries': 2, 'baseDelay': 0.01},
+                'breaker': {'failures': 3, 'resetTime': 0.2}}
+
+    # retried server errors and empty responses, then succeeds
+    v = TestVehicle([HTTPError(503), None, {'timestamp': 2}])
+    car = Car("VIN", {}, v, settings)
+    print(f"Retried: {car.getDriveState()} after {v.requests} requests")
+
+    # asleep and bad requests aren't retried
+    for e in (HTTPError(408), HTTPError(404)):
+        v = TestVehicle([e])
+        car = Car("VIN", {}, v, settings)
+        print(f"{classifyError(e)}: {car.getDriveState()} after {v.requests} requests")
+
+    # a car that always fails opens its breaker, and is only probed afterwards
+    v = TestVehicle([None] * 100)
+    car = Car("VIN", {}, v, settings)
+    for _ in range(3):
+        car.getDriveState()
+    print(f"Breaker open: {car.breaker.isOpen()} after {v.requests} requests")
+    n = v.requests
+    car.getDriveState()
+    time.sleep(0.2)
+    v.responses = []
+    print(f"Probe: {car.getDriveState()}, requests while open: {v.requests - n}, open: {car.breaker.isOpen()}")
+
+    # the async requests go through the client for each attempt (i.e., each
+    #  one is rate limited), and wait to retry on the loop
+    class TestClient(object):
+        limiter = None
+
+        def __init__(self):
+            self.calls = 0
+
+        async def call(self, func, *args, priority=None, tokens=1):
+            self.calls += 1
+            return func(*args)
+
+    v = TestVehicle([HTTPError(503), None, {'timestamp': 3}])
+    car = Car("VIN", {}, v, settings)
+    client = TestClient()
+    print(f"Async retried: {asyncio.run(car.getTableAsync(client, 'driveState'))} after {client.calls} calls")
+
+    # nothing goes through the client while the breaker is open
+    v = TestVehicle([None] * 100)
+    car = Car("VIN", {}, v, settings)
+    for _ in range(3):
+        car.getDriveState()
+    client = TestClient()
+    samples = asyncio.run(car.getTablesAsync(client, ['driveState', 'chargeState']))
+    print(f"Async while open: {samples} after {client.calls} calls, last error: {car.lastError('driveState')}")
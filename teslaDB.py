@@ -7,33 +7,115 @@
 '''
 
 import argparse
+import collections
+import copy
 import json
 import os
+import queue
 import sqlite3
 import sys
-
-
-#### TODO
-####  * Version the schema and put in checks
-
-#### FIXME figure out how to deal with the new nested objects in the schema
-####        e.g., recursively flatten out the json object, prepend the name
+import threading
+import time
+
+import metrics
+from schemaCompiler import SEPARATOR, SQL_TYPE_MAP, TYPE_MAP, TableLayout
+from schemaCompiler import addField, compileSchema, inferType
+
+
+# N.B. values that turn into lists or objects are stored as JSON, rather than
+#      failing the whole batch of inserts
+sqlite3.register_adapter(dict, json.dumps)
+sqlite3.register_adapter(list, json.dumps)
+
+# Default settings for a CarDB
+#  * batchSize: number of buffered rows that forces a flush (1 => commit each row)
+#  * batchAge: max number of seconds a buffered row waits before being flushed
+#  * journalMode: Sqlite3 journal mode (e.g., "WAL", "DELETE")
+#  * synchronous: Sqlite3 synchronous setting (e.g., "NORMAL", "FULL")
+#  * mmapSize: max number of bytes of the DB file to memory map (0 => none)
+#  * cacheSize: Sqlite3 page cache size (pages if >0, KiB if <0, 0 => default)
+#  * writerThread: if True, all writes are done by a dedicated thread
+#  * queueSize: max number of rows queued for the writer thread
+#  * deltaLogging: if True, only store rows that differ from the previous one
+#  * volatileFields: fields that are ignored when comparing rows
+#  * schemaEvolution: what to do with fields that aren't in the schema --
+#    "alter" adds columns for them, "overflow" puts them (as JSON) in the
+#    table's overflow column
+DEF_DB_SETTINGS = {
+    'batchSize': 1,
+    'batchAge': 0,
+    'journalMode': "WAL",
+    'synchronous': "NORMAL",
+    'mmapSize': 0,
+    'cacheSize': 0,
+    'writerThread': False,
+    'queueSize': 1000,
+    'deltaLogging': False,
+    'volatileFields': ['timestamp', 'gps_as_of'],
+    'schemaEvolution': "alter"
+}
+
+SCHEMA_EVOLUTIONS = ("alter", "overflow")
+
+# column that holds the (inclusive) end of the time span for which a row is
+#  valid, in the units of the 'timestamp' column
+VALID_UNTIL_COL = "valid_until"
+
+# column that holds (a JSON object with) the fields of a row that don't have
+#  their own columns
+OVERFLOW_COL = "overflow"
+
+# table that records the versions of the layouts of the other tables
+SCHEMA_TABLE = "_schema"
+
+# columns (in addition to 'timestamp') that are indexed in specific tables
+INDEXED_COLUMNS = {
+    'driveState': ['gps_as_of']
+}
+
+# default number of rows fetched at a time by queries
+DEF_QUERY_CHUNK = 256
+
+# message sent to the writer thread to make it flush and exit
+_STOP_WRITER = None
 
 
 class CarDB(object):
     '''Object that encapsulates the Sqlite3 DB that contains data from a car,
     '''
-    TYPE_MAP = {
-        'integer': "INTEGER",
-        'number': "REAL",
-        'boolean': "INTEGER",
-        'string': "TEXT"
-    }
-
-    def __init__(self, vin, dbFile, schema, create=True):
+    TYPE_MAP = TYPE_MAP
+
+    def __init__(self, vin, dbFile, schema, create=True, settings=None):
         ''' Instantiate a DB object for the car given by the VIN and connect to
             the given DB file.
 
+            Rows are buffered and written with one transaction per flush,
+            where a flush happens when the number of buffered rows reaches
+            'batchSize', when the oldest buffered row is older than 'batchAge'
+            seconds, or when the DB is closed.
+
+            If the 'writerThread' setting is True, rows are handed to a
+            dedicated writer thread (with its own connection) through a bounded
+            queue, so callers never block on the disk.  If the queue is full,
+            the row is dropped (and counted in the stats).  The connection
+            owned by this object is then only used for reads, which don't
+            block the writer when the DB is in WAL mode.
+
+            If the 'deltaLogging' setting is True, a row that only differs from
+            the previous row of its table in the 'volatileFields' is not
+            stored, and instead the previous row's 'valid_until' column is
+            advanced to the new row's timestamp.  Use getSeries() to rebuild
+            the full time series from a delta-logged table.
+
+            The fields of nested objects in the schema are stored in columns
+            named '<parent>__<child>' (see schemaCompiler.py).
+
+            Fields that the Tesla API adds are handled as given by the
+            'schemaEvolution' setting: either columns are added for them, or
+            they're put in the table's overflow column.  Fields it drops are
+            stored as NULLs.  Each change of a table's columns is recorded as
+            a new version in the '_schema' table (see getSchemaVersions()).
+
             Inputs
                 vin: VIN string for a car
                 dbFile: Path to a Sqlite3 DB file (created if doesn't exist)
@@ -41,6 +123,8 @@ class CarDB(object):
                     the Tesla API (that will become tables in the DB)
                 create: If True, creates file if not found, otherwise fails if
                     file not found.
+                settings: optional dict of settings that override the
+                    defaults in DEF_DB_SETTINGS
             Returns
                 car DB object
         '''
@@ -51,22 +135,64 @@ class CarDB(object):
                 raise ValueError(f"Invalid DB file: {dbFile}")
         self.dbFile = dbFile
 
-        self.db = sqlite3.connect(dbFile)
-        self.cursors = {}
+        self.settings = dict(DEF_DB_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        if self.settings['schemaEvolution'] not in SCHEMA_EVOLUTIONS:
+            raise ValueError(f"Invalid schema evolution '{self.settings['schemaEvolution']}'")
 
-        self.schema = schema
+        self.db = self._connect()
+        self.cursors = {}
+        self.columns = {}
+        self.insertCmds = {}
+        self.extractors = {}
+        self.rowTypes = {}
+
+        self.pending = {}
+        self.pendingRows = 0
+        self.pendingSince = None
+
+        self.volatileFields = set(self.settings['volatileFields'])
+        self.volatileFields.add(VALID_UNTIL_COL)
+        self.lastRows = {}
+        self.lastPending = {}
+        self.pendingUntil = {}
+        self.stats = {
+            'commits': 0,
+            'rows': 0,
+            'droppedRows': 0,
+            'commitTime': 0.0,
+            'lastCommitTime': 0.0,
+            'maxCommitTime': 0.0,
+            'addedColumns': 0,
+            'overflowRows': 0
+        }
+        self.statsLock = threading.Lock()
 
-        #### TODO validate schema version
+        # N.B. the schema is changed as the tables evolve, and it's shared
+        self.schema = copy.deepcopy(schema)
+        self.newColumns = {}
 
         if 'tables' not in self.schema:
             raise Exception("'tables' field missing from schema")
-        for tableName in self.schema['tables'].keys():
-            cols = "id INTEGER PRIMARY KEY"
-            keyList = self.schema['tables'][tableName]['properties'].keys()
-            for colName in sorted(keyList):
-                colType = CarDB.TYPE_MAP[self.schema['tables'][tableName]['properties'][colName]['type']]
-                cols += f", {colName} {colType}"
-            self.createTable(tableName, cols)
+        self.extraColumns = [(VALID_UNTIL_COL, "INTEGER"), (OVERFLOW_COL, "TEXT")]
+        self.layouts = compileSchema(self.schema, self.extraColumns)
+        self.createTable(SCHEMA_TABLE, "version INTEGER PRIMARY KEY, tableName TEXT, "
+                                       "schemaVersion TEXT, columns TEXT, "
+                                       "changedAt REAL, change TEXT")
+        for tableName, layout in self.layouts.items():
+            self.createTable(tableName, "id INTEGER PRIMARY KEY, " + layout.columnDefs())
+            self._syncColumns(tableName)
+            for colName in ['timestamp'] + INDEXED_COLUMNS.get(tableName, []):
+                self.createIndex(tableName, colName)
+            self.pending[tableName] = []
+        self.db.commit()
+
+        # N.B. the writer thread is started on first use, so a DB can be
+        #      created before the tracker processes are forked
+        self.writeQ = None
+        self.writer = None
+        self.writerPid = None
 
     def __enter__(self):
         return self
@@ -74,9 +200,135 @@ class CarDB(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def _startWriter(self):
+        # N.B. threads don't survive a fork, so restart it in a new process
+        if self.writer and self.writerPid == os.getpid():
+            return
+        self.writerPid = os.getpid()
+        self.writeQ = queue.Queue(maxsize=self.settings['queueSize'])
+        self.writer = threading.Thread(target=self._writerLoop,
+                                       name=f"CarDB-{self.vin}", daemon=True)
+        self.writer.start()
+
+    def _hasWriter(self):
+        return self.writer is not None and self.writerPid == os.getpid()
+
     def close(self):
+        if self._hasWriter():
+            self.writeQ.put(_STOP_WRITER)
+            self.writer.join()
+            self.writer = None
+        else:
+            self._flush(self.db)
         self.db.close()
 
+    def _connect(self):
+        ''' Open a connection to the DB file and apply the storage settings.
+
+            Returns
+              Sqlite3 connection object
+        '''
+        db = sqlite3.connect(self.dbFile, check_same_thread=False)
+        if self.settings['journalMode']:
+            db.execute(f"PRAGMA journal_mode={self.settings['journalMode']};")
+        if self.settings['synchronous']:
+            db.execute(f"PRAGMA synchronous={self.settings['synchronous']};")
+        if self.settings['mmapSize']:
+            db.execute(f"PRAGMA mmap_size={int(self.settings['mmapSize'])};")
+        if self.settings['cacheSize']:
+            db.execute(f"PRAGMA cache_size={int(self.settings['cacheSize'])};")
+        return db
+
+    def _setLayout(self, tableName, layout):
+        self.layouts[tableName] = layout
+        self.columns[tableName] = layout.columns
+        self.insertCmds[tableName] = layout.insertCmd
+        self.extractors[tableName] = layout.extract
+
+    def _syncColumns(self, tableName):
+        ''' Make a table's layout and its columns in the DB match, by adding
+            the columns that are missing from the DB file (e.g., it was created
+            by earlier versions of this code), and adding the columns that were
+            added to the DB file (e.g., by schema evolution) to the layout.
+        '''
+        c = self.db.cursor()
+        dbCols = {r[1]: r[2] for r in c.execute(f'PRAGMA table_info("{tableName}");')}
+        tableSchema = self.schema['tables'][tableName]
+        added = False
+        for colName, colType in dbCols.items():
+            if colName != 'id' and colName not in self.layouts[tableName].columns:
+                addField(tableSchema, tuple(colName.split(SEPARATOR)),
+                         SQL_TYPE_MAP.get(colType.upper(), 'string'))
+                added = True
+        if added:
+            self._setLayout(tableName, TableLayout(tableName, tableSchema, self.extraColumns))
+        layout = self.layouts[tableName]
+        self._setLayout(tableName, layout)
+        for colName, colType in zip(layout.columns, layout.types):
+            if colName not in dbCols:
+                c.execute(f'ALTER TABLE "{tableName}" ADD COLUMN "{colName}" {colType};')
+        self._recordSchema(self.db, tableName, "opened")
+
+    def _recordSchema(self, db, tableName, change):
+        ''' Add a version to the '_schema' table for a table if its columns
+            changed since the last version recorded.
+        '''
+        columns = json.dumps(self.columns[tableName])
+        r = db.execute(f'SELECT columns FROM "{SCHEMA_TABLE}" WHERE tableName = ? '
+                       f'ORDER BY version DESC LIMIT 1;', (tableName,)).fetchone()
+        if r is None or r[0] != columns:
+            db.execute(f'INSERT INTO "{SCHEMA_TABLE}" (tableName, schemaVersion, columns, '
+                       f'changedAt, change) VALUES (?, ?, ?, ?, ?);',
+                       (tableName, self.schema.get('info', {}).get('version'), columns,
+                        time.time(), change))
+
+    def getSchemaVersions(self, tableName=None):
+        ''' Return a list of the recorded versions of the layouts of the
+            tables (or the given table), in order.
+
+            Returns
+              List of dicts with the 'version', 'tableName', 'schemaVersion'
+              (i.e., of the schema file), 'columns', 'changedAt' (secs since
+              the epoch), and 'change' of each version
+        '''
+        sqlCmd = f'SELECT version, tableName, schemaVersion, columns, changedAt, change FROM "{SCHEMA_TABLE}"'
+        args = ()
+        if tableName:
+            sqlCmd += " WHERE tableName = ?"
+            args = (tableName,)
+        rows = self.db.execute(sqlCmd + " ORDER BY version;", args).fetchall()
+        keys = ('version', 'tableName', 'schemaVersion', 'columns', 'changedAt', 'change')
+        versions = [dict(zip(keys, r)) for r in rows]
+        for v in versions:
+            v['columns'] = json.loads(v['columns'])
+        return versions
+
+    def _writerLoop(self):
+        ''' Body of the writer thread: take rows off the write queue, buffer
+            them, and flush them with the writer's own connection.
+        '''
+        db = self._connect()
+        while True:
+            timeout = None
+            if self.pendingSince is not None:
+                timeout = max(0.0, self.pendingSince + self.settings['batchAge'] - time.time())
+            try:
+                item = self.writeQ.get(True, timeout)
+            except queue.Empty:
+                self._flush(db)
+                continue
+            if item is _STOP_WRITER:
+                break
+            if isinstance(item, threading.Event):
+                self._flush(db)
+                item.set()
+                continue
+            self._bufferRow(*item)
+            if self.pendingRows >= self.settings['batchSize']:
+                self._flush(db)
+        self._flush(db)
+        db.close()
+
     def createTable(self, tableName, tableCols):
         ''' Take name and the SQL column defintions for a Table and create it in
             the DB.
@@ -91,6 +343,143 @@ class CarDB(object):
         c.execute(tableDef)
         self.db.commit()
 
+    def createIndex(self, tableName, colName):
+        ''' Create an index on the given column of a table, if one doesn't
+            already exist.
+
+            Inputs
+              tableName: String with name of the table
+              colName: String with name of the column to be indexed
+        '''
+        c = self.db.cursor()
+        c.execute(f'CREATE INDEX IF NOT EXISTS "{tableName}_{colName}_idx" '
+                  f'ON "{tableName}" ({colName});')
+        self.db.commit()
+
+    def query(self, tableName, start=None, end=None, columns=None,
+              timeColumn='timestamp', namedTuples=False, chunkSize=DEF_QUERY_CHUNK):
+        ''' Generator that streams the rows of a table whose time lies within
+            a given (inclusive) range, in time order.
+
+            Rows are fetched from the DB in chunks of bounded size, so the
+            whole table is never held in memory.  When querying on 'timestamp'
+            a delta-logged row that starts before the range, but is still valid
+            at its start, is also returned.
+
+            Inputs
+              tableName: String with name of table to be read
+              start: optional start of the time range, in the units of the
+                time column (i.e., ms for 'timestamp' and secs for 'gps_as_of')
+              end: optional end of the time range, in the same units as start
+              columns: optional list of the names of the columns to return
+                (defaults to all of them)
+              timeColumn: name of the (indexed) column that holds the time
+              namedTuples: if True, return rows as named tuples, otherwise as
+                dicts
+              chunkSize: max number of rows to fetch from the DB at a time
+
+            Returns
+              An iterator that returns one row at a time
+        '''
+        if tableName not in self.columns:
+            raise ValueError(f"Unknown table '{tableName}'")
+        validCols = set(self.columns[tableName]) | set(['id'])
+        if columns is None:
+            columns = ['id'] + self.columns[tableName]
+        badCols = (set(columns) | set([timeColumn])) - validCols
+        if badCols:
+            raise ValueError(f"Unknown columns {badCols} for table '{tableName}'")
+        colNames = ", ".join(f'"{col}"' for col in columns)
+
+        rowType = None
+        if namedTuples:
+            key = (tableName, tuple(columns))
+            if key not in self.rowTypes:
+                self.rowTypes[key] = collections.namedtuple(tableName, columns)
+            rowType = self.rowTypes[key]
+
+        c = self.db.cursor()
+        if start is not None and timeColumn == 'timestamp':
+            sqlCmd = (f'SELECT {colNames} FROM "{tableName}" WHERE timestamp < ? '
+                      f'AND {VALID_UNTIL_COL} >= ? ORDER BY timestamp DESC LIMIT 1;')
+            r = c.execute(sqlCmd, (start, start)).fetchone()
+            if r is not None:
+                yield rowType._make(r) if rowType else dict(zip(columns, r))
+
+        conds = []
+        args = []
+        if start is not None:
+            conds.append(f"{timeColumn} >= ?")
+            args.append(start)
+        if end is not None:
+            conds.append(f"{timeColumn} <= ?")
+            args.append(end)
+        where = f" WHERE {' AND '.join(conds)}" if conds else ""
+        sqlCmd = f'SELECT {colNames} FROM "{tableName}"{where} ORDER BY {timeColumn};'
+        c.execute(sqlCmd, args)
+        while True:
+            rows = c.fetchmany(chunkSize)
+            if not rows:
+                break
+            for r in rows:
+                yield rowType._make(r) if rowType else dict(zip(columns, r))
+
+    def getLatest(self, tableName):
+        ''' Return the most recent row of a table, as a dict whose keys are the
+            table's schema fields (with nested objects, as they come from the
+            Tesla API), or None if the table is empty.
+
+            N.B. rows that haven't been flushed yet aren't seen
+
+            Inputs
+              tableName: String with name of table to be read
+        '''
+        if tableName not in self.columns:
+            raise ValueError(f"Unknown table '{tableName}'")
+        colNames = ", ".join(f'"{col}"' for col in self.columns[tableName])
+        c = self.db.cursor()
+        r = c.execute(f'SELECT {colNames} FROM "{tableName}" ORDER BY timestamp DESC LIMIT 1;').fetchone()
+        if r is None:
+            return None
+        row = self.layouts[tableName].unflatten(r)
+        del row[VALID_UNTIL_COL]
+        return row
+
+    def getLatestId(self, tableName):
+        ''' Return the id of the most recently stored row of a table, or None
+            if the table is empty.
+
+            N.B. with delta logging this row's 'valid_until' is still advanced
+                 by new rows, so it mustn't be moved out of the DB
+        '''
+        if tableName not in self.columns:
+            raise ValueError(f"Unknown table '{tableName}'")
+        return self.db.execute(f'SELECT MAX(id) FROM "{tableName}";').fetchone()[0]
+
+    def deleteRows(self, tableName, ids):
+        ''' Delete the rows with the given ids from a table, in a single
+            transaction.
+
+            Inputs
+              tableName: String with name of table to delete rows from
+              ids: iterable of the ids of the rows to be deleted
+
+            Returns
+              Number of rows deleted
+        '''
+        if tableName not in self.columns:
+            raise ValueError(f"Unknown table '{tableName}'")
+        with self.db:
+            c = self.db.executemany(f'DELETE FROM "{tableName}" WHERE id = ?;',
+                                    ((i,) for i in ids))
+        return c.rowcount
+
+    def vacuum(self):
+        ''' Rebuild the DB file, to give the space freed by deleted rows back
+            to the file system.
+        '''
+        self.db.execute("VACUUM;")
+
     def getTable(self, tableName):
         '''Take name of table and return its rows in a dict.
 
@@ -126,7 +515,8 @@ class CarDB(object):
         return (str(t[0]) for t in r)
 
     def insertRow(self, tableName, row):
-        ''' Take name of table and a row of data and insert it into the table.
+        ''' Take name of table and a row of data and add it to the write buffer,
+            flushing the buffer if it is full or too old.
 
             Inputs
               tableName: String with name of table to be created
@@ -135,12 +525,214 @@ class CarDB(object):
         if not row:
             sys.stderr.write(f"WARNING: empty row for table '{tableName}'; skipping...\n")
             return
-        c = self.db.cursor()
-        cols = ", ".join('"{}"'.format(col) for col in row.keys())
-        vals = ", ".join(':{}'.format(col) for col in row.keys())
-        sqlCmd = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(tableName, cols, vals)
-        c.execute(sqlCmd, row)
-        self.db.commit()
+        if tableName not in self.pending:
+            raise ValueError(f"Unknown table '{tableName}'")
+        start = time.perf_counter()
+        if self.settings['writerThread']:
+            self._startWriter()
+            try:
+                self.writeQ.put_nowait((tableName, row))
+            except queue.Full:
+                with self.statsLock:
+                    self.stats['droppedRows'] += 1
+                metrics.inc('teslawatch_db_dropped_rows_total', {'vin': self.vin})
+        else:
+            self._bufferRow(tableName, row)
+            self.checkFlush()
+        metrics.observe('teslawatch_db_insert_seconds', time.perf_counter() - start,
+                        {'vin': self.vin})
+        metrics.inc('teslawatch_db_rows_total', {'vin': self.vin, 'table': tableName})
+
+    def _bufferRow(self, tableName, row):
+        ''' Add a row to the write buffer (of whichever thread does the writes).
+
+            With delta logging, a row that is unchanged from the previous one
+            only extends the previous row's 'valid_until' value.
+        '''
+        if not self.layouts[tableName].covers(row):
+            row = self._evolve(tableName, row)
+        if self.settings['deltaLogging']:
+            last = self.lastRows.get(tableName)
+            until = row.get('timestamp')
+            if last is not None and self._unchanged(last, row):
+                last[VALID_UNTIL_COL] = until
+                if not self.lastPending[tableName]:
+                    self.pendingUntil[tableName] = until
+                    if self.pendingSince is None:
+                        self.pendingSince = time.time()
+                return
+            row = dict(row)
+            row[VALID_UNTIL_COL] = until
+            self.lastRows[tableName] = row
+            self.lastPending[tableName] = True
+        self.pending[tableName].append(row)
+        self.pendingRows += 1
+        if self.pendingSince is None:
+            self.pendingSince = time.time()
+
+    def _evolve(self, tableName, row):
+        ''' Take a row with fields that the table doesn't have columns for,
+            and either add the columns (to be created on the next flush), or
+            put the fields in the row's overflow column.
+
+            Returns
+              the row, with its overflow column set (if needed)
+        '''
+        layout = self.layouts[tableName]
+        tableSchema = self.schema['tables'][tableName]
+        overflow = {}
+        added = []
+        for path, value in layout.unknownFields(row):
+            fieldType = inferType(value)
+            if fieldType is None:
+                # N.B. can't tell what type of column a null needs
+                continue
+            conflict = any(path[:i] in layout.leafPaths for i in range(1, len(path)))
+            if self.settings['schemaEvolution'] == "overflow" or conflict:
+                overflow[SEPARATOR.join(path)] = value
+            else:
+                addField(tableSchema, path, fieldType)
+                added.append(SEPARATOR.join(path))
+        if added:
+            layout = TableLayout(tableName, tableSchema, self.extraColumns)
+            cols = self.newColumns.setdefault(tableName, [])
+            for colName in added:
+                cols.append((colName, layout.types[layout.columns.index(colName)]))
+            self._setLayout(tableName, layout)
+            sys.stderr.write(f"WARNING: added columns {added} to table '{tableName}'\n")
+            with self.statsLock:
+                self.stats['addedColumns'] += len(added)
+        if overflow:
+            row = dict(row)
+            row[OVERFLOW_COL] = overflow
+            with self.statsLock:
+                self.stats['overflowRows'] += 1
+        return row
+
+    def _unchanged(self, last, row):
+        ''' Return True if the given row has the same non-volatile fields as
+            the last row stored for a table.
+        '''
+        volatile = self.volatileFields
+        for k, v in row.items():
+            if k not in volatile and (k not in last or last[k] != v):
+                return False
+        for k in last:
+            if k not in volatile and k not in row:
+                return False
+        return True
+
+    def checkFlush(self, now=None):
+        ''' Flush the write buffer if it holds at least 'batchSize' rows, or if
+            its oldest row has waited at least 'batchAge' seconds.
+
+            This should be called periodically by users of buffered DBs so that
+            age-based flushes happen even when no new rows are arriving.  It
+            does nothing when using the writer thread, which handles this
+            itself.
+
+            Inputs
+              now: optional current time (in seconds since the epoch)
+        '''
+        if self.settings['writerThread'] or self.pendingSince is None:
+            return
+        if now is None:
+            now = time.time()
+        if ((self.pendingRows >= self.settings['batchSize']) or
+                (now - self.pendingSince >= self.settings['batchAge'])):
+            self._flush(self.db)
+
+    def flush(self):
+        ''' Write all buffered rows to the DB, waiting for the writer thread to
+            do it if there is one.
+        '''
+        if self._hasWriter():
+            done = threading.Event()
+            self.writeQ.put(done)
+            done.wait()
+        else:
+            self._flush(self.db)
+
+    def _flush(self, db):
+        ''' Write all buffered rows to the DB in a single transaction, using one
+            prepared INSERT statement per table.
+
+            Inputs
+              db: the connection to write with
+
+            Returns
+              Number of rows written
+        '''
+        if self.pendingSince is None:
+            return 0
+        numRows = self.pendingRows
+        start = time.perf_counter()
+        try:
+            with db:
+                # N.B. sqlite3 doesn't open a transaction for DDL statements, so
+                #      begin one explicitly to roll back the added columns too
+                if not db.in_transaction:
+                    db.execute("BEGIN;")
+                for tableName, cols in self.newColumns.items():
+                    for colName, colType in cols:
+                        db.execute(f'ALTER TABLE "{tableName}" ADD COLUMN "{colName}" {colType};')
+                    self._recordSchema(db, tableName, "added " + ", ".join(c for c, _ in cols))
+                # N.B. must update the previously stored rows before any new
+                #      rows are added to their tables
+                for tableName, until in self.pendingUntil.items():
+                    db.execute(f'UPDATE "{tableName}" SET {VALID_UNTIL_COL} = ? '
+                               f'WHERE id = (SELECT MAX(id) FROM "{tableName}")', (until,))
+                for tableName, rows in self.pending.items():
+                    if rows:
+                        db.executemany(self.insertCmds[tableName],
+                                       map(self.extractors[tableName], rows))
+        except sqlite3.Error as e:
+            sys.stderr.write(f"WARNING: failed to write {numRows} rows to DB '{self.dbFile}': {e}\n")
+            with self.statsLock:
+                self.stats['droppedRows'] += numRows
+            metrics.inc('teslawatch_db_dropped_rows_total', {'vin': self.vin}, numRows)
+            numRows = 0
+            # N.B. the last rows of these tables were dropped, so the next
+            #      rows for them must be stored in full
+            for tableName, rows in self.pending.items():
+                if rows:
+                    self.lastRows.pop(tableName, None)
+        else:
+            # N.B. the new columns are added again if their transaction failed
+            self.newColumns.clear()
+            elapsed = time.perf_counter() - start
+            with self.statsLock:
+                self.stats['commits'] += 1
+                self.stats['rows'] += numRows
+                self.stats['commitTime'] += elapsed
+                self.stats['lastCommitTime'] = elapsed
+                self.stats['maxCommitTime'] = max(self.stats['maxCommitTime'], elapsed)
+            metrics.observe('teslawatch_db_commit_seconds', elapsed, {'vin': self.vin})
+        for rows in self.pending.values():
+            rows.clear()
+        self.pendingUntil.clear()
+        for tableName in self.lastPending:
+            self.lastPending[tableName] = False
+        self.pendingRows = 0
+        self.pendingSince = None
+        return numRows
+
+    def getStats(self):
+        ''' Return a dict with the DB's write counters.
+
+            Returns
+              Dict with the number of commits, rows written, rows dropped,
+              rows still buffered or queued, mean number of rows per commit,
+              and the total/last/max/mean commit latency (in seconds)
+        '''
+        with self.statsLock:
+            stats = dict(self.stats)
+        stats['pendingRows'] = self.pendingRows
+        stats['queuedRows'] = self.writeQ.qsize() if self._hasWriter() else 0
+        commits = stats['commits']
+        stats['rowsPerCommit'] = (stats['rows'] / commits) if commits else 0.0
+        stats['meanCommitTime'] = (stats['commitTime'] / commits) if commits else 0.0
+        return stats
 
     def insertState(self, state):
         ''' Take dict with a row for each of one or more tables, and insert
@@ -156,6 +748,38 @@ class CarDB(object):
             except Exception as e:
                 sys.stderr.write("WARNING: failed to log row to table {0}: {1}\n".format(tableName, e))
 
+    def getSeries(self, tableName, interval=None):
+        ''' Generator that rebuilds the time series of a (delta-logged) table.
+
+            Inputs
+              tableName: String with name of table to be read
+              interval: optional sample interval (in the units of the
+                'timestamp' column).  If given, each stored row is repeated
+                every interval from its timestamp up to its 'valid_until'
+                time, with the 'timestamp' field set accordingly.
+
+            Returns
+              An iterator that returns one row (as a dict) at a time, in
+              timestamp order
+        '''
+        c = self.db.cursor()
+        c.execute(f'SELECT * FROM "{tableName}" ORDER BY timestamp;')
+        colNames = [d[0] for d in c.description]
+        for r in c:
+            row = dict(zip(colNames, r))
+            if not interval:
+                yield row
+                continue
+            until = row[VALID_UNTIL_COL]
+            if until is None:
+                until = row['timestamp']
+            ts = row['timestamp']
+            while ts <= until:
+                sample = dict(row)
+                sample['timestamp'] = ts
+                yield sample
+                ts += interval
+
     def getRows(self, tableName):
         ''' Take name of table and return an iterator on the table's rows.
 
@@ -194,7 +818,11 @@ if __name__ == '__main__':
     if not options.dbFile:
         fatalError("Must provide test DB file")
 
-    with CarDB(DUMMY_VIN, options.dbFile, options.schemaFile) as cdb:
+    import yaml
+    with open(options.schemaFile, "r") as f:
+        schema = yaml.load(f, Loader=yaml.Loader)
+
+    with CarDB(DUMMY_VIN, options.dbFile, schema) as cdb:
         tables = cdb.getTables()
         print("Tables: {0}".format(tables))
 
@@ -225,5 +853,9 @@ if __name__ == '__main__':
             json.dump(dsTable, sys.stdout, indent=4, sort_keys=True)
             print("")
 
+        cdb.flush()
+
         for row in cdb.getRows('driveState'):
             print(row)
+
+        print("Stats: {0}".format(cdb.getStats()))
@@ -21,25 +21,33 @@
 
 import argparse
 import collections
+import copy
 import json
 import logging
 import multiprocessing as mp
 import os
-import queue
-import random
 import signal
 import sys
+import threading
 import time
+import traceback
 
 import yaml
 
 import teslajson
 
-from notifier import Notifier
+from asyncEngine import AsyncEngine, DEF_MAX_CONCURRENT
+from dispatcher import Dispatcher
+from geoCache import GeocodeCache
+from ipc import Channel, Hub, command, formatMessage
+from metrics import DEF_METRICS_SETTINGS, MetricsServer, Publisher
+from notifier import DEF_WINDOW, EventBatcher, Notifier, loadPlugins
+from rateLimiter import AsyncTokenBucket, SharedTokenBucket
 from regions import Region
+from stateStore import DEF_STATE_SETTINGS, StateServer, StateStore, UnixStateServer
 from teslaCar import Car
 import teslaDB
-from teslawatch import fatalError, dictMerge
+from teslawatch import fatalError, dictDiff, dictMerge, geocoder
 from tracker import Tracker
 
 '''
@@ -55,9 +63,32 @@ DEF_SCHEMA_FILE = "./dbSchema.yml"
 
 DEF_LOG_LEVEL = "WARNING"
 
+# name of the file (in the DB directory) that holds cached place names
+GEOCACHE_FILE = "geocache.db"
+
+# name of the file (in the DB directory) that failed notifications are logged to
+DEAD_LETTER_FILE = "deadLetters.jsonl"
+
+# ways of running the trackers: one process per car, or all cars on a single
+#  asyncio event loop
+ENGINES = ("process", "async")
+DEF_ENGINE = "process"
+
 # Default
 # Includes intervals between samples of the Tesla API (quantized to integer
 #  multiples of the min time), given in units of seconds, and thresholds
+# The 'stateIntervals' override the default intervals when the car is in a
+#  given state (see scheduler.CAR_STATES), 'nightHours' gives the [start, end)
+#  local hours when a parked car is considered to be in the 'night' state,
+#  and 'home' can give the location (and radius in Km) of the car's home --
+#  e.g., {'latitude': 37.46, 'longitude': -122.16, 'radius': 0.1}
+# The 'sleep' settings stop the data requests of a car that has been parked
+#  for 'idleTime' secs, so it can fall asleep, after which its state is
+#  checked in the vehicle list every 'checkInterval' secs (see tracker.py)
+# The 'regionMargin' (Km) and 'regionDwell' (secs) thresholds keep GPS jitter
+#  at the edge of a region from generating enter/exit events, and the
+#  'motionSamples' (count) and 'motionTime' (secs) thresholds debounce the
+#  car's changes between being parked, moving, and stopped
 #### FIXME
 #### TODO make more rational choices for these values
 DEF_SETTINGS = {
@@ -68,70 +99,898 @@ DEF_SETTINGS = {
         'guiSettings': 3 * 60,
         'vehicleState': 60
     },
+    'stateIntervals': {
+        'moving': {
+            'driveState': 1,
+            'vehicleState': 60
+        },
+        'charging': {
+            'chargeState': 60,
+            'driveState': 60
+        },
+        'parkedHome': {
+            'chargeState': 10 * 60,
+            'driveState': 60,
+            'vehicleState': 5 * 60
+        },
+        'parkedAway': {
+            'driveState': 15,
+            'vehicleState': 2 * 60
+        },
+        'night': {
+            'chargeState': 30 * 60,
+            'climateSettings': 60 * 60,
+            'driveState': 5 * 60,
+            'guiSettings': 60 * 60,
+            'vehicleState': 15 * 60
+        },
+        'asleep': {
+            'chargeState': 30 * 60,
+            'climateSettings': 60 * 60,
+            'driveState': 10 * 60,
+            'guiSettings': 60 * 60,
+            'vehicleState': 30 * 60
+        },
+        'probe': {
+            'chargeState': 60 * 60,
+            'climateSettings': 60 * 60,
+            'driveState': 5 * 60,
+            'guiSettings': 60 * 60,
+            'vehicleState': 60 * 60
+        }
+    },
+    'nightHours': [23, 6],
+    'home': None,
+    'sleep': {
+        'enabled': True,
+        'idleTime': 15 * 60,
+        'checkInterval': 60
+    },
     'thresholds': {
-        'distance': 0
+        'motionSamples': 2,
+        'motionTime': 10,
+        'regionMargin': 0.025,
+        'regionDwell': 30
+    }
+}
+
+
+# Default settings for the per-car DBs (override those in teslaDB)
+#  buffer rows and commit them in batches, at least every 'batchAge' seconds,
+#  from a dedicated writer thread, to a DB in WAL mode, and only store rows
+#  that changed (ignoring the timestamp fields)
+DEF_DB_SETTINGS = {
+    'batchSize': 100,
+    'batchAge': 30,
+    'journalMode': "WAL",
+    'synchronous': "NORMAL",
+    'mmapSize': 64 * 1024 * 1024,
+    'cacheSize': -8 * 1024,
+    'writerThread': True,
+    'queueSize': 1000,
+    'deltaLogging': True,
+    'volatileFields': ['timestamp', 'gps_as_of']
+}
+
+
+# Default settings for requests to the Tesla API
+#  * snapshotMode: how to get all of a car's tables (see teslaCar.SNAPSHOT_MODES)
+#  * maxRate: max number of requests per second (across all cars)
+#  * burst: max number of requests that can be made at once
+#  * retry: how failed requests are retried (see teslaCar.DEF_RETRY_SETTINGS)
+#  * breaker: when to stop making requests of a car that keep failing (see
+#    teslaCar.DEF_BREAKER_SETTINGS), which is then only polled in the
+#    'probe' state
+#  N.B. when the requests run low, those for less important tables (given by
+#       scheduler.TABLE_PRIORITIES) have to wait for the more important ones
+DEF_API_SETTINGS = {
+    'snapshotMode': "vehicleData",
+    'maxRate': 2.0,
+    'burst': 10,
+    'retry': {
+        'retries': 3,
+        'baseDelay': 1.0,
+        'maxDelay': 60.0,
+        'throttledFactor': 4.0
+    },
+    'breaker': {
+        'failures': 5,
+        'resetTime': 5 * 60
     }
 }
 
 
-def commandInterpreter(trackers, cmds, resps):
-    ''' TBD
+# Default settings for the supervisor of the trackers
+#  * baseDelay, maxDelay: a tracker that stops without being told to is
+#    restarted after a delay that doubles (from 'baseDelay' up to 'maxDelay'
+#    secs) with each consecutive failure
+#  * resetTime: number of secs a tracker has to run for before its failures
+#    are forgotten
+#  * stopTimeout: number of secs a tracker is given to stop, before it's
+#    terminated
+#  * checkInterval: max number of secs between checks of the trackers
+DEF_SUPERVISOR_SETTINGS = {
+    'baseDelay': 1.0,
+    'maxDelay': 5 * 60,
+    'resetTime': 10 * 60,
+    'stopTimeout': 30,
+    'checkInterval': 1.0
+}
+
+# parts of the configs (given as paths of keys) that are shared by all of the
+#  trackers (along with the DB schema), so all of them are restarted when any
+#  of these change
+SHARED_CONFIGS = (('dbSettings',),)
+
+# parts of the configs used by the master's notifier, which is replaced
+#  (without restarting any trackers) when any of these change
+NOTIFIER_CONFIGS = (('config', 'dispatcher'), ('config', 'notifierPlugins'),
+                    ('config', 'notifierWindow'), ('config', 'eventNotifiers'))
+
+# parts of the configs that are only used when starting, so changing them
+#  doesn't take effect until teslaWatch is restarted
+STATIC_CONFIGS = (('user',), ('passwd',), ('dbDir',), ('config', 'api'),
+                  ('config', 'apiConcurrency'), ('config', 'metrics'),
+                  ('config', 'stateApi'))
+
+# parts of a car's tracker configs (see trackerConfigs()) that can be applied
+#  to a running tracker, without restarting it
+RECONFIGURABLE = ('settings', 'regions')
+
+
+def getConfig(confs, path):
+    ''' Return the value at the given path (a tuple of keys) in the configs, or
+        None if there isn't one.
+    '''
+    for key in path:
+        if not isinstance(confs, dict):
+            return None
+        confs = confs.get(key)
+    return confs
+
+
+def loadConfigs(configsFile):
+    ''' Read the configs from the given (YAML) file, and return them.
+    '''
+    with open(configsFile, "r") as confsFile:
+        confs = list(yaml.load_all(confsFile, Loader=yaml.Loader))[0]
+    if not isinstance(confs, dict):
+        raise ValueError(f"Invalid configuration file: {configsFile}")
+    if not confs.get('config'):
+        confs['config'] = {}
+    if not confs.get('cars'):
+        confs['cars'] = {}
+    return confs
+
+
+def trackerConfigs(confs, vin):
+    ''' Return the parts of the configs that are used by the tracker of the
+        given car.
+
+        N.B. the settings given for a car (if any) override the global ones
+
+        Returns
+          dict with the car's configs (without its regions or settings), its
+          tracker's 'settings', and the specs of its 'regions'
+    '''
+    conf = confs['cars'][vin] or {}
+    settings = copy.deepcopy(DEF_SETTINGS)
+    dictMerge(settings, copy.deepcopy(getConfig(confs, ('config', 'settings')) or {}))
+    dictMerge(settings, copy.deepcopy(conf.get('settings') or {}))
+    return {
+        'car': {k: v for k, v in conf.items() if k not in ('regions', 'settings')},
+        'settings': settings,
+        'regions': conf.get('regions') or []
+    }
+
+
+def commandInterpreter(supervisor):
+    ''' Read commands from the console and hand them to the supervisor, until
+        told to quit (or the input ends).
     '''
-    #### TODO implement cmd interpreter and send cmds to running trackers to restart them and change their events
-    cmd = ""
     while True:
-        line = input("> ")
-        words = line.split(' ')
-        cmd = words[0].lower().strip()
+        try:
+            line = input("> ")
+        except EOFError:
+            break
+        words = line.split()
+        if not words:
+            continue
+        cmd = words[0].lower()
         args = words[1:]
-        if cmd == 'l':
-            print(f"Tracking: {trackers.keys()}")
-        if cmd == 'p':
-            vin = args[0]
-            if vin not in trackers:
-                print(f"ERROR: VIN '{vin}' not being tracked")
-            else:
-                print(dumpQueue(resps[vin]))
-        if cmd == 'r':
-            pass
-        if cmd == 's':
+        if cmd in ('p', 's'):
+            if not args or args[0] not in supervisor.cars:
+                print(f"ERROR: VIN '{args[0] if args else ''}' not being tracked")
+                continue
             vin = args[0]
-            if vin not in trackers:
-                print(f"ERROR: VIN '{vin}' not being tracked")
-            else:
-                cmds[vin].put("STOP")
-                #### TODO reread trackers
+        if cmd == 'l':
+            print(f"Tracking: {supervisor.running()}")
+        elif cmd == 'p':
+            for msg in supervisor.hub.drain(vin):
+                print(formatMessage(msg))
+        elif cmd == 'r':
+            supervisor.request("reload")
+        elif cmd == 's':
+            supervisor.request("stop", vin)
         elif cmd == 'q':
+            supervisor.request("quit")
             break
         elif cmd == '?' or cmd == 'h':
             print("Help:")
             print("    h: print this help message")
             print("    l: show VINs of cars being tracked")
             print("    p <vin>: print output from car given by <vin>")
-            print("    r: stop and restart all trackers, re-reading the configs file")
+            print("    r: re-read the configs file, and reconfigure or restart the trackers whose configs changed")
             print("    s <vin>: stop tracking the car given by <vin>")
-            print("    q: quit")
+            print("    q: stop all trackers and quit")
             print("    ?: print this help message")
-    return
 
 
-def dumpQueue(q):
-    ''' Return the contents of a given message queue.
+def runTracker(makeTracker, spec, conn, inherited=()):
+    ''' Create a tracker and run it, in a (newly forked) process.
+
+        N.B. the pipes the process inherited from the launcher are closed, so
+             they don't outlive it
+        N.B. signals (e.g., a Ctrl-C sent to the whole process group) are left
+             to the master, which stops the trackers
+
+        Inputs
+          makeTracker: function that creates the tracker from its spec, and
+            its end of the channel
+          spec: the tracker's spec (see Supervisor._trackerSpec())
+          conn: the tracker's end of the channel (a Connection)
+          inherited: list of objects (with a close() method) to be closed
     '''
-    result = []
-    try:
-        msg = q.get(True, 0.1)
-        while msg:
-            result.append(msg)
-            msg = q.get(True, 0.1)
-    except queue.Empty:
-        pass
-    return result
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    for obj in inherited:
+        obj.close()
+    makeTracker(spec, Channel(conn)).run()
+
+
+class Launcher(object):
+    ''' Object for the (single-threaded) process that forks the processes of
+        the trackers, when the master asks it to.
+
+        N.B. a process forked while other threads hold locks (e.g., the
+             master's hub, servers, and notifier) inherits the locks held, so
+             the launcher is forked before the master starts any threads
+        N.B. the trackers' objects (e.g., a Tesla API connection) can't be
+             pickled, so they're created in the trackers' processes, from
+             their (picklable) specs and the objects the launcher inherited
+    '''
+    def __init__(self, makeTracker):
+        ''' Fork the launcher process
+
+            Inputs
+              makeTracker: function that creates a tracker from its spec, and
+                its end of the channel (called in the tracker's process)
+        '''
+        self.exited = {}
+        self.alive = True
+        self.conn, conn = mp.Pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 0
+            try:
+                self.conn.close()
+                self._serve(conn, makeTracker)
+            except (EOFError, OSError):
+                # N.B. the master has gone away
+                pass
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        conn.close()
+
+    def start(self, vin, spec, channel):
+        ''' Start a tracker's process, and return its pid.
+
+            Inputs
+              vin: VIN of the tracker's car
+              spec: the tracker's spec
+              channel: the tracker's end of its channel, which is closed here
+                (once the launcher has it)
+        '''
+        try:
+            self.conn.send(("start", vin, spec))
+            mp.reduction.send_handle(self.conn, channel.conn.fileno(), self.pid)
+        finally:
+            channel.close()
+        while True:
+            reply = self._recv()
+            if reply[0] == "started":
+                return reply[1]
+            if reply[0] == "failed":
+                raise RuntimeError(reply[1])
+
+    def kill(self, pid):
+        ''' Terminate a tracker's process.
+        '''
+        self.conn.send(("kill", pid))
+
+    def poll(self):
+        ''' Take the launcher's reports of the tracker processes that exited,
+            without waiting for any.
+        '''
+        try:
+            while self.alive and self.conn.poll():
+                self._recv()
+        except (EOFError, OSError):
+            self.alive = False
+
+    def isRunning(self, pid):
+        ''' Return True if the tracker process with the given pid hasn't
+            exited (and the launcher is still running).
+        '''
+        self.poll()
+        return self.alive and pid not in self.exited
+
+    def forget(self, pid):
+        ''' Return the exit code of a tracker process that exited, and
+            forget about it.
+        '''
+        return self.exited.pop(pid, None)
+
+    def close(self):
+        ''' Stop the launcher (once all of the trackers have stopped).
+        '''
+        try:
+            self.conn.send(("quit",))
+        except OSError:
+            pass
+        self.conn.close()
+        os.waitpid(self.pid, 0)
+
+    def _recv(self):
+        msg = self.conn.recv()
+        if msg[0] == "exited":
+            self.exited[msg[1]] = msg[2]
+        return msg
+
+    def _serve(self, conn, makeTracker):
+        ''' Fork the trackers' processes when asked to, and report those that
+            exited, until told to quit (or the master goes away).
+        '''
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        procs = {}
+        while True:
+            for sentinel in mp.connection.wait([conn] + list(procs)):
+                if sentinel is not conn:
+                    proc = procs.pop(sentinel)
+                    proc.join()
+                    conn.send(("exited", proc.pid, proc.exitcode))
+                    continue
+                req = conn.recv()
+                if req[0] == "start":
+                    trackerConn = mp.connection.Connection(mp.reduction.recv_handle(conn))
+                    try:
+                        proc = mp.Process(target=runTracker,
+                                          args=(makeTracker, req[2], trackerConn, (conn,)),
+                                          name=f"tracker-{req[1]}")
+                        proc.start()
+                    except Exception as e:
+                        conn.send(("failed", str(e)))
+                        continue
+                    finally:
+                        # N.B. only the tracker's process uses its end of the
+                        #      channel
+                        trackerConn.close()
+                    procs[proc.sentinel] = proc
+                    conn.send(("started", proc.pid))
+                elif req[0] == "kill":
+                    for proc in procs.values():
+                        if proc.pid == req[1]:
+                            proc.terminate()
+                elif req[0] == "quit":
+                    return
+
+
+class Supervisor(object):
+    ''' Object that runs the trackers of the cars (with either engine), restarts
+        those that fail (with backoff), and reloads the configs when asked to,
+        reconfiguring, restarting, starting, or stopping only the trackers of
+        the cars whose configs changed.
+    '''
+    def __init__(self, options, confs, vehicles, dbDir=None, geocache=None):
+        ''' Construct a supervisor object
+
+            Inputs
+              options: the command line options
+              confs: dict of the configs read from the configs file
+              vehicles: dict of the vehicles known to the Tesla API, whose keys
+                are VINs
+              dbDir: optional path to the directory of the cars' DBs
+              geocache: optional GeocodeCache used by all of the trackers
+
+            N.B. raises ValueError if the configs shared by the trackers are
+                 invalid
+        '''
+        self.options = options
+        self.confs = confs
+        self.vehicles = vehicles
+        self.dbDir = dbDir
+        self.geocache = geocache
+        self.settings = dict(DEF_SUPERVISOR_SETTINGS)
+        self.settings.update(getConfig(confs, ('config', 'supervisor')) or {})
+        self.shared = self._makeShared(self._sharedConfigs(confs))
+        # N.B. the notifier (and its dispatcher, plugins, and batcher) belongs
+        #      to this process, which runs it on the trackers' EVENT messages
+        #      (in the hub's thread), so the events of all of the cars are
+        #      batched together (with either engine), and it's closed once,
+        #      when all of the trackers have stopped, and is swapped (under
+        #      the lock) on reload
+        self.notifierConfigs = self._notifierConfigs(confs)
+        self.notifier = self._makeNotifier(self.notifierConfigs)
+        self.notifierLock = threading.Lock()
+
+        self.apiSettings = dict(DEF_API_SETTINGS)
+        self.apiSettings.update(getConfig(confs, ('config', 'api')) or {})
+        # N.B. the trackers' processes share the state of one token bucket,
+        #      while the async engine limits the requests on its loop, before
+        #      they're handed to the Car objects
+        if options.engine == "async":
+            self.limiter = AsyncTokenBucket(self.apiSettings['maxRate'], self.apiSettings['burst'])
+        else:
+            self.limiter = SharedTokenBucket(self.apiSettings['maxRate'], self.apiSettings['burst'])
+
+        # N.B. the tracker processes send snapshots of their metrics to the
+        #      hub, and this process serves them (with its own)
+        self.metricsSettings = dict(DEF_METRICS_SETTINGS)
+        self.metricsSettings.update(getConfig(confs, ('config', 'metrics')) or {})
+
+        # N.B. the trackers send the latest samples of the cars' tables to the
+        #      hub, which hands them to the state store that this process serves
+        self.stateSettings = dict(DEF_STATE_SETTINGS)
+        self.stateSettings.update(getConfig(confs, ('config', 'stateApi')) or {})
+        self.stateStore = StateStore()
+
+        self.hub = Hub(handler=self._onMessage)
+        self.engine = None
+        self.engineThread = None
+        self.launcher = None
+        self.server = None
+        self.stateServers = []
+        # N.B. each car's entry holds its tracker, and the state of its
+        #      restarts: a tracker isn't running while its 'restartAt' is set
+        self.cars = {}
+        self.quitting = False
+        # N.B. requests (from signal handlers and other threads) are queued,
+        #      and the main loop is woken up by writing to this pipe
+        self.requests = collections.deque()
+        self.wakeReader, self.wakeWriter = os.pipe()
+        os.set_blocking(self.wakeWriter, False)
+
+    def request(self, *req):
+        ''' Ask the supervisor to do something, from any thread (or a signal
+            handler): ("reload",), ("stop", <vin>), or ("quit",).
+        '''
+        self.requests.append(req)
+        self._wake()
+
+    def running(self):
+        ''' Return the VINs of the cars whose trackers are running.
+        '''
+        return [vin for vin, car in list(self.cars.items()) if car['restartAt'] is None]
+
+    def run(self, vins):
+        ''' Run the trackers of the given cars, until they've all stopped (or,
+            in interactive mode, until told to quit).
+        '''
+        signal.signal(signal.SIGHUP, lambda sig, frame: self.request("reload"))
+        signal.signal(signal.SIGINT, lambda sig, frame: self.request("quit"))
+
+        if self.options.engine != "async":
+            # N.B. forked before this process starts any threads
+            self.launcher = Launcher(self._makeTracker)
+        self.hub.start()
+        if self.options.engine == "async":
+            maxConcurrent = self.confs['config'].get('apiConcurrency', DEF_MAX_CONCURRENT)
+            self.engine = AsyncEngine({}, maxConcurrent, self.limiter)
+            self.engineThread = threading.Thread(target=self.engine.run, args=(True,),
+                                                 name="asyncEngine")
+            self.engineThread.start()
+            self.server = startMetricsServer(self.metricsSettings)
+        else:
+            self.server = startMetricsServer(self.metricsSettings, self.hub.metricsSnapshots)
+        self.stateServers = startStateServers(self.stateSettings, self.stateStore)
+        for vin in vins:
+            self._add(vin)
+        if self.options.interactive:
+            threading.Thread(target=commandInterpreter, args=(self,), name="commands",
+                             daemon=True).start()
+
+        while True:
+            now = time.time()
+            while self.requests:
+                self._handleRequest(self.requests.popleft(), now)
+            self._checkTrackers(now)
+            if not self.cars and (self.quitting or not self.options.interactive):
+                break
+            self._wait(now)
+        self._close(vins)
+
+    def _close(self, vins):
+        if self.engine:
+            self.engine.close()
+            self.engineThread.join()
+        self.hub.close()
+        # N.B. the hub has handed over all of the trackers' events by now
+        self.notifier.close()
+        for vin in vins:
+            logging.debug(f"Results for {vin}: {[formatMessage(m) for m in self.hub.drain(vin)]}")
+        if self.server:
+            self.server.close()
+        for server in self.stateServers:
+            server.close()
+        if self.launcher:
+            self.launcher.close()
+        os.close(self.wakeReader)
+        os.close(self.wakeWriter)
+
+    def _wake(self):
+        try:
+            os.write(self.wakeWriter, b"\0")
+        except BlockingIOError:
+            pass
+
+    def _onMessage(self, msg):
+        # N.B. called in the hub's thread, so the loop notices stopped async
+        #      trackers without waiting for its next check
+        if msg.type == "STATE":
+            self.stateStore.handleMessage(msg)
+        elif msg.type == "EVENT":
+            self._notify(msg)
+        elif msg.type == "BAILING":
+            logging.warning(formatMessage(msg))
+        if msg.type in ("STOPPING", "BAILING"):
+            self._wake()
+
+    def _notify(self, msg):
+        ''' Emit the notifications for a tracker's event, without letting a
+            failed notification stop the hub.
+        '''
+        eventType, arg = msg.data['eventType'], msg.data['arg']
+        try:
+            with self.notifierLock:
+                self.notifier.notify(eventType, arg, msg.data.get('car') or msg.vin)
+        except Exception as e:
+            logging.warning(f"Failed to notify '{eventType}({arg})' for '{msg.vin}': {e}")
+
+    def _wait(self, now):
+        ''' Wait until a request arrives, a tracker process exits, or it's
+            time to check the trackers.
+        '''
+        timeout = self.settings['checkInterval']
+        for car in self.cars.values():
+            due = car['restartAt'] if car['restartAt'] is not None else car['stopDeadline']
+            if due is not None:
+                timeout = min(timeout, max(0, due - now))
+        conns = [self.wakeReader]
+        if self.launcher and self.launcher.alive:
+            conns.append(self.launcher.conn)
+        ready = mp.connection.wait(conns, timeout)
+        if self.wakeReader in ready:
+            os.read(self.wakeReader, 1024)
+        if self.launcher:
+            self.launcher.poll()
+
+    def _sharedConfigs(self, confs):
+        ''' Return the parts of the configs that all of the trackers share,
+            along with the contents of the DB schema file.
+        '''
+        schemaFile = self.options.schemaFile if self.options.schemaFile else confs.get('schema')
+        if not schemaFile or not os.path.isfile(schemaFile):
+            raise ValueError(f"Invalid DB schema file: {schemaFile}")
+        with open(schemaFile, "r") as f:
+            schema = yaml.load(f, Loader=yaml.Loader)
+        configs = {'.'.join(path): getConfig(confs, path) for path in SHARED_CONFIGS}
+        configs['schema'] = schema
+        return configs
+
+    def _makeShared(self, configs):
+        ''' Create the objects that are shared by all of the trackers from the
+            shared configs (see _sharedConfigs()).
+        '''
+        if not isinstance(configs['schema'], dict) or 'tables' not in configs['schema']:
+            raise ValueError("Invalid DB schema: no tables")
+        dbSettings = dict(DEF_DB_SETTINGS)
+        dbSettings.update(configs['dbSettings'] or {})
+        return {
+            'configs': configs,
+            'schema': configs['schema'],
+            'dbSettings': dbSettings
+        }
+
+    def _notifierConfigs(self, confs):
+        ''' Return the parts of the configs that the notifier uses.
+        '''
+        return {'.'.join(path): getConfig(confs, path) for path in NOTIFIER_CONFIGS}
+
+    def _makeNotifier(self, configs):
+        ''' Create the notifier (and its dispatcher, plugins, and batcher)
+            from its configs (see _notifierConfigs()).
+
+            N.B. raises ValueError if the notifiers are invalid
+        '''
+        dispatcherSettings = dict(configs['config.dispatcher'] or {})
+        if self.dbDir and not dispatcherSettings.get('deadLetterFile'):
+            dispatcherSettings['deadLetterFile'] = os.path.join(self.dbDir, DEAD_LETTER_FILE)
+        window = configs['config.notifierWindow']
+        return Notifier(configs['config.eventNotifiers'] or {},
+                        Dispatcher(dispatcherSettings),
+                        loadPlugins(configs['config.notifierPlugins'] or {}),
+                        EventBatcher(DEF_WINDOW if window is None else window))
+
+    def _trackerSpec(self, vin):
+        ''' Return the (picklable) spec of a car's tracker, with the parts of
+            the configs it's created from that can change on reload.
+        '''
+        return {
+            'vin': vin,
+            'car': self.confs['cars'][vin],
+            'configs': self.cars[vin]['configs'],
+            'schema': self.shared['schema'],
+            'dbSettings': self.shared['dbSettings']
+        }
+
+    def _makeTracker(self, spec, channel):
+        ''' Create a tracker for a car, from its spec (see _trackerSpec()),
+            and its end of the channel.
+
+            N.B. called in the tracker's process, when run in one
+        '''
+        vin = spec['vin']
+        configs = spec['configs']
+        regions = [Region(r) for r in configs['regions']]
+        asyncMode = self.options.engine == "async"
+        car = Car(vin, spec['car'], self.vehicles[vin],
+                  {k: self.apiSettings[k] for k in ('snapshotMode', 'retry', 'breaker')},
+                  None if asyncMode else self.limiter)
+        # N.B. the trackers only wake up cars that are asleep if the 'sleep'
+        #      setting isn't enabled, otherwise they wait for them to wake up
+
+        cdb = None
+        if self.dbDir:
+            dbFile = os.path.join(self.dbDir, vin + ".db")
+            cdb = teslaDB.CarDB(vin, dbFile, spec['schema'], settings=spec['dbSettings'])
+        publisher = None
+        if asyncMode:
+            # N.B. the engine creates the (asyncio) command queues
+            inQ = None
+        else:
+            inQ = channel
+            if self.metricsSettings['port'] is not None:
+                publisher = Publisher(channel, vin, self.metricsSettings['publishInterval'])
+        return Tracker(car, cdb, spec['schema']['tables'].keys(),
+                       copy.deepcopy(configs['settings']), regions, None,
+                       inQ, channel,
+                       geocache=self.geocache, publisher=publisher)
+
+    def _add(self, vin):
+        ''' Add a car, whose tracker is started by the next check.
+        '''
+        self.cars[vin] = {
+            'configs': trackerConfigs(self.confs, vin),
+            'proc': None,
+            'startTime': None,
+            'failures': 0,
+            'restartAt': 0,
+            'stopDeadline': None,
+            'wanted': True
+        }
+
+    def _start(self, vin, now):
+        ''' Start the tracker of a car (that isn't running).
+        '''
+        car = self.cars[vin]
+        # N.B. a restarted tracker gets a new channel, and the hub keeps the
+        #      messages from the old one
+        self.hub.remove(vin)
+        channel = self.hub.add(vin)
+        try:
+            if self.engine:
+                self.engine.addTracker(vin, self._makeTracker(self._trackerSpec(vin), channel))
+            else:
+                car['proc'] = self.launcher.start(vin, self._trackerSpec(vin), channel)
+        except Exception as e:
+            logging.error(f"Failed to start tracker for '{vin}': {e}")
+            self._failed(vin, now)
+            return
+        car.update({'startTime': now, 'restartAt': None, 'stopDeadline': None})
+        logging.info(f"Tracker: {vin}")
+
+    def _stop(self, vin, now):
+        ''' Tell the tracker of a car to stop, if it's running.
+        '''
+        car = self.cars[vin]
+        if car['restartAt'] is not None or car['stopDeadline'] is not None:
+            return
+        logging.debug(f"Stopping: {vin}")
+        car['stopDeadline'] = now + self.settings['stopTimeout']
+        self._send(vin, "STOP")
+
+    def _send(self, vin, cmdType, data=None):
+        if self.engine:
+            self.engine.sendCmd(vin, command(cmdType, data))
+        else:
+            self.hub.send(vin, cmdType, data)
+
+    def _isRunning(self, vin):
+        if self.engine:
+            return self.engine.isRunning(vin)
+        if not self.launcher.alive and not self.quitting:
+            logging.error("Tracker launcher exited, stopping")
+            self.request("quit")
+        return self.launcher.isRunning(self.cars[vin]['proc'])
+
+    def _kill(self, vin):
+        ''' Force the tracker of a car to stop (e.g., if it didn't when told
+            to).
+        '''
+        logging.warning(f"Tracker for '{vin}' didn't stop, terminating it")
+        if self.engine:
+            self.engine.cancelTracker(vin)
+        else:
+            self.launcher.kill(self.cars[vin]['proc'])
+
+    def _failed(self, vin, now):
+        ''' Schedule the restart of a car's tracker that failed, after a delay
+            that grows with its number of consecutive failures.
+        '''
+        car = self.cars[vin]
+        if car['startTime'] is not None and now - car['startTime'] >= self.settings['resetTime']:
+            car['failures'] = 0
+        car['failures'] += 1
+        delay = min(self.settings['maxDelay'],
+                    self.settings['baseDelay'] * 2 ** (car['failures'] - 1))
+        logging.warning(f"Restarting tracker for '{vin}' in {delay} secs (failures: {car['failures']})")
+        car['restartAt'] = now + delay
+
+    def _stopped(self, vin, now):
+        ''' Clean up after the tracker of a car stopped, and either restart it
+            (now, or after a delay if it failed), or forget the car.
+        '''
+        car = self.cars[vin]
+        if car['proc']:
+            self.launcher.forget(car['proc'])
+            car['proc'] = None
+        stopDeadline, car['stopDeadline'] = car['stopDeadline'], None
+        if not car['wanted']:
+            del self.cars[vin]
+            logging.info(f"Stopped: {vin}")
+        elif stopDeadline is None:
+            # N.B. the tracker wasn't told to stop
+            self._failed(vin, now)
+        else:
+            car['restartAt'] = now
+
+    def _checkTrackers(self, now):
+        ''' Start the trackers that are due to be (re)started, and deal with
+            those that have stopped (or are slow to).
+        '''
+        for vin in list(self.cars):
+            car = self.cars[vin]
+            if car['restartAt'] is not None:
+                if not car['wanted']:
+                    del self.cars[vin]
+                elif now >= car['restartAt'] and not self.quitting:
+                    self._start(vin, now)
+            elif not self._isRunning(vin):
+                self._stopped(vin, now)
+            elif car['stopDeadline'] is not None and now >= car['stopDeadline']:
+                self._kill(vin)
+                car['stopDeadline'] = now + self.settings['stopTimeout']
+
+    def _handleRequest(self, req, now):
+        if req[0] == "reload":
+            logging.info("Reloading configs")
+            self._reload(now)
+        elif req[0] == "stop":
+            if req[1] in self.cars:
+                self.cars[req[1]]['wanted'] = False
+                self._stop(req[1], now)
+        elif req[0] == "quit":
+            logging.info("Stopping all trackers")
+            self.quitting = True
+            for vin in self.cars:
+                self.cars[vin]['wanted'] = False
+                self._stop(vin, now)
+
+    def _reload(self, now):
+        ''' Re-read the configs file, and apply the changes to the trackers of
+            the cars whose configs changed.
+        '''
+        try:
+            confs = loadConfigs(self.options.configsFile)
+            sharedConfigs = self._sharedConfigs(confs)
+            shared = None
+            if sharedConfigs != self.shared['configs']:
+                shared = self._makeShared(sharedConfigs)
+            notifierConfigs = self._notifierConfigs(confs)
+            notifier = None
+            if notifierConfigs != self.notifierConfigs:
+                notifier = self._makeNotifier(notifierConfigs)
+            configs = {vin: trackerConfigs(confs, vin) for vin in confs['cars']}
+        except Exception as e:
+            logging.error(f"Failed to reload configs from '{self.options.configsFile}': {e}")
+            return
+        for path in STATIC_CONFIGS:
+            if getConfig(confs, path) != getConfig(self.confs, path):
+                logging.warning(f"Changes to '{'.'.join(path)}' take effect when restarted")
+        # N.B. the log settings are only used when starting
+        for key in ('logLevel', 'logFile'):
+            if key in self.confs['config']:
+                confs['config'][key] = self.confs['config'][key]
+        self.confs = confs
+        self.settings = dict(DEF_SUPERVISOR_SETTINGS)
+        self.settings.update(getConfig(confs, ('config', 'supervisor')) or {})
+        if shared:
+            logging.info("Shared configs changed, restarting all trackers")
+            self.shared = shared
+        if notifier:
+            logging.info("Notifier configs changed, replacing the notifier")
+            with self.notifierLock:
+                notifier, self.notifier = self.notifier, notifier
+            self.notifierConfigs = notifierConfigs
+            # N.B. delivers the old notifier's pending notifications
+            notifier.close()
+
+        vins = [self.options.VIN] if self.options.VIN else list(configs)
+        notFound = [vin for vin in vins if vin not in self.vehicles or vin not in configs]
+        if notFound:
+            logging.warning(f"Cars asked for, but not found in Tesla API: {notFound}")
+        vins = [vin for vin in vins if vin not in notFound]
+
+        for vin in list(self.cars):
+            if vin not in vins:
+                self.cars[vin]['wanted'] = False
+                self._stop(vin, now)
+        for vin in vins:
+            car = self.cars.get(vin)
+            if not car or not car['wanted']:
+                # N.B. a car that's still being stopped is restarted when it has
+                if car:
+                    car.update({'configs': configs[vin], 'wanted': True, 'failures': 0})
+                else:
+                    self._add(vin)
+                logging.info(f"Adding: {vin}")
+                continue
+            _, _, changed, _ = dictDiff(configs[vin], car['configs'])
+            if not changed and not shared:
+                continue
+            car['configs'] = configs[vin]
+            if car['restartAt'] is not None:
+                # N.B. the new configs might fix a tracker that was failing
+                car.update({'restartAt': now, 'failures': 0})
+            elif not shared and changed <= set(RECONFIGURABLE):
+                logging.info(f"Reconfiguring: {vin} ({sorted(changed)})")
+                data = {}
+                if 'settings' in changed:
+                    data['settings'] = copy.deepcopy(configs[vin]['settings'])
+                if 'regions' in changed:
+                    try:
+                        data['regions'] = [Region(r) for r in configs[vin]['regions']]
+                    except Exception as e:
+                        logging.error(f"Invalid regions for '{vin}': {e}")
+                        continue
+                self._send(vin, "RECONFIGURE", data)
+            else:
+                logging.info(f"Restarting: {vin} ({sorted(changed) if changed else 'shared'})")
+                self._stop(vin, now)
 
 
 def run(options):
     try:
-        conn = teslajson.Connection(options.user, options.passwd)
+        if options.mockApi:
+            # N.B. the mock API is only for testing, so only import it if used
+            from mockTesla import HttpConnection
+            conn = HttpConnection(options.mockApi)
+        else:
+            conn = teslajson.Connection(options.user, options.passwd)
     except Exception as e:
         fatalError(f"Failed to connect: {e}")
     logging.info(f"Connection: {conn}")
@@ -166,21 +1025,13 @@ def run(options):
     if notAskedFor:
         logging.warning(f"Cars Tesla API knows about, but not asked for: {notAskedFor}")
 
-    vehicles = {v['vin']: v for v in conn.vehicles if v['vin'] in vinList}
+    # N.B. all of the vehicles are kept, so cars can be added when reloading
+    vehicles = {v['vin']: v for v in conn.vehicles}
     if options.verbose > 3:
         print("VEHICLES:")
         json.dump(vehicles, sys.stdout, indent=4, sort_keys=True)
         print("")
 
-    if opts.schemaFile:
-        schemaFile = opts.schemaFile
-    else:
-        schemaFile = opts.confs.get('schema')
-    if not os.path.isfile(schemaFile):
-        fatalError(f"Invalid DB schema file: {schemaFile}")
-    with open(schemaFile, "r") as f:
-        schema = yaml.load(f, Loader=yaml.Loader)
-
     if opts.dbDir:
         dbDir = opts.dbDir
     else:
@@ -191,64 +1042,70 @@ def run(options):
     else:
         if opts.verbose:
             logging.warning("Not logging data to DB")
+    # N.B. the cache file is opened on first use, so each tracker process
+    #      gets its own connection to it
+    geocacheFile = os.path.join(dbDir, GEOCACHE_FILE) if dbDir else None
+    geocache = GeocodeCache(geocoder, geocacheFile)
 
-    cars = {}
-    cmdQs = {}
-    respQs = {}
-    trackers = {}
-    for vin in vinList:
-        conf = opts.confs['cars'][vin]
-        cars[vin] = car = Car(vin, conf, vehicles[vin])
-        logging.info(f"Waking up {vin}: {car.getName()}")
-        if not car.wakeUp():
-            logging.warning(f"Unable to wake up '{car.getName()}', skipping...")
-            time.sleep(random.randint(5, 15))
-            continue
+    try:
+        supervisor = Supervisor(options, opts.confs, vehicles, dbDir, geocache)
+    except ValueError as e:
+        fatalError(str(e))
+    supervisor.run(vinList)
 
-        # give car time to wake up and dither start times across cars
-        #### FIXME time.sleep(random.randint(15, 45))
 
-        cdb = None
-        if dbDir:
-            dbFile = os.path.join(dbDir, vin + ".db")
-            cdb = teslaDB.CarDB(vin, dbFile, schema)
-        tables = schema['tables'].keys()
-        settings = dict(DEF_SETTINGS)
-        dictMerge(settings, opts.confs.get('config', {}).get('settings', {}))
-        regions = [Region(r) for r in conf.get('regions', [])]
-        notifier = Notifier(opts.confs.get('config', {}).get('eventNotifiers', {}))
-        cmdQs[vin] = mp.Queue()
-        respQs[vin] = mp.Queue()
-        tracker = Tracker(car, cdb, tables, settings, regions, notifier,
-                          cmdQs[vin], respQs[vin])
-        logging.info(f"Tracker: {vin}")
-        trackers[vin] = mp.Process(target=tracker.run, args=())
+def startMetricsServer(settings, snapshots=None):
+    ''' Start the HTTP server for the metrics, if a port is given for it.
+
+        N.B. started after the launcher is forked, so the tracker processes
+             don't inherit the server's socket
 
-    for vin in trackers:
-        trackers[vin].start()
+        Inputs
+          settings: dict of metrics settings (see DEF_METRICS_SETTINGS)
+          snapshots: optional function that returns the tracker processes'
+            metrics snapshots
+
+        Returns
+          the MetricsServer object, or None
+    '''
+    if not settings or settings['port'] is None:
+        return None
+    try:
+        server = MetricsServer(snapshots, settings['host'], settings['port'])
+    except OSError as e:
+        fatalError(f"Failed to start metrics server: {e}")
+    logging.info(f"Metrics: http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+    return server
 
-    if options.interactive:
-        commandInterpreter(trackers, cmdQs, respQs)
 
-    for vin in trackers:
-        trackers[vin].join()
-        logging.debug(f"Results for {vin}: {dumpQueue(respQs[vin])}")
+def startStateServers(settings, store):
+    ''' Start the HTTP servers for the state store, on the port and/or the
+        Unix socket given for them.
+
+        Inputs
+          settings: dict of state API settings (see DEF_STATE_SETTINGS)
+          store: the StateStore to serve
+
+        Returns
+          list of the servers started
+    '''
+    servers = []
+    try:
+        if settings['port'] is not None:
+            servers.append(StateServer(store, settings['host'], settings['port'],
+                                       settings['maxWait']))
+            address = servers[-1].server_address
+            logging.info(f"State: http://{address[0]}:{address[1]}/state")
+        if settings['socket']:
+            servers.append(UnixStateServer(store, settings['socket'], settings['maxWait']))
+            logging.info(f"State: {settings['socket']}")
+    except OSError as e:
+        fatalError(f"Failed to start state server: {e}")
+    return servers
 
 
 def getOps():
-    def signalHandler(sig, frame):
-        ''' Catch SIGHUP to force a reload/restart and SIGINT to stop all.""
-        '''
-        if sig == signal.SIGHUP:
-            logging.info("SIGHUP")
-            #### TODO stop, reload, and restart everything
-        elif sig == signal.SIGINT:
-            logging.info("SIGINT")
-            for vin in cmdQs:
-                logging.debug(f"Stopping: {vin}")
-                cmdQs[vin].put("STOP")
-
-    usage = f"Usage: {sys.argv[0]} [-v] [-c <configsFile>] [-d <dbDir>] [-i] [-L <logLevel>] [-l <logFile>] [-p <passwd>] [-s <schemaFile>] [-V <VIN>]"
+    usage = f"Usage: {sys.argv[0]} [-v] [-c <configsFile>] [-d <dbDir>] [-e <engine>] [-i] [-L <logLevel>] [-l <logFile>] [-M <mockApiUrl>] [-p <passwd>] [-s <schemaFile>] [-V <VIN>]"
     ap = argparse.ArgumentParser()
     ap.add_argument(
         "-c", "--configsFile", action="store", type=str,
@@ -256,6 +1113,10 @@ def getOps():
     ap.add_argument(
         "-d", "--dbDir", action="store", type=str,
         help="path to a directory that contains the DB files for cars")
+    ap.add_argument(
+        "-e", "--engine", action="store", type=str, default=DEF_ENGINE,
+        choices=ENGINES,
+        help="run each car's tracker in its own process, or all of them on one asyncio loop")
     ap.add_argument(
         "-i", "--interactive", action="store_true", default=False,
         help="enable interactive mode")
@@ -266,6 +1127,9 @@ def getOps():
     ap.add_argument(
         "-l", "--logFile", action="store", type=str,
         help="Path to location of logfile (create it if it doesn't exist)")
+    ap.add_argument(
+        "-M", "--mockApi", action="store", type=str,
+        help="URL of a mock Tesla API server (see mockTesla.py) to use instead of Tesla's")
     ap.add_argument(
         "-p", "--password", action="store", type=str, help="user password")
     ap.add_argument(
@@ -283,8 +1147,10 @@ def getOps():
 
     #### TODO add check if configs file has proper protections
 
-    with open(opts.configsFile, "r") as confsFile:
-        confs = list(yaml.load_all(confsFile, Loader=yaml.Loader))[0]
+    try:
+        confs = loadConfigs(opts.configsFile)
+    except Exception as e:
+        fatalError(f"Invalid configuration file: {opts.configsFile}: {e}")
     if opts.verbose > 3:
         json.dump(confs, sys.stdout, indent=4, sort_keys=True)    #### TMP TMP TMP
         print("")
@@ -310,8 +1176,9 @@ def getOps():
     else:
         logging.basicConfig(level=l)
 
+    # N.B. a mock API server doesn't need the account's credentials
     opts.user = confs.get('user')
-    if not opts.user:
+    if not opts.user and not opts.mockApi:
         input("user: ")
     logging.debug(f"user: {opts.user}")
 
@@ -321,13 +1188,10 @@ def getOps():
         password = opts.password
     else:
         password = confs.get('passwd')
-    if not password:
+    if not password and not opts.mockApi:
         password = input("password: ")
     opts.passwd = password
 
-    signal.signal(signal.SIGHUP, signalHandler)
-    signal.signal(signal.SIGINT, signalHandler)
-
     opts.confs = confs
     return opts
 
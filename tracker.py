@@ -6,21 +6,23 @@
 ################################################################################
 '''
 
+import asyncio
 import queue
 import sys
 import time
 import traceback
 
-from geopy import distance
-from teslawatch import geocoder, dictDiff
+from teslawatch import dictDiff
 
-from regions import Region
+from ipc import message
+import metrics
+from regions import GridIndex, Region, TransitionDetector
+from regions import DEF_REGION_DWELL, DEF_REGION_MARGIN
+from scheduler import DRIVING_SHIFT_STATES, PollScheduler, inferState
 
 
 '''
 TODO
-  * generate parked->moving/stopped and parked/moving->stopped events
-  * look for geofence entry/exit events
   * look for temperature events (too hot/cold)
   * look for doors/windows open/unlocked for period of time events
   * look for battery going below a threshold events
@@ -28,8 +30,6 @@ TODO
   * make hooks that can call arbitrary functions in addition to sending messages on events
     - allow automation of locking/shutting/turning on/off climate, opening/closing stuff
   * specify functions to call (potentially external/shell cmds, in addition to those in events.py) in configs file
-  * up the poll rate for drive state when moving to more frequent, less when stopped/parked
-  * poll frequency: driveState (D/R vs P), vehicleState, chargeState, {climateSettings, guiSettings}
   * make the tracker keep track of previous states, detect transitions, and call the event object (with args relevent to the event)
     - create list of event/arg tuples and send to eventHandler object for the car
       * instantiate per-car eventHandler object in main loop and pass in as arg to the tracker
@@ -39,7 +39,6 @@ TODO
     - create (home/work) regions from config spec, add new regions through various means
     - location object encapsulates lat/lon, computes distances, give it list of region objects and get back boolean vector (inside/outside)
     - keep track of regions here and detect transitions when new location given
-  * do compression -- keep last contents of each table, and suppress db store if no change (ignore/mask timestamps)
 
 Questions
   * make an event object that gets instantiated with params from the config file?
@@ -70,11 +69,127 @@ EVENT_TYPES = (
 # commands that can be sent on the trackers' command Queue
 TRACKER_CMDS = ("PAUSE", "RESUME", "STOP")
 
+# states of a car's motion
+#  N.B. a car that's in gear but not going anywhere (e.g., at a light) is
+#       'STOPPED', and only a car that's out of gear is 'PARKED'
+MOTION_STATES = ("PARKED", "MOVING", "STOPPED")
+
+# default number of consecutive samples, or number of seconds, a new motion
+#  state must persist for before the MotionStateMachine commits to it
+DEF_MOTION_SAMPLES = 2
+DEF_MOTION_TIME = 10
+
+# min speed (in the car's units) at which the car is considered to be moving
+DEF_MOTION_SPEED = 1
+
+# default settings for letting a parked car fall asleep
+#  * enabled: if True, stop requesting a car's data once it has been idle (or
+#    is asleep), and only check its state in the (non-waking) vehicle list
+#  * idleTime: number of secs a car must be idle before its data requests stop
+#  * checkInterval: number of secs between checks of the vehicle list
+DEF_SLEEP_SETTINGS = {
+    'enabled': True,
+    'idleTime': 15 * 60,
+    'checkInterval': 60
+}
+
+# car states (see scheduler.CAR_STATES) in which a car is considered idle
+IDLE_STATES = ("parkedHome", "parkedAway", "night", "asleep")
+
+
+class MotionStateMachine(object):
+    ''' Object that tracks whether a car is parked, moving, or stopped, from
+        the fields of its driveState samples.
+
+        A change of state is debounced, so a single odd sample doesn't
+        generate a pair of STARTED_MOVING/STOPPED_MOVING events.
+    '''
+    def __init__(self, samples=DEF_MOTION_SAMPLES, secs=DEF_MOTION_TIME,
+                 minSpeed=DEF_MOTION_SPEED):
+        ''' Construct a motion state machine object
+
+            Inputs
+              samples: number of consecutive samples a new state must be seen
+                in before it is committed to
+              secs: number of seconds a new state must persist for before it
+                is committed to (whichever of these happens first)
+              minSpeed: min speed at which the car is considered to be moving
+        '''
+        self.samples = samples
+        self.secs = secs
+        self.minSpeed = minSpeed
+        self.state = None
+        self.candidate = None
+        self.candidateCount = 0
+        self.candidateSince = None
+
+    def classify(self, sample):
+        ''' Return the motion state that a single driveState sample indicates
+        '''
+        speed = sample.get('speed')
+        if speed is not None and speed >= self.minSpeed:
+            return "MOVING"
+        if sample.get('shift_state') in DRIVING_SHIFT_STATES:
+            # N.B. the speed isn't always reported, but the car draws power
+            #      when it's creeping along in traffic
+            if speed is None and (sample.get('power') or 0) > 0:
+                return "MOVING"
+            return "STOPPED"
+        return "PARKED"
+
+    def isMoving(self):
+        ''' Return True if the car is being driven (i.e., is moving or stopped)
+        '''
+        return self.state in ("MOVING", "STOPPED")
+
+    def update(self, sample, now):
+        ''' Take a new driveState sample and return a list of the events
+            (i.e., "STARTED_MOVING" or "STOPPED_MOVING") caused by it.
+
+            The first sample sets the initial state without generating events.
+
+            Inputs
+              sample: dict with (at least) the 'shift_state', 'speed', and
+                'power' fields of a driveState sample
+              now: time (in secs since the epoch) used if the sample doesn't
+                have a 'gps_as_of' field
+
+            Returns
+              List of event type names
+        '''
+        t = sample.get('gps_as_of') or now
+        state = self.classify(sample)
+        if self.state is None:
+            self.state = state
+            return []
+        if state == self.state:
+            self.candidate = None
+            return []
+        # N.B. the debouncing is of leaving the current state, so going from
+        #      parked to stopped to moving on successive samples still counts
+        if self.candidate is None:
+            self.candidateCount = 0
+            self.candidateSince = t
+        self.candidate = state
+        self.candidateCount += 1
+        if self.candidateCount < self.samples and (t - self.candidateSince) < self.secs:
+            return []
+
+        prevState = self.state
+        self.state = state
+        self.candidate = None
+        if state == "MOVING":
+            return ["STARTED_MOVING"]
+        if prevState == "MOVING":
+            return ["STOPPED_MOVING"]
+        return []
+
 
 class Tracker(object):
     ''' Object that encapsulates all of the state associated with a car that is being tracked
     '''
-    def __init__(self, carObj, carDB, tables, settings, regions, notifier, inQ, outQ):
+    def __init__(self, carObj, carDB, tables, settings, regions, notifier, inQ, outQ,
+                 geocache=None, publisher=None):
         ''' Construct a tracker object
 
             Inputs
@@ -83,20 +198,404 @@ class Tracker(object):
               tables: ????
               settings: ????
               regions: ????
-              notifier: ????
-              inQ: MP Queue object for receiving commands from the master
-              outQ: MP Queue object for returning status
+              notifier: optional Notifier object owned by the tracker (and
+                closed when it stops), or None if the master emits the
+                notifications for the tracker's EVENT messages
+              inQ: ipc.Channel object for receiving commands from the master
+                (or an asyncio Queue when run with runAsync())
+              outQ: ipc.Channel object for sending messages to the master
+              geocache: optional GeocodeCache object used to get place names
+              publisher: optional metrics Publisher object, used when run in
+                its own process
         '''
         self.car = carObj
         self.db = carDB
         self.tables = tables
         self.settings = settings
         self.regions = regions
+        self.regionIndex = GridIndex([r.shape for r in regions])
+        thresholds = settings.get('thresholds', {})
+        self.transitions = TransitionDetector(self.regionIndex,
+                                              thresholds.get('regionMargin', DEF_REGION_MARGIN),
+                                              thresholds.get('regionDwell', DEF_REGION_DWELL))
+        self.inRegions = set()
+        self.motion = MotionStateMachine(thresholds.get('motionSamples', DEF_MOTION_SAMPLES),
+                                         thresholds.get('motionTime', DEF_MOTION_TIME),
+                                         thresholds.get('motionSpeed', DEF_MOTION_SPEED))
         self.notifier = notifier
         self.inQ = inQ
         self.outQ = outQ
+        self.geocache = geocache
+        self.publisher = publisher
+        self.labels = {'vin': self.car.vin}
+
+        self.sleepSettings = dict(DEF_SLEEP_SETTINGS)
+        self.sleepSettings.update(settings.get('sleep', {}))
 
         self.samples = {t: {'sample': {}, 'time': None} for t in tables}
+        self.scheduler = None
+        self.asleep = False
+        self.carName = None
+        self.prevLoc = None
+        # N.B. set to the engine's loop when run with runAsync()
+        self.loop = None
+
+        # N.B. while 'sleeping', no data requests are made of the car
+        self.sleeping = False
+        self.idleSince = None
+        self.onlineState = None
+        self.onlineSince = None
+        self.nextOnlineCheck = None
+        self.backOffFailed = False
+
+    def _start(self, state, now):
+        ''' Take the initial snapshot of all of the car's tables, log it, and
+            set up the polling schedule.
+        '''
+        if self.db:
+            self.db.insertState(state)
+        self.prevLoc = (state['driveState']['latitude'],
+                        state['driveState']['longitude'])
+        self.transitions.update(*self.prevLoc, now)
+        self.inRegions = self.transitions.insideIds()
+        self.motion.update(state['driveState'], now)
+        for tableName in self.samples:
+            self.samples[tableName]['sample'] = state[tableName]
+            self.samples[tableName]['time'] = now
+            self._sendState(tableName)
+        self.scheduler = PollScheduler(self.samples.keys(), self.settings, now)
+        self.scheduler.setState(inferState(self.samples, self.settings, now,
+                                           regions=self.inRegions,
+                                           moving=self.motion.isMoving()))
+
+        self.carName = self.car.getName()
+        self._send("TRACKING", {'name': self.carName, 'place': self.placeName(*self.prevLoc)})
+
+    def _wakeFirst(self, onlineState):
+        ''' Return True if the car has to be woken up to start tracking it, or
+            False if it can be tracked (from its last known state) while it
+            sleeps.
+        '''
+        if self.sleepSettings['enabled'] and onlineState in ("asleep", "offline"):
+            return False
+        return onlineState != "online"
+
+    def _startAsleep(self, onlineState, now):
+        ''' Start tracking a car without waking it up, with the last known
+            state of its tables (from the car's snapshot, or the DB), and
+            without making data requests until it wakes up.
+        '''
+        snapshot = self.car.getSnapshot()
+        for tableName in self.samples:
+            sample = snapshot.get(tableName)
+            if not sample and self.db:
+                sample = self.db.getLatest(tableName)
+            self.samples[tableName]['sample'] = sample if sample else {}
+            self._sendState(tableName)
+        drive = self.samples['driveState']['sample']
+        if drive.get('latitude') is not None and drive.get('longitude') is not None:
+            self.prevLoc = (drive['latitude'], drive['longitude'])
+            self.transitions.update(*self.prevLoc, now)
+            self.inRegions = self.transitions.insideIds()
+            self.motion.update(drive, now)
+        self.asleep = True
+        self.scheduler = PollScheduler(self.samples.keys(), self.settings, now)
+        self.scheduler.setState("asleep")
+
+        self.carName = self.car.getName()
+        place = self.placeName(*self.prevLoc) if self.prevLoc else "unknown location"
+        self._send("TRACKING", {'name': self.carName, 'place': place, 'state': onlineState})
+        self._backOff(now)
+        self.onlineState = onlineState
+
+    def placeName(self, lat, lon):
+        ''' Return the name of the place at the given location, from the
+            geocoding cache if there is one, or its coordinates otherwise.
+        '''
+        name = None
+        if self.geocache and lat is not None and lon is not None:
+            try:
+                if self.loop:
+                    # N.B. mustn't block the engine's loop, so places that
+                    #      aren't cached are looked up in the background
+                    #      (and named by their coordinates until then)
+                    found, name = self.geocache.cached(lat, lon)
+                    if not found:
+                        self.loop.run_in_executor(None, self._geocode, lat, lon)
+                else:
+                    name = self._geocode(lat, lon)
+            except Exception as e:
+                sys.stderr.write(f"WARNING: failed to geocode ({lat}, {lon}): {e}\n")
+        return name if name else f"({lat}, {lon})"
+
+    def _geocode(self, lat, lon):
+        ''' Return the name of the place at the given location from the
+            geocoding cache (calling the geocoder on a miss), or None.
+        '''
+        try:
+            return self.geocache.reverse(lat, lon)
+        except Exception as e:
+            sys.stderr.write(f"WARNING: failed to geocode ({lat}, {lon}): {e}\n")
+            return None
+
+    def _send(self, msgType, data=None):
+        ''' Send a message of the given type to the master.
+        '''
+        self.outQ.put(message(msgType, self.car.vin, data))
+
+    def _bail(self, e):
+        ''' Tell the master about the error that stopped the tracker, if it
+            can still be reached (e.g., the error wasn't a broken channel).
+        '''
+        traceback.print_exc()
+        try:
+            self._send("BAILING", str(e))
+        except OSError as sendError:
+            sys.stderr.write(f"WARNING: failed to send 'BAILING' for '{self.car.vin}': {sendError}\n")
+
+    def _close(self):
+        ''' Release the tracker's resources (delivering its pending
+            notifications and writing its buffered rows), when it stops.
+        '''
+        if self.notifier:
+            self.notifier.close()
+        if self.db:
+            self.db.close()
+        if self.publisher:
+            try:
+                self.publisher.publish(force=True)
+            except OSError:
+                pass
+
+    def _sendState(self, tableName):
+        ''' Send the latest sample of one of the car's tables to the master
+            (for its state store).
+        '''
+        latest = self.samples[tableName]
+        if latest['sample']:
+            self._send("STATE", {'table': tableName, 'sample': latest['sample'],
+                                 'time': latest['time']})
+
+    def _handleCmd(self, cmd):
+        ''' Take a command message from the master and return its type if the
+            tracker has to act on it (i.e., "STOP" or "PAUSE"), or None
+            otherwise.
+        '''
+        if cmd is None:
+            return None
+        if cmd.type == "STOP":
+            self._send("STOPPING")
+            return cmd.type
+        elif cmd.type == "PAUSE":
+            return cmd.type
+        elif cmd.type == "RESUME":
+            pass
+        elif cmd.type == "RECONFIGURE":
+            self.reconfigure(**cmd.data)
+        else:
+            sys.stderr.write("WARNING: unknown tracker command '{0}'\n".format(cmd.type))
+        return None
+
+    def _processSample(self, tableName, sample, now):
+        ''' Take a new sample of one of the car's tables, log it, and look for
+            events in it.
+        '''
+        self.scheduler.done(tableName, now)
+        if tableName == 'driveState':
+            # N.B. only a request that failed because the car is asleep (and
+            #      not, e.g., a network error) means that the car is asleep
+            if sample is not None:
+                self.asleep = False
+            elif self.car.lastError(tableName) == "asleep":
+                self.asleep = True
+        if sample is None:
+            return
+        metrics.inc('teslawatch_samples_total', {'vin': self.car.vin, 'table': tableName})
+        prev = self.samples[tableName]['sample']
+        if prev and sample.keys() != prev.keys():
+            # N.B. the DB adds columns for new fields, and stores NULLs for
+            #      dropped ones
+            add, rem, _, _ = dictDiff(sample, prev)
+            self._send("SCHEMA", {'table': tableName, 'added': add, 'removed': rem})
+        if self.db:
+            # N.B. the DB suppresses rows that haven't changed
+            #      if it was created with 'deltaLogging'
+            self.db.insertRow(tableName, sample)
+
+        if tableName == 'driveState':
+            newLoc = (sample['latitude'], sample['longitude'])
+            with metrics.timer('teslawatch_region_check_seconds', self.labels):
+                transitions = self.transitions.update(*newLoc, now)
+            for eventType, regionId in transitions:
+                self._notify(eventType, regionId)
+            self.inRegions = self.transitions.insideIds()
+            for eventType in self.motion.update(sample, now):
+                self._notify(eventType, self.placeName(*newLoc))
+            self.prevLoc = newLoc
+
+        self.samples[tableName]['sample'] = sample
+        self.samples[tableName]['time'] = now
+        self._sendState(tableName)
+
+    def _notify(self, eventType, arg):
+        ''' Emit a notification for an event, without letting a failed
+            notification stop the tracker.
+        '''
+        self._send("EVENT", {'eventType': eventType, 'arg': arg,
+                             'car': self.carName or self.car.vin})
+        if not self.notifier:
+            return
+        try:
+            self.notifier.notify(eventType, arg, self.carName or self.car.vin)
+        except Exception as e:
+            sys.stderr.write(f"WARNING: failed to notify '{eventType}({arg})': {e}\n")
+
+    def reconfigure(self, settings=None, regions=None):
+        ''' Apply new settings and/or regions to the running tracker, keeping
+            its state (e.g., the regions the car is in, if they're unchanged).
+
+            Inputs
+              settings: optional dict with the tracker's new settings
+              regions: optional list with all of the tracker's Region objects
+        '''
+        if settings is not None:
+            self.settings = settings
+            thresholds = settings.get('thresholds', {})
+            self.transitions.margin = thresholds.get('regionMargin', DEF_REGION_MARGIN)
+            self.transitions.dwell = thresholds.get('regionDwell', DEF_REGION_DWELL)
+            self.motion.samples = thresholds.get('motionSamples', DEF_MOTION_SAMPLES)
+            self.motion.secs = thresholds.get('motionTime', DEF_MOTION_TIME)
+            self.motion.minSpeed = thresholds.get('motionSpeed', DEF_MOTION_SPEED)
+            self.sleepSettings = dict(DEF_SLEEP_SETTINGS)
+            self.sleepSettings.update(settings.get('sleep', {}))
+            if self.scheduler:
+                self.scheduler.setSettings(settings)
+        if regions is not None:
+            specs = {r.name: r.specs for r in self.regions}
+            names = set(r.name for r in regions)
+            for name in specs:
+                if name not in names:
+                    self.removeRegion(name)
+            for region in regions:
+                if specs.get(region.name) != region.specs:
+                    self.addRegion(region)
+
+    def addRegion(self, region):
+        ''' Add a region to those being tracked (replacing any region with the
+            same name).
+        '''
+        self.removeRegion(region.name)
+        self.regions.append(region)
+        self.regionIndex.insert(region.shape)
+
+    def removeRegion(self, name):
+        ''' Stop tracking the region with the given name.
+        '''
+        self.regions = [r for r in self.regions if r.name != name]
+        self.regionIndex.delete(name)
+        self.transitions.forget(name)
+        self.inRegions = self.transitions.insideIds()
+
+    def _endCycle(self, now):
+        ''' Finish a pass of the polling loop: let the DB flush old rows,
+            update the polling schedule with the car's current state, and
+            publish the process' metrics.
+        '''
+        if self.db:
+            self.db.checkFlush()
+
+        # poll more frequently when driving and less when parked
+        state = inferState(self.samples, self.settings, now, self.asleep,
+                           self.inRegions, self.motion.isMoving(),
+                           self.car.breaker.isOpen())
+        self.scheduler.setState(state)
+        self._checkIdle(state, now)
+        if self.publisher:
+            self.publisher.publish(now)
+
+    def _checkIdle(self, state, now):
+        ''' Stop making data requests of a car (so it can fall asleep) once it
+            has been idle for long enough, or has fallen asleep.
+        '''
+        if not self.sleepSettings['enabled'] or self.sleeping:
+            return
+        if state not in IDLE_STATES:
+            self.idleSince = None
+            return
+        if self.idleSince is None:
+            self.idleSince = now
+        if state == "asleep" or now - self.idleSince >= self.sleepSettings['idleTime']:
+            self._backOff(now, failed=state == "asleep")
+
+    def _backOff(self, now, failed=False):
+        ''' Stop making data requests of the car, where 'failed' is True if
+            it's because a request failed (rather than the car being idle).
+        '''
+        self.sleeping = True
+        self.backOffFailed = failed
+        self.onlineState = None
+        self.onlineSince = now
+        # N.B. after a failure, check right away whether the car is still
+        #      online (e.g., the request failed because of the network)
+        self.nextOnlineCheck = now if failed else now + self.sleepSettings['checkInterval']
+        self._send("SLEEPING")
+
+    def _resume(self, now):
+        self.sleeping = False
+        self.backOffFailed = False
+        self.idleSince = None
+        self.asleep = False
+        self.scheduler.pollAll(now)
+        self._send("RESUMING")
+
+    def _checkDue(self, now):
+        ''' Return True if it's time to check the car's state in the vehicle
+            list (i.e., while data requests are stopped).
+        '''
+        return self.sleeping and now >= self.nextOnlineCheck
+
+    def _checkOnline(self, onlineState, now):
+        ''' Take the car's state from the vehicle list, and resume polling it
+            if it changed to 'online' (i.e., it woke up), if it's online after
+            a failed request stopped the polling (i.e., the failure wasn't
+            because it's asleep), or if it stayed online for the idle time
+            (i.e., it didn't fall asleep, so it might be in use).
+        '''
+        self.nextOnlineCheck = now + self.sleepSettings['checkInterval']
+        if onlineState is None:
+            return
+        prevState = self.onlineState
+        if onlineState != prevState:
+            self.onlineState = onlineState
+            self.onlineSince = now
+        self.asleep = onlineState != "online"
+        if onlineState != "online":
+            return
+        if prevState not in (None, "online") or self.backOffFailed:
+            self._resume(now)
+        elif now - self.onlineSince >= self.sleepSettings['idleTime']:
+            self._resume(now)
+
+    def _recordLag(self, wakeTime, now):
+        ''' Record how late the polling loop woke up (if it wasn't woken early
+            by a command).
+        '''
+        if now >= wakeTime:
+            metrics.observe('teslawatch_loop_lag_seconds', now - wakeTime, self.labels)
+
+    def _timeToNext(self, now):
+        ''' Return the number of secs until the tracker next has to do
+            something (i.e., poll a table, or check the vehicle list).
+        '''
+        if self.sleeping:
+            return max(0.0, self.nextOnlineCheck - now)
+        return self.scheduler.timeToNext(now)
+
+    def _due(self, now):
+        ''' Return the names of the tables that are to be polled now (none
+            while the data requests are stopped).
+        '''
+        return [] if self.sleeping else self.scheduler.due(now)
 
     def run(self):
         ''' Per-car process that polls the Tesla API, logs the data, and emits
@@ -104,94 +603,129 @@ class Tracker(object):
 
             This is intended to be called by Multiprocessing.Process()
         '''
-        CHANGING_FIELDS = set(['timestamp', 'gps_as_of'])
-        now = int(time.time())
-
+        if self.publisher:
+            self.publisher.start()
         try:
-            state = self.car.getCarState()
-            if self.db:
-                self.db.insertState(state)
-            prevLoc = geocoder.reverse((state['driveState']['latitude'],
-                                        state['driveState']['longitude']))
-            for tableName in self.samples:
-                self.samples[tableName]['sample'] = state[tableName]
-                self.samples[tableName]['time'] = now
-
-            carName = self.car.getName()
-            self.outQ.put("TRACKING {0}".format(carName))
+            onlineState = self.car.getOnlineState()
+            if not self._wakeFirst(onlineState) and onlineState != "online":
+                self._startAsleep(onlineState, time.time())
+            else:
+                if self._wakeFirst(onlineState) and not self.car.wakeUp():
+                    raise Exception("unable to wake up the car")
+                self._start(self.car.getCarState(), time.time())
+            if self.publisher:
+                self.publisher.publish(force=True)
 
             while True:
+                # sleep until the next table is due, or a command arrives
+                timeout = self._timeToNext(time.time())
+                wakeTime = time.time() + timeout
                 try:
-                    cmd = self.inQ.get_nowait()
+                    cmd = self._handleCmd(self.inQ.get(True, timeout))
+                    if cmd == "PAUSE":
+                        msg = self.inQ.get()
+                        while msg.type not in ("RESUME", "STOP"):
+                            msg = self.inQ.get()
+                        cmd = self._handleCmd(msg)
                     if cmd == "STOP":
-                        self.outQ.put("STOPPING {0}".format(carName))
-                        print("Exiting:", self.car.vin)    #### TMP TMP TMP
                         break
-                    elif cmd == "PAUSE":
-                        cmd = self.inQ.get()
-                        while cmd != "RESUME":
-                            cmd = self.inQ.get()
-                    elif cmd == "RESUME":
-                        pass
-                    else:
-                        sys.stderr.write("WARNING: unknown tracker command '{0}'".format(cmd))
                 except queue.Empty:
                     pass
 
-                #### TODO implement the poll loop
-                #### TODO get current Location object, create vector of In-Region booleans, compute other events, call notifier for events
-                events = {}
-                curTime = int(time.time())
-                for tableName in self.samples:
-                    if curTime >= self.samples[tableName]['time'] + self.settings['intervals'][tableName]:
-                        sample = self.car.getTable(tableName)
-                        print(f"Sample: {tableName}; VIN: {self.car.vin}")    #### TMP TMP TMP
-                        add, rem, chg, _ = dictDiff(self.samples[tableName]['sample'], sample)
-                        if self.db:
-                            if add or rem:
-                                self.outQ.put("Table {0} Schema Change: ADD={1}, REM={2}".
-                                              format(tableName, add, rem))
-                            if not chg - CHANGING_FIELDS:
-                                print(f"Write to DB: {self.car.vin}")   #### TMP TMP TMP
-                                self.db.insertRow(tableName, sample)
-
-                        if tableName == 'driveState':
-                            newLoc = geocoder.reverse((sample['latitude'],
-                                                       sample['longitude']))
-                            dist = distance.distance(prevLoc.point, newLoc.point).km
-                            print(f"Distance: {dist} km; VIN: {self.car.vin}") #### TMP TMP TMP
-                            if dist > self.settings['thresholds']['distance']:
-                                print(f"Moved: {dist}")
-                                #### TODO implement the logic to detect state transitions -- i.e., keep state, note the change, update accordingly
-                                '''
-                                if self.moving:
-                                    self.notifier.notify("STOPPED_MOVING", arg)
-                                else:
-                                    self.notifier.notify("STARTED_MOVING", arg)
-                                '''
-
-                        self.samples[tableName]['sample'] = sample
-                        self.samples[tableName]['time'] = curTime
-
-                    #### call notifier and pass it events
-                    print("Call Notifier:", self.car.vin)  #### TMP TMP TMP
-                    pass
+                curTime = time.time()
+                self._recordLag(wakeTime, curTime)
+                if self._checkDue(curTime):
+                    self._checkOnline(self.car.getOnlineState(), curTime)
+                for tableName in self._due(curTime):
+                    sample = self.car.getTable(tableName, self.scheduler.priority(tableName))
+                    self._processSample(tableName, sample, curTime)
+                self._endCycle(curTime)
+
+        except Exception as e:
+            self._bail(e)
+        finally:
+            self._close()
 
-                #### TODO make the polling interval a function of the car's state
-                ####      poll more frequently when driving and less when parked
-                print(f"Sleep: {self.car.vin}")
-                nextInterval = 1.0    #### TMP TMP TMP
-                time.sleep(nextInterval)
+    async def _getCmdAsync(self, timeout):
+        ''' Wait (up to the given number of secs) for a command on an asyncio
+            command Queue, and return it, or None if none arrived.
+        '''
+        if not self.inQ.empty():
+            return self.inQ.get_nowait()
+        if timeout == 0:
+            return None
+        try:
+            return await asyncio.wait_for(self.inQ.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def runAsync(self, client):
+        ''' Coroutine that does the same thing as run(), for use with the
+            asyncio engine.
+
+            N.B. the inQ must be an asyncio Queue, and all Tesla API requests are
+                 made through the given (shared) client, with the Car's
+                 coroutines that retry them on the loop
 
+            Inputs
+              client: ApiClient object used to make requests of the Tesla API
+        '''
+        self.loop = asyncio.get_running_loop()
+        try:
+            onlineState = await self.car.getOnlineStateAsync(client)
+            if not self._wakeFirst(onlineState) and onlineState != "online":
+                self._startAsleep(onlineState, time.time())
+            else:
+                if self._wakeFirst(onlineState) and not await client.call(self.car.wakeUp):
+                    raise Exception("unable to wake up the car")
+                self._start(await self.car.getCarStateAsync(client), time.time())
+
+            while True:
+                timeout = self._timeToNext(time.time())
+                wakeTime = time.time() + timeout
+                cmd = self._handleCmd(await self._getCmdAsync(timeout))
+                if cmd == "PAUSE":
+                    msg = await self.inQ.get()
+                    while msg.type not in ("RESUME", "STOP"):
+                        msg = await self.inQ.get()
+                    cmd = self._handleCmd(msg)
+                if cmd == "STOP":
+                    break
+
+                curTime = time.time()
+                self._recordLag(wakeTime, curTime)
+                if self._checkDue(curTime):
+                    self._checkOnline(await self.car.getOnlineStateAsync(client), curTime)
+                due = self._due(curTime)
+                samples = await self.car.getTablesAsync(client, due,
+                                                        [self.scheduler.priority(t) for t in due])
+                for tableName, sample in zip(due, samples):
+                    self._processSample(tableName, sample, curTime)
+                self._endCycle(curTime)
+
+        except asyncio.CancelledError:
+            self._send("STOPPING")
         except Exception as e:
-            traceback.print_exc()
-            self.outQ.put("BAILING {0}: {1}".format(self.car.vin, e))
-        if self.db:
-            self.db.close()
+            self._bail(e)
+        finally:
+            self._close()
 
 #
 # TESTING
 #
 if __name__ == '__main__':
-    #### TODO implement test cases
-    pass
+    motion = MotionStateMachine()
+    trace = [
+        {'shift_state': None, 'speed': None, 'power': 0},
+        {'shift_state': "D", 'speed': 0, 'power': 0},
+        {'shift_state': "D", 'speed': 12, 'power': 20},
+        {'shift_state': "D", 'speed': 0, 'power': 0},    # glitch
+        {'shift_state': "D", 'speed': 15, 'power': 25},
+        {'shift_state': "D", 'speed': 0, 'power': 0},
+        {'shift_state': "D", 'speed': 0, 'power': 0},
+        {'shift_state': "P", 'speed': None, 'power': 0},
+        {'shift_state': "P", 'speed': None, 'power': 0},
+    ]
+    for i, sample in enumerate(trace):
+        events = motion.update(sample, i)
+        print(f"{i}: {motion.state} {events}")